@@ -12,6 +12,7 @@ from ckanext.subscribe import (
     email_auth,
     email_verification,
     notification,
+    purge,
     schema,
 )
 from ckanext.subscribe.model import Frequency, Subscription
@@ -365,4 +366,6 @@ def subscribe_send_any_notifications(context, data_dict):
     notification.send_any_immediate_notifications()
     notification.send_weekly_notifications_if_its_time_to()
     notification.send_daily_notifications_if_its_time_to()
+    if purge.is_enabled_after_notifications():
+        purge.purge()
     return None
@@ -0,0 +1,425 @@
+"""
+An asyncio backend for delivering the emails, for SMTP relays that accept
+many concurrent sessions:
+
+    ckanext.subscribe.delivery_backend = asyncio
+    ckanext.subscribe.delivery_workers = 50
+
+Rather than a thread for each SMTP connection, as mailer.DeliveryPool has, an
+event loop in a single thread drives a fixed set of delivery_workers
+connections, each sending one email after another. Where the server supports
+PIPELINING, the MAIL, RCPT and DATA commands of each email are sent together,
+saving two round trips per email.
+
+The SMTP client is a small one, on asyncio streams, which does what
+mailer.SMTPConnection does with smtplib: EHLO, STARTTLS, AUTH (PLAIN or
+LOGIN), reconnecting after max_messages emails, and if the server disconnects.
+"""
+
+import asyncio
+import base64
+import smtplib
+import socket
+import ssl
+import threading
+
+import ckan.plugins as p
+from ckan.lib.mailer import MailerException
+
+from ckanext.subscribe import mailer
+
+log = __import__("logging").getLogger(__name__)
+config = p.toolkit.config
+
+# seconds to wait for the server to connect or reply
+TIMEOUT = 60
+
+
+class _Disconnected(Exception):
+    """The server closed the connection"""
+
+
+class _ReplyError(Exception):
+    """The server replied with an unexpected code"""
+
+    def __init__(self, code, message):
+        super(_ReplyError, self).__init__(code, message)
+        self.code = code
+        self.message = message
+
+
+class AsyncSMTPConnection(object):
+    """An authenticated SMTP connection, on asyncio streams, which can be
+    reused to send many emails.
+
+    Like mailer.SMTPConnection, it connects lazily, on the first email, and
+    reconnects if the server drops the connection, and after every
+    `max_messages` emails.
+    """
+
+    def __init__(self, max_messages=None):
+        if max_messages is None:
+            max_messages = p.toolkit.asint(
+                config.get("ckanext.subscribe.smtp_max_messages_per_connection", 100)
+            )
+        self.max_messages = max_messages
+        self.messages_sent = 0
+        self._reader = None
+        self._writer = None
+        # {EHLO keyword: its parameters}, e.g. {"auth": "PLAIN LOGIN"}
+        self._extensions = {}
+
+    async def connect(self):
+        smtp_server, smtp_starttls, smtp_user, smtp_password = (
+            mailer.get_smtp_settings()
+        )
+        host, port = _split_host_port(smtp_server)
+        try:
+            self._reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(host, port), TIMEOUT
+            )
+        except (OSError, asyncio.TimeoutError) as e:
+            log.exception(e)
+            raise MailerException(
+                f'SMTP server could not be connected to: "{smtp_server}" {e}'
+            )
+        try:
+            self._check(await self._reply(), 220)
+            await self._ehlo()
+
+            if smtp_starttls:
+                if "starttls" not in self._extensions:
+                    raise MailerException("SMTP server does not support STARTTLS")
+                self._check(await self._command("STARTTLS"), 220)
+                await self._start_tls(host)
+                # Re-identify ourselves over TLS connection.
+                await self._ehlo()
+
+            if smtp_user:
+                assert smtp_password, (
+                    "If smtp.user is configured then "
+                    "smtp.password must be configured as well."
+                )
+                await self._login(smtp_user, smtp_password)
+        except (_ReplyError, _Disconnected, OSError, asyncio.TimeoutError) as e:
+            msg = f"{e!r}"
+            log.exception(msg)
+            await self.close()
+            raise MailerException(msg)
+        except MailerException:
+            await self.close()
+            raise
+        self.messages_sent = 0
+
+    async def close(self):
+        if self._writer is None:
+            return
+        try:
+            self._writer.write(b"QUIT\r\n")
+            await asyncio.wait_for(self._writer.drain(), TIMEOUT)
+        except (OSError, asyncio.TimeoutError):
+            # the connection is unusable anyway
+            pass
+        writer = self._writer
+        self._abort()
+        try:
+            await asyncio.wait_for(writer.wait_closed(), TIMEOUT)
+        except (OSError, asyncio.TimeoutError):
+            pass
+
+    def _abort(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+    async def sendmail(self, mail_from, recipient_email, msg_string):
+        if self._writer is not None and self.messages_sent >= self.max_messages:
+            log.debug(
+                f"Sent {self.messages_sent} emails on this SMTP connection - "
+                "reconnecting"
+            )
+            await self.close()
+        if self._writer is None:
+            await self.connect()
+        try:
+            try:
+                await self._transaction(mail_from, recipient_email, msg_string)
+            except (_Disconnected, ConnectionError):
+                # the server may time out idle connections, or close them
+                # after its own limit of messages, so reconnect and retry once
+                log.debug("SMTP server disconnected - reconnecting")
+                self._abort()
+                await self.connect()
+                await self._transaction(mail_from, recipient_email, msg_string)
+        except _ReplyError as e:
+            msg = f"{e!r}"
+            log.exception(msg)
+            # carry on with the next email on this connection
+            await self._reset()
+            raise MailerException(msg)
+        except _Disconnected as e:
+            log.exception(e)
+            self._abort()
+            raise MailerException(f"SMTP server disconnected: {e!r}")
+        except (OSError, asyncio.TimeoutError) as e:
+            # the connection is broken, so start afresh for the next email
+            log.exception(e)
+            self._abort()
+            raise MailerException(f"SMTP connection failed: {e!r}")
+        self.messages_sent += 1
+        log.info(f"Sent email to {recipient_email}")
+
+    async def _transaction(self, mail_from, recipient_email, msg_string):
+        commands = [
+            f"MAIL FROM:{smtplib.quoteaddr(mail_from)}",
+            f"RCPT TO:{smtplib.quoteaddr(recipient_email)}",
+            "DATA",
+        ]
+        if "pipelining" in self._extensions:
+            # send the commands together, then read their replies (RFC 2920)
+            self._writer.write(
+                b"".join(command.encode("ascii") + b"\r\n" for command in commands)
+            )
+            await self._writer.drain()
+            replies = [await self._reply() for command in commands]
+        else:
+            replies = []
+            for command in commands:
+                replies.append(await self._command(command))
+                if replies[-1][0] >= 400:
+                    break
+        try:
+            self._check(replies[0], 250)
+            self._check(replies[1], 250, 251)
+        except _ReplyError:
+            if replies[-1][0] == 354:
+                # the server took the DATA command regardless, so end it
+                self._writer.write(b".\r\n")
+                await self._writer.drain()
+                await self._reply()
+            raise
+        self._check(replies[2], 354)
+
+        data = smtplib.quotedata(msg_string).encode("ascii")
+        if not data.endswith(b"\r\n"):
+            data += b"\r\n"
+        self._writer.write(data + b".\r\n")
+        await self._writer.drain()
+        self._check(await self._reply(), 250)
+
+    async def _reset(self):
+        try:
+            self._check(await self._command("RSET"), 250)
+        except (_ReplyError, _Disconnected, OSError, asyncio.TimeoutError):
+            self._abort()
+
+    async def _ehlo(self):
+        local_hostname = socket.getfqdn()
+        code, lines = await self._command(f"EHLO {local_hostname}")
+        self._extensions = {}
+        if code != 250:
+            # an old server
+            self._check(await self._command(f"HELO {local_hostname}"), 250)
+            return
+        for line in lines[1:]:
+            keyword, _, params = line.partition(" ")
+            self._extensions[keyword.lower()] = params
+
+    async def _start_tls(self, host):
+        # like smtplib's starttls(), which doesn't verify the certificate
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        if hasattr(self._writer, "start_tls"):
+            # Python 3.11+
+            await self._writer.start_tls(context, server_hostname=host)
+            return
+        loop = asyncio.get_running_loop()
+        transport = self._writer.transport
+        protocol = transport.get_protocol()
+        tls_transport = await loop.start_tls(
+            transport, protocol, context, server_hostname=host
+        )
+        self._writer = asyncio.StreamWriter(tls_transport, protocol, self._reader, loop)
+
+    async def _login(self, user, password):
+        mechanisms = self._extensions.get("auth", "").upper().split()
+        if "PLAIN" in mechanisms:
+            token = _b64("\0" + user + "\0" + password)
+            self._check(await self._command(f"AUTH PLAIN {token}"), 235)
+        elif "LOGIN" in mechanisms:
+            self._check(await self._command("AUTH LOGIN"), 334)
+            self._check(await self._command(_b64(user)), 334)
+            self._check(await self._command(_b64(password)), 235)
+        else:
+            raise MailerException("SMTP server does not support AUTH PLAIN or LOGIN")
+
+    async def _command(self, command):
+        self._writer.write(command.encode("ascii") + b"\r\n")
+        await self._writer.drain()
+        return await self._reply()
+
+    async def _reply(self):
+        """Reads a reply, which may be several lines long
+
+        :returns: (code, [line of text])
+        """
+        lines = []
+        while True:
+            line = await asyncio.wait_for(self._reader.readline(), TIMEOUT)
+            if not line.endswith(b"\n"):
+                raise _Disconnected("Connection unexpectedly closed")
+            lines.append(line[4:].strip().decode("utf-8", "replace"))
+            if line[3:4] != b"-":
+                break
+        try:
+            code = int(line[:3])
+        except ValueError:
+            raise _ReplyError(-1, line.decode("utf-8", "replace"))
+        return code, lines
+
+    @staticmethod
+    def _check(reply, *expected_codes):
+        code, lines = reply
+        if code == 421:
+            # the server is closing the connection
+            raise _Disconnected(" ".join(lines))
+        if code not in expected_codes:
+            raise _ReplyError(code, " ".join(lines))
+
+
+def _split_host_port(smtp_server):
+    # "host" or "host:port", as smtplib.SMTP.connect() accepts
+    host, colon, port = smtp_server.rpartition(":")
+    if not colon:
+        return smtp_server, smtplib.SMTP_PORT
+    return host, int(port)
+
+
+def _b64(text):
+    return base64.b64encode(text.encode("utf-8")).decode("ascii")
+
+
+class AsyncDeliveryPool(object):
+    """Delivers the emails sent within the block over a fixed set of SMTP
+    connections, driven by an asyncio event loop in a thread of its own. It
+    has the same interface as mailer.DeliveryPool:
+
+        with async_mailer.AsyncDeliveryPool() as pool:
+            for email in emails:
+                mailer.mail_recipient(...)
+        log.info(pool.report)
+
+    Delivery failures are logged and recorded in the `report`, rather than
+    raised, so that one bad mailbox doesn't stop the other emails going out.
+
+    :param workers: the number of SMTP connections, and so the number of
+        emails sent concurrently
+        (optional, default: ckanext.subscribe.delivery_workers)
+    :param max_messages: the number of emails after which each connection is
+        reconnected
+        (optional, default: ckanext.subscribe.smtp_max_messages_per_connection)
+    """
+
+    def __init__(self, workers=None, max_messages=None):
+        if workers is None:
+            workers = p.toolkit.asint(
+                config.get("ckanext.subscribe.delivery_workers", 1)
+            )
+        self.workers = max(1, workers)
+        self.max_messages = max_messages
+        self.report = mailer.DeliveryReport()
+        self._loop = None
+        self._thread = None
+        self._queue = None
+        self._senders = []
+
+    def __enter__(self):
+        mailer.set_delivery_pool(self)
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._loop.run_forever, name="subscribe-delivery", daemon=True
+        )
+        self._thread.start()
+        self._run(self._start())
+        self.report.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        mailer.set_delivery_pool(None)
+        try:
+            self._run(self._stop())
+        finally:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+            self.report.finish()
+
+    def submit(self, msg, mail_from, recipient_email):
+        self.submit_string(msg.as_string(), mail_from, recipient_email)
+
+    def submit_string(self, msg_string, mail_from, recipient_email, callback=None):
+        """Sends an email that is already rendered as a string. If all the
+        connections are busy, and the queue of emails waiting for them is
+        full, it waits for room in the queue.
+
+        :param callback: called when the email has been delivered, with None,
+            or with the MailerException if it failed. It is called in the
+            event loop's thread.
+        """
+        self._run(self._queue.put((msg_string, mail_from, recipient_email, callback)))
+
+    def wait(self):
+        """Waits until the emails submitted so far have been delivered"""
+        self._run(self._queue.join())
+
+    def _run(self, coroutine):
+        # runs the coroutine in the event loop, and waits for its result
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    async def _start(self):
+        # don't let the queue of rendered emails grow without bound
+        self._queue = asyncio.Queue(maxsize=self.workers * 10)
+        self._senders = [
+            asyncio.ensure_future(self._sender()) for _ in range(self.workers)
+        ]
+
+    async def _stop(self):
+        for _ in self._senders:
+            await self._queue.put(None)
+        await asyncio.gather(*self._senders)
+
+    async def _sender(self):
+        # sends the queued emails, one after another, over one connection
+        connection = AsyncSMTPConnection(max_messages=self.max_messages)
+        try:
+            while True:
+                email = await self._queue.get()
+                try:
+                    if email is None:
+                        return
+                    await self._deliver(connection, *email)
+                finally:
+                    self._queue.task_done()
+        finally:
+            await connection.close()
+
+    async def _deliver(
+        self, connection, msg_string, mail_from, recipient_email, callback=None
+    ):
+        try:
+            await connection.sendmail(mail_from, recipient_email, msg_string)
+        except Exception as e:
+            error = e
+            if not isinstance(error, MailerException):
+                # don't let a surprise stop this connection's sending
+                log.exception(error)
+                error = MailerException(f"{error!r}")
+            log.error(f"Could not send email to {recipient_email}: {error}")
+            self.report.record_failure(recipient_email)
+            if callback:
+                callback(error)
+        else:
+            self.report.record_success()
+            if callback:
+                callback(None)
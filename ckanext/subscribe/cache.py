@@ -0,0 +1,157 @@
+"""
+Caches of the objects that emails are about, and the links in them, for the
+duration of a notification run.
+
+Within an object_cache() block, each dataset, group or org is fetched from the
+database at most once, and the ones a batch of emails is about can be fetched
+in one go with prefetch():
+
+    with cache.object_cache():
+        cache.prefetch([("dataset", dataset_id), ...])
+        dataset = cache.get_object("dataset", dataset_id)
+
+The objects are lightweight rows with just the id, name and title.
+
+Within a url_cache() block, each link is built by Flask only once. Links with
+a recipient's code are built once with a placeholder, which is then replaced
+by each code:
+
+    with cache.url_cache():
+        object_link = cache.url_for("dataset.read", id=dataset_id)
+        manage_link = cache.url_with_code("subscribe.manage", code)
+"""
+
+import contextlib
+import threading
+from collections import defaultdict
+from urllib.parse import quote
+
+import ckan.plugins as p
+from ckan import model
+
+# stand-in for the code when building a link for url_with_code(). It is letters
+# only, so it is not escaped in the URL.
+URL_CODE_PLACEHOLDER = "SubscribeUrlCodePlaceholder"
+
+# the object_cache() and url_cache() of the current notification run, if any
+_local = threading.local()
+
+
+def get_object(object_type, object_id):
+    """Returns the dataset, group or org with this id, from the current
+    object_cache() if there is one. It has (at least) the id, name and title.
+
+    :param object_type: "dataset", "group" or "organization"
+    """
+    cache = getattr(_local, "object_cache", None)
+    if cache is not None:
+        return cache.get(object_type, object_id)
+    return _object_class(object_type).get(object_id)
+
+
+def prefetch(objects):
+    """Fetches the objects into the current object_cache(), if there is one,
+    so they are ready for get_object().
+
+    :param objects: iterable of (object_type, object_id)
+    """
+    cache = getattr(_local, "object_cache", None)
+    if cache is not None:
+        cache.prefetch(objects)
+
+
+@contextlib.contextmanager
+def object_cache():
+    """Caches the objects looked up with get_object() within the block"""
+    if getattr(_local, "object_cache", None) is not None:
+        # already caching, so just carry on using it
+        yield _local.object_cache
+        return
+    _local.object_cache = ObjectCache()
+    try:
+        yield _local.object_cache
+    finally:
+        _local.object_cache = None
+
+
+class ObjectCache(object):
+    """The datasets, groups and orgs looked up, each fetched at most once"""
+
+    def __init__(self):
+        # {(object class, id): row, or None if it doesn't exist}
+        self._objects = {}
+        self.queries = 0
+
+    def prefetch(self, objects):
+        """Fetches the objects that aren't already cached, with one query per
+        type of object.
+
+        :param objects: iterable of (object_type, object_id)
+        """
+        ids_to_fetch = defaultdict(set)  # {object class: {id, ...}}
+        for object_type, object_id in objects:
+            object_class = _object_class(object_type)
+            if (object_class, object_id) not in self._objects:
+                ids_to_fetch[object_class].add(object_id)
+        for object_class, ids in ids_to_fetch.items():
+            self._fetch(object_class, ids)
+
+    def get(self, object_type, object_id):
+        object_class = _object_class(object_type)
+        if (object_class, object_id) not in self._objects:
+            self._fetch(object_class, {object_id})
+        return self._objects[(object_class, object_id)]
+
+    def _fetch(self, object_class, ids):
+        self.queries += 1
+        rows = {
+            row.id: row
+            for row in model.Session.query(
+                object_class.id, object_class.name, object_class.title
+            ).filter(object_class.id.in_(ids))
+        }
+        for id_ in ids:
+            self._objects[(object_class, id_)] = rows.get(id_)
+
+
+def _object_class(object_type):
+    return model.Package if object_type == "dataset" else model.Group
+
+
+def url_for(endpoint, **kwargs):
+    """Returns the qualified URL of an endpoint, from the current url_cache()
+    if there is one."""
+    cache = getattr(_local, "url_cache", None)
+    if cache is None:
+        return p.toolkit.url_for(endpoint, qualified=True, **kwargs)
+    key = (endpoint, tuple(kwargs.items()))
+    url = cache.get(key)
+    if url is None:
+        url = cache[key] = p.toolkit.url_for(endpoint, qualified=True, **kwargs)
+    return url
+
+
+def url_with_code(endpoint, code, **kwargs):
+    """Returns the qualified URL of an endpoint, with the code as a query
+    parameter. Within a url_cache(), the URL is only built once, for all the
+    codes."""
+    if getattr(_local, "url_cache", None) is None:
+        return p.toolkit.url_for(endpoint, code=code, qualified=True, **kwargs)
+    url = url_for(endpoint, code=URL_CODE_PLACEHOLDER, **kwargs)
+    return url.replace(URL_CODE_PLACEHOLDER, quote(code, safe=""))
+
+
+@contextlib.contextmanager
+def url_cache():
+    """Caches the URLs built with url_for() and url_with_code() within the
+    block"""
+    if getattr(_local, "url_cache", None) is not None:
+        # already caching, so just carry on using it
+        yield _local.url_cache
+        return
+    # {(endpoint, args): url}
+    _local.url_cache = {}
+    try:
+        yield _local.url_cache
+    finally:
+        _local.url_cache = None
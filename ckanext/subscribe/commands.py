@@ -0,0 +1,78 @@
+import time
+
+import click
+
+log = __import__("logging").getLogger(__name__)
+
+
+@click.group(short_help="ckanext-subscribe commands")
+def subscribe():
+    """ckanext-subscribe commands"""
+    pass
+
+
+@subscribe.command("send-any-notifications")
+@click.option(
+    "-r",
+    "--repeatedly",
+    is_flag=True,
+    help="Keep running, sending the notifications as they fall due",
+)
+def send_any_notifications(repeatedly):
+    """Send any notifications that are due."""
+    import ckan.plugins as p
+    from ckan import model
+
+    from ckanext.subscribe.scheduler import Scheduler
+
+    if repeatedly:
+        Scheduler().run()
+        return
+    p.toolkit.get_action("subscribe_send_any_notifications")(
+        {"model": model, "ignore_auth": True}, {}
+    )
+
+
+@subscribe.command()
+@click.option(
+    "--shards",
+    type=click.IntRange(min=1),
+    required=True,
+    help="The number of worker processes to share the sending between",
+)
+def send(shards):
+    """Send any notifications that are due, with several worker processes,
+    each sending to a share of the email addresses."""
+    from ckanext.subscribe import parallel
+
+    report = parallel.send_any_notifications(shards)
+    click.echo(f"Notification run, in {shards} shards: {report}")
+
+
+@subscribe.command()
+@click.option(
+    "-r", "--repeatedly", is_flag=True, help="Keep running, delivering every 10s"
+)
+def deliver(repeatedly):
+    """Deliver the emails queued in the outbox (when ckanext.subscribe.outbox
+    = true)."""
+    from ckanext.subscribe import outbox
+
+    while True:
+        report = outbox.deliver()
+        if not repeatedly:
+            click.echo(f"Outbox delivery: {report}")
+            break
+        log.debug("Repeating in 10s")
+        time.sleep(10)
+
+
+@subscribe.command("purge-codes")
+def purge_codes():
+    """Delete the expired codes, stale unverified subscriptions and old
+    history."""
+    from ckanext.subscribe import purge
+
+    purged = purge.purge()
+    for kind, count in sorted(purged.items()):
+        click.echo(f"Purged {count} {kind.replace('_', ' ')}")
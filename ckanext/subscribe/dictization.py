@@ -5,6 +5,10 @@ from ckan.lib.dictization import table_dict_save, table_dictize
 
 from ckanext.subscribe.model import Frequency, Subscription
 
+# the fields of the objects in activity.data (the package, group or org) that
+# notifications use
+ACTIVITY_DATA_FIELDS = ("id", "name", "title")
+
 
 def subscription_save(subscription_dict, context):
     subscription_obj = table_dict_save(subscription_dict, Subscription, context)
@@ -35,3 +39,29 @@ def dictize_subscription(subscription_obj, context, include_name=False):
     subscription_dict["frequency"] = Frequency(subscription_dict["frequency"]).name
 
     return subscription_dict
+
+
+def dictize_activity(activity):
+    """Dictizes an activity with just the fields that notifications use.
+
+    Unlike ckanext.activity's activity_list_dictize(), this doesn't dictize
+    and copy the whole of activity.data - only the id, name and title of the
+    package, group or org in it.
+
+    :param activity: Activity object, or a row with the same fields
+    """
+    return {
+        "id": activity.id,
+        "timestamp": activity.timestamp.isoformat(),
+        "user_id": activity.user_id,
+        "object_id": activity.object_id,
+        "activity_type": activity.activity_type,
+        "data": {
+            key: {
+                field: value[field] for field in ACTIVITY_DATA_FIELDS if field in value
+            }
+            for key, value in (activity.data or {}).items()
+            if isinstance(value, dict)
+            and any(field in value for field in ACTIVITY_DATA_FIELDS)
+        },
+    }
@@ -22,28 +22,30 @@ import string
 
 import ckan.plugins as p
 from ckan import model
+from ckan.model.types import make_uuid
 from six import text_type
 
-from ckanext.subscribe import mailer
-from ckanext.subscribe.interfaces import ISubscribe
+from ckanext.subscribe import mailer, pipeline
 from ckanext.subscribe.model import LoginCode
 
 log = __import__("logging").getLogger(__name__)
 config = p.toolkit.config
 
 CODE_EXPIRY = datetime.timedelta(days=7)
+# the number of rows in each multi-row INSERT
+INSERT_BATCH_SIZE = 1000
 
 
 def send_subscription_confirmation_email(code, subscription=None):
     email_vars = {}
-    for subscribe in p.PluginImplementations(ISubscribe):
-        email_vars = subscribe.get_email_vars(
+    for get_email_vars in pipeline.hooks("get_email_vars"):
+        email_vars = get_email_vars(
             subscription=subscription, code=code, email_vars=email_vars
         )
 
     plain_text_footer = html_footer = ""
-    for subscribe in p.PluginImplementations(ISubscribe):
-        plain_text_footer, html_footer = subscribe.get_footer_contents(
+    for get_footer_contents in pipeline.hooks("get_footer_contents"):
+        plain_text_footer, html_footer = get_footer_contents(
             email_vars,
             subscription=subscription,
             plain_text_footer=plain_text_footer,
@@ -54,12 +56,12 @@ def send_subscription_confirmation_email(code, subscription=None):
     email_vars["html_footer"] = html_footer
 
     subject = plain_text_body = html_body = ""
-    for subscribe in p.PluginImplementations(ISubscribe):
+    for get_contents in pipeline.hooks("get_subscription_confirmation_email_contents"):
         (
             subject,
             plain_text_body,
             html_body,
-        ) = subscribe.get_subscription_confirmation_email_contents(
+        ) = get_contents(
             email_vars,
             subject=subject,
             plain_text_body=plain_text_body,
@@ -78,14 +80,14 @@ def send_subscription_confirmation_email(code, subscription=None):
 
 def send_manage_email(code, subscription=None, email=None):
     email_vars = {}
-    for subscribe in p.PluginImplementations(ISubscribe):
-        email_vars = subscribe.get_email_vars(
+    for get_email_vars in pipeline.hooks("get_email_vars"):
+        email_vars = get_email_vars(
             code=code, subscription=subscription, email=email, email_vars=email_vars
         )
 
     plain_text_footer = html_footer = ""
-    for subscribe in p.PluginImplementations(ISubscribe):
-        plain_text_footer, html_footer = subscribe.get_footer_contents(
+    for get_footer_contents in pipeline.hooks("get_footer_contents"):
+        plain_text_footer, html_footer = get_footer_contents(
             email_vars,
             subscription=subscription,
             plain_text_footer=plain_text_footer,
@@ -96,8 +98,8 @@ def send_manage_email(code, subscription=None, email=None):
     email_vars["html_footer"] = html_footer
 
     subject = plain_text_body = html_body = ""
-    for subscribe in p.PluginImplementations(ISubscribe):
-        subject, plain_text_body, html_body = subscribe.get_manage_email_contents(
+    for get_contents in pipeline.hooks("get_manage_email_contents"):
+        subject, plain_text_body, html_body = get_contents(
             email_vars,
             subject=subject,
             plain_text_body=plain_text_body,
@@ -129,6 +131,34 @@ def create_code(email):
     return code
 
 
+def create_codes(emails, commit=True):
+    """Creates a login code for each of the email addresses. Unlike calling
+    create_code() for each one, this inserts them all in one transaction, with
+    multi-row INSERTs.
+
+    :param emails: email addresses
+    :type emails: iterable of strings
+    :param commit: whether to commit the codes, or leave that to the caller
+    :type commit: bool
+
+    :returns: {email: code}
+    :rtype: dict
+    """
+    expires = datetime.datetime.now() + CODE_EXPIRY
+    codes = {email: text_type(make_code()) for email in emails}
+    rows = [
+        dict(id=make_uuid(), email=email, code=code, expires=expires)
+        for email, code in codes.items()
+    ]
+    for i in range(0, len(rows), INSERT_BATCH_SIZE):
+        model.Session.execute(
+            LoginCode.__table__.insert().values(rows[i : i + INSERT_BATCH_SIZE])
+        )
+    if commit:
+        model.Session.commit()
+    return codes
+
+
 def make_code():
     # random.SystemRandom() is documented as suitable for cryptographic use
     return "".join(
@@ -6,8 +6,7 @@ import ckan.plugins as p
 from ckan import model
 from six import text_type
 
-from ckanext.subscribe import mailer
-from ckanext.subscribe.interfaces import ISubscribe
+from ckanext.subscribe import mailer, pipeline
 
 config = p.toolkit.config
 
@@ -18,10 +17,10 @@ def send_request_email(subscription):
     email_vars = get_verification_email_vars(subscription)
 
     plain_text_footer = html_footer = ""
-    for subscribe in p.PluginImplementations(ISubscribe):
+    for get_footer_contents in pipeline.hooks("get_footer_contents"):
         # We pass in subscription=None here because there is no active
         # subscription yet, so we don't want to include an unsubscribe link.
-        plain_text_footer, html_footer = subscribe.get_footer_contents(
+        plain_text_footer, html_footer = get_footer_contents(
             email_vars,
             subscription=None,
             plain_text_footer=plain_text_footer,
@@ -32,8 +31,8 @@ def send_request_email(subscription):
     email_vars["html_footer"] = html_footer
 
     subject = plain_text_body = html_body = ""
-    for subscribe in p.PluginImplementations(ISubscribe):
-        subject, plain_text_body, html_body = subscribe.get_verification_email_contents(
+    for get_contents in pipeline.hooks("get_verification_email_contents"):
+        subject, plain_text_body, html_body = get_contents(
             email_vars, subject, plain_text_body, html_body
         )
 
@@ -49,8 +48,8 @@ def send_request_email(subscription):
 
 def get_verification_email_vars(subscription):
     email_vars = {}
-    for subscribe in p.PluginImplementations(ISubscribe):
-        email_vars = subscribe.get_email_vars(
+    for get_email_vars in pipeline.hooks("get_email_vars"):
+        email_vars = get_email_vars(
             code=subscription.verification_code,
             subscription=subscription,
             email_vars=email_vars,
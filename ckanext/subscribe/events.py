@@ -0,0 +1,174 @@
+"""
+Event-driven immediate notifications. Rather than polling for new activity,
+the scheduler can wait for PostgreSQL to tell it about each new activity, and
+then notify the activity on just those objects, within a second or so.
+
+With ckanext.subscribe.listen = true, the scheduler LISTENs on CHANNEL, and
+a trigger on the activity table (added when it first listens) sends a NOTIFY
+with the object_id of each activity inserted, when its transaction commits:
+
+    listener = events.ActivityListener()
+    listener.listen()
+    object_ids = listener.wait(timeout=60)  # {object_id, ...}
+
+Bursts of activity, e.g. a dataset edited several times in a row, are
+gathered up for ckanext.subscribe.listen_debounce seconds, and notified
+together.
+"""
+
+import select
+import time
+
+import ckan.plugins as p
+from ckan import model
+from sqlalchemy import text
+
+log = __import__("logging").getLogger(__name__)
+config = p.toolkit.config
+
+CHANNEL = "ckanext_subscribe_activity"
+TRIGGER = "subscribe_notify_activity"
+
+
+def is_enabled():
+    return p.toolkit.asbool(config.get("ckanext.subscribe.listen", False))
+
+
+def get_debounce():
+    return float(config.get("ckanext.subscribe.listen_debounce", 0.5))
+
+
+def is_trigger_installed():
+    return bool(
+        model.Session.execute(
+            text("SELECT 1 FROM pg_trigger WHERE tgname = :name"), {"name": TRIGGER}
+        ).scalar()
+    )
+
+
+def install_trigger():
+    """Adds the trigger to the activity table, replacing any that is there.
+
+    :returns: whether it was added - not if there is no activity table yet
+    :rtype: bool
+    """
+    if not model.Session.execute(
+        text("SELECT to_regclass('activity') IS NOT NULL")
+    ).scalar():
+        return False
+    # the object_id of each activity is NOTIFYed when its transaction commits.
+    # (Repeats of the same object_id in a transaction are sent once.)
+    model.Session.execute(
+        text(
+            f"""
+            CREATE OR REPLACE FUNCTION {TRIGGER}() RETURNS trigger AS $$
+            BEGIN
+                PERFORM pg_notify('{CHANNEL}', NEW.object_id);
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+            """
+        )
+    )
+    model.Session.execute(text(f"DROP TRIGGER IF EXISTS {TRIGGER} ON activity"))
+    model.Session.execute(
+        text(
+            f"""
+            CREATE TRIGGER {TRIGGER}
+            AFTER INSERT ON activity
+            FOR EACH ROW EXECUTE PROCEDURE {TRIGGER}()
+            """
+        )
+    )
+    model.Session.commit()
+    return True
+
+
+class ActivityListener(object):
+    """LISTENs for the ids of the objects with new activity, on a database
+    connection of its own.
+
+    :param debounce: seconds to wait for more activity after the first, so a
+        burst is returned together
+        (optional, default: ckanext.subscribe.listen_debounce)
+    """
+
+    def __init__(self, debounce=None):
+        self.debounce = get_debounce() if debounce is None else debounce
+        self._raw_connection = None
+
+    def listen(self):
+        if self._raw_connection is not None:
+            return
+        if not is_trigger_installed():
+            # the first time, or the activity table was recreated
+            try:
+                installed = install_trigger()
+            except Exception:
+                log.exception(f"Could not add the {TRIGGER} trigger")
+                model.Session.rollback()
+                installed = False
+            if installed:
+                log.info(f"Added the {TRIGGER} trigger")
+            else:
+                log.warning(
+                    f"The {TRIGGER} trigger is missing, so activity won't be "
+                    "notified until the next poll"
+                )
+        self._raw_connection = model.Session.get_bind().raw_connection()
+        connection = _driver_connection(self._raw_connection)
+        connection.autocommit = True
+        with connection.cursor() as cursor:
+            cursor.execute(f"LISTEN {CHANNEL}")
+        log.debug(f"Listening on {CHANNEL}")
+
+    def close(self):
+        if self._raw_connection is None:
+            return
+        raw_connection, self._raw_connection = self._raw_connection, None
+        try:
+            with _driver_connection(raw_connection).cursor() as cursor:
+                cursor.execute(f"UNLISTEN {CHANNEL}")
+        finally:
+            # the pool would otherwise reuse it, still in autocommit
+            raw_connection.invalidate()
+
+    def wait(self, timeout):
+        """Waits for activity, for up to `timeout` seconds.
+
+        :returns: the ids of the objects with new activity (empty if there
+            was none)
+        :rtype: set
+        """
+        object_ids = self._receive(timeout)
+        if object_ids and self.debounce:
+            deadline = time.monotonic() + self.debounce
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                object_ids |= self._receive(remaining)
+        return object_ids
+
+    def _receive(self, timeout):
+        connection = _driver_connection(self._raw_connection)
+        object_ids = self._drain(connection)
+        if object_ids:
+            return object_ids
+        readable, _, _ = select.select([connection], [], [], max(timeout, 0))
+        if readable:
+            connection.poll()
+        return self._drain(connection)
+
+    @staticmethod
+    def _drain(connection):
+        object_ids = {notify.payload for notify in connection.notifies}
+        del connection.notifies[:]
+        return object_ids
+
+
+def _driver_connection(raw_connection):
+    # the psycopg2 connection, which is .driver_connection in SQLAlchemy 2.0
+    return getattr(raw_connection, "driver_connection", None) or (
+        raw_connection.connection
+    )
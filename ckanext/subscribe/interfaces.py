@@ -1,3 +1,4 @@
+from ckan.plugins import PluginImplementations
 from ckan.plugins.interfaces import Interface
 
 from ckanext.subscribe.utils import filter_activities as subscribe_filter_activities
@@ -117,6 +118,13 @@ class ISubscribe(Interface):
         """Get the plain-text body and html body of an email with update
         notifications.
 
+        During a notification run, each distinct email is rendered once, with
+        placeholders for the recipient's code and email address in the
+        email_vars, which are substituted afterwards for each recipient (see
+        notification_email.render_cache()). So don't derive other values from
+        them here or in get_footer_contents() - do that in get_email_vars(),
+        which turns the render cache off.
+
         :param email_vars: Dict of strings to substitute into the text
         :type email_vars: dict
         :param type: String to indicate which kind of notification is to be send
@@ -165,9 +173,23 @@ class ISubscribe(Interface):
         :type include_activity_from: timestamp
         :param objects_subscribed_to_keys: Subject line of the email
         :type objects_subscribed_to_keys: list of strings
-        :return: activities from the database
-        :rtype: list of objects
+        :return: activities from the database. They are only iterated over
+                 once, so this can be a generator, to avoid loading them all
+                 into memory at once.
+        :rtype: iterable of objects
         """
         return subscribe_filter_activities(
             include_activity_from, objects_subscribed_to_keys
         )
+
+
+def has_custom_implementation(method_name):
+    """Returns whether any plugin implementing ISubscribe overrides the
+    default implementation of the given method, e.g. "get_activities". If not,
+    the default behaviour can be optimized, e.g. done in the database.
+    """
+    default = getattr(ISubscribe, method_name)
+    return any(
+        getattr(type(plugin), method_name, default) is not default
+        for plugin in PluginImplementations(ISubscribe)
+    )
@@ -0,0 +1,125 @@
+"""
+Locks shared between processes - e.g. so that only one of several replicas of
+the scheduler sends the notifications - using PostgreSQL advisory locks.
+
+    lock = locks.AdvisoryLock("scheduler")
+    if lock.acquire():
+        try:
+            ...
+        finally:
+            lock.release()
+
+The lock is held on a database connection of its own, so it is kept however
+many transactions the holder commits, and the database releases it if the
+process dies.
+
+A shared lock can be held by several processes at once, but not while
+another holds the lock exclusively.
+"""
+
+import hashlib
+
+from ckan import model
+from sqlalchemy import func, literal, select
+
+log = __import__("logging").getLogger(__name__)
+
+
+def lock_key(name):
+    """Returns the 64-bit advisory lock key for a lock name"""
+    digest = hashlib.md5(f"ckanext-subscribe:{name}".encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big", signed=True)
+
+
+class AdvisoryLock(object):
+    """A session-level advisory lock, which is taken without waiting
+
+    :param shared: take it in shared mode, rather than exclusively
+    """
+
+    def __init__(self, name, shared=False):
+        self.name = name
+        self.key = lock_key(name)
+        self.shared = shared
+        self._connection = None
+
+    @property
+    def held(self):
+        return self._connection is not None
+
+    def acquire(self):
+        """Tries to take the lock, returning straight away.
+
+        :returns: whether this process now holds the lock
+        :rtype: bool
+        """
+        if self.held:
+            return True
+        # autocommit, so the connection isn't left idle in a transaction for
+        # as long as the lock is held
+        connection = (
+            model.Session.get_bind()
+            .connect()
+            .execution_options(isolation_level="AUTOCOMMIT")
+        )
+        try:
+            try_lock = (
+                func.pg_try_advisory_lock_shared
+                if self.shared
+                else func.pg_try_advisory_lock
+            )
+            acquired = connection.execute(select(try_lock(self.key))).scalar()
+        except Exception:
+            connection.close()
+            raise
+        if not acquired:
+            connection.close()
+            return False
+        self._connection = connection
+        log.debug(f"Acquired lock {self.name}")
+        return True
+
+    def is_alive(self):
+        """Checks that the lock's connection is still up, since the lock goes
+        with it - e.g. if the database restarted. If it isn't, the lock is no
+        longer held.
+
+        :returns: whether this process still holds the lock
+        :rtype: bool
+        """
+        if not self.held:
+            return False
+        try:
+            self._connection.execute(select(literal(1)))
+        except Exception:
+            log.warning(f"Lost lock {self.name}", exc_info=True)
+            connection, self._connection = self._connection, None
+            try:
+                connection.close()
+            except Exception:
+                pass
+            return False
+        return True
+
+    def release(self):
+        if not self.held:
+            return
+        connection, self._connection = self._connection, None
+        try:
+            unlock = (
+                func.pg_advisory_unlock_shared
+                if self.shared
+                else func.pg_advisory_unlock
+            )
+            connection.execute(select(unlock(self.key)))
+        finally:
+            connection.close()
+        log.debug(f"Released lock {self.name}")
+
+
+def lock_transaction(name, session=None):
+    """Takes an advisory lock until the end of the current transaction,
+    waiting for it if another transaction holds it"""
+    (session or model.Session).execute(
+        select(func.pg_advisory_xact_lock(lock_key(name)))
+    )
@@ -2,11 +2,14 @@
 
 import smtplib
 import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait as futures_wait
 from email import utils
 from email.header import Header
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from time import time
+from time import monotonic, time
 
 import ckan
 import ckan.plugins as p
@@ -17,6 +20,9 @@ config = p.toolkit.config
 _ = p.toolkit._
 asbool = p.toolkit.asbool
 
+# the current DeliveryPool, if any
+_local = threading.local()
+
 
 def _mail_recipient(
     recipient_name,
@@ -61,61 +67,380 @@ def _mail_recipient(
     _mail_payload(msg, mail_from, recipient_email)
 
 
-def _mail_payload(msg, mail_from, recipient_email):
-    # Send the email using Python's smtplib.
+def get_smtp_settings():
+    """Returns the SMTP server's address, whether to STARTTLS, the user and
+    the password, from the CKAN config
+
+    :rtype: (str, bool, str, str)
+    """
     if "smtp.test_server" in config:
         # If 'smtp.test_server' is configured we assume we're running tests,
         # and don't use the smtp.server, starttls, user, password etc. options.
-        smtp_server = config["smtp.test_server"]
-        smtp_starttls = False
-        smtp_user = None
-        smtp_password = None
-    else:
-        smtp_server = config.get("smtp.server", "localhost")
-        smtp_starttls = asbool(config.get("smtp.starttls"))
-        smtp_user = config.get("smtp.user")
-        smtp_password = config.get("smtp.password")
+        return config["smtp.test_server"], False, None, None
+    return (
+        config.get("smtp.server", "localhost"),
+        asbool(config.get("smtp.starttls")),
+        config.get("smtp.user"),
+        config.get("smtp.password"),
+    )
 
-    smtp_connection = smtplib.SMTP(smtp_server)
 
+def set_delivery_pool(delivery_pool):
+    """Hands the emails sent in this thread to `delivery_pool`, rather than
+    sending them straight away, until it is set back to None.
+
+    :param delivery_pool: anything with a submit(msg, mail_from,
+        recipient_email) method, e.g. a DeliveryPool or an outbox.OutboxWriter
+    """
+    if delivery_pool is not None:
+        assert getattr(_local, "delivery_pool", None) is None, "Already delivering"
+    _local.delivery_pool = delivery_pool
+
+
+def _mail_payload(msg, mail_from, recipient_email):
+    delivery_pool = getattr(_local, "delivery_pool", None)
+    if delivery_pool is not None:
+        delivery_pool.submit(msg, mail_from, recipient_email)
+        return
+    # Send the email using Python's smtplib.
+    connection = SMTPConnection(max_messages=1)
     try:
-        smtp_connection.connect(smtp_server)
-    except socket.error as e:
-        log.exception(e)
-        raise MailerException(
-            f'SMTP server could not be connected to: "{smtp_server}" {e}'
-        )
-    try:
-        # Identify ourselves and prompt the server for supported features.
-        smtp_connection.ehlo()
-
-        # If 'smtp.starttls' is on in CKAN config, try to put the SMTP
-        # connection into TLS mode.
-        if smtp_starttls:
-            if smtp_connection.has_extn("STARTTLS"):
-                smtp_connection.starttls()
-                # Re-identify ourselves over TLS connection.
-                smtp_connection.ehlo()
-            else:
-                raise MailerException("SMTP server does not support STARTTLS")
-
-        # If 'smtp.user' is in CKAN config, try to login to SMTP server.
-        if smtp_user:
-            assert smtp_password, (
-                "If smtp.user is configured then "
-                "smtp.password must be configured as well."
+        connection.sendmail(mail_from, recipient_email, msg.as_string())
+    finally:
+        connection.close()
+
+
+class SMTPConnection(object):
+    """An authenticated connection to the SMTP server, which can be reused to
+    send many emails.
+
+    It connects lazily, on the first email. It transparently reconnects if the
+    server drops the connection, and after every `max_messages` emails, as many
+    servers limit the number of messages they accept in one session.
+    """
+
+    def __init__(self, max_messages=None):
+        if max_messages is None:
+            max_messages = p.toolkit.asint(
+                config.get("ckanext.subscribe.smtp_max_messages_per_connection", 100)
             )
-            smtp_connection.login(smtp_user, smtp_password)
+        self.max_messages = max_messages
+        self.messages_sent = 0
+        self._smtp = None
 
-        smtp_connection.sendmail(mail_from, [recipient_email], msg.as_string())
+    def connect(self):
+        smtp_server, smtp_starttls, smtp_user, smtp_password = get_smtp_settings()
+
+        smtp_connection = smtplib.SMTP()
+
+        try:
+            smtp_connection.connect(smtp_server)
+        except socket.error as e:
+            log.exception(e)
+            raise MailerException(
+                f'SMTP server could not be connected to: "{smtp_server}" {e}'
+            )
+        try:
+            # Identify ourselves and prompt the server for supported features.
+            smtp_connection.ehlo()
+
+            # If 'smtp.starttls' is on in CKAN config, try to put the SMTP
+            # connection into TLS mode.
+            if smtp_starttls:
+                if smtp_connection.has_extn("STARTTLS"):
+                    smtp_connection.starttls()
+                    # Re-identify ourselves over TLS connection.
+                    smtp_connection.ehlo()
+                else:
+                    raise MailerException("SMTP server does not support STARTTLS")
+
+            # If 'smtp.user' is in CKAN config, try to login to SMTP server.
+            if smtp_user:
+                assert smtp_password, (
+                    "If smtp.user is configured then "
+                    "smtp.password must be configured as well."
+                )
+                smtp_connection.login(smtp_user, smtp_password)
+        except smtplib.SMTPException as e:
+            msg = f"{e!r}"
+            log.exception(msg)
+            _quit(smtp_connection)
+            raise MailerException(msg)
+        except MailerException:
+            _quit(smtp_connection)
+            raise
+
+        self._smtp = smtp_connection
+        self.messages_sent = 0
+
+    def close(self):
+        if self._smtp is not None:
+            _quit(self._smtp)
+            self._smtp = None
+
+    def _discard(self):
+        # the connection is broken, so close its socket, without a QUIT
+        if self._smtp is not None:
+            self._smtp.close()
+            self._smtp = None
+
+    def sendmail(self, mail_from, recipient_email, msg_string):
+        if self._smtp is not None and self.messages_sent >= self.max_messages:
+            log.debug(
+                f"Sent {self.messages_sent} emails on this SMTP connection - "
+                "reconnecting"
+            )
+            self.close()
+        if self._smtp is None:
+            self.connect()
+        try:
+            try:
+                self._smtp.sendmail(mail_from, [recipient_email], msg_string)
+            except smtplib.SMTPServerDisconnected:
+                # the server may time out idle connections, or close them
+                # after its own limit of messages, so reconnect and retry once
+                log.debug("SMTP server disconnected - reconnecting")
+                self._discard()
+                self.connect()
+                self._smtp.sendmail(mail_from, [recipient_email], msg_string)
+        except smtplib.SMTPException as e:
+            msg = f"{e!r}"
+            log.exception(msg)
+            if isinstance(e, smtplib.SMTPServerDisconnected):
+                self._discard()
+            raise MailerException(msg)
+        except socket.error as e:
+            # the connection is broken, so start afresh for the next email
+            log.exception(e)
+            self._discard()
+            raise MailerException(f"SMTP connection failed: {e!r}")
+        self.messages_sent += 1
         log.info(f"Sent email to {recipient_email}")
 
-    except smtplib.SMTPException as e:
-        msg = f"{e!r}"
-        log.exception(msg)
-        raise MailerException(msg)
-    finally:
+
+def _quit(smtp_connection):
+    try:
         smtp_connection.quit()
+    except (smtplib.SMTPException, socket.error):
+        # the connection is unusable anyway
+        pass
+
+
+def get_delivery_pool(workers=None, max_messages=None):
+    """Returns a DeliveryPool, or with ckanext.subscribe.delivery_backend =
+    asyncio, an async_mailer.AsyncDeliveryPool, which has the same interface.
+
+    :param workers: the number of emails to send concurrently
+        (optional, default: ckanext.subscribe.delivery_workers)
+    :param max_messages: the number of emails after which each connection is
+        reconnected
+        (optional, default: ckanext.subscribe.smtp_max_messages_per_connection)
+    """
+    backend = config.get("ckanext.subscribe.delivery_backend", "threads")
+    if backend == "asyncio":
+        from ckanext.subscribe import async_mailer
+
+        return async_mailer.AsyncDeliveryPool(
+            workers=workers, max_messages=max_messages
+        )
+    if backend != "threads":
+        raise ValueError(
+            f"ckanext.subscribe.delivery_backend is {backend!r}, but must be "
+            "threads or asyncio"
+        )
+    return DeliveryPool(workers=workers, max_messages=max_messages)
+
+
+class DeliveryPool(object):
+    """Delivers the emails sent within the block using a pool of worker
+    threads, each with its own SMTP connection.
+
+    Delivery failures are logged and recorded in the `report`, rather than
+    raised, so that one bad mailbox doesn't stop the other emails going out.
+
+        with mailer.DeliveryPool() as pool:
+            for email in emails:
+                mailer.mail_recipient(...)
+        log.info(pool.report)
+
+    :param workers: the number of emails to send concurrently. With 1, the
+        emails are sent in the calling thread.
+        (optional, default: ckanext.subscribe.delivery_workers)
+    :param max_messages: the number of emails after which each worker
+        reconnects
+        (optional, default: ckanext.subscribe.smtp_max_messages_per_connection)
+    """
+
+    def __init__(self, workers=None, max_messages=None):
+        if workers is None:
+            workers = p.toolkit.asint(
+                config.get("ckanext.subscribe.delivery_workers", 1)
+            )
+        self.workers = max(1, workers)
+        self.max_messages = max_messages
+        self.report = DeliveryReport()
+        self._executor = None
+        self._slots = None
+        self._worker_local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        # the emails being delivered
+        self._futures = set()
+        self._futures_lock = threading.Lock()
+
+    def __enter__(self):
+        set_delivery_pool(self)
+        if self.workers > 1:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="subscribe-delivery"
+            )
+            # don't let the queue of rendered emails grow without bound
+            self._slots = threading.BoundedSemaphore(self.workers * 10)
+        self.report.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        set_delivery_pool(None)
+        try:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+        finally:
+            for connection in self._connections:
+                connection.close()
+            self.report.finish()
+
+    def submit(self, msg, mail_from, recipient_email):
+        self.submit_string(msg.as_string(), mail_from, recipient_email)
+
+    def submit_string(self, msg_string, mail_from, recipient_email, callback=None):
+        """Sends an email that is already rendered as a string.
+
+        :param callback: called when the email has been delivered, with None,
+            or with the MailerException if it failed. It may be called in a
+            worker thread.
+        """
+        if self._executor is None:
+            self._deliver(msg_string, mail_from, recipient_email, callback)
+            return
+        self._slots.acquire()
+        future = self._executor.submit(
+            self._deliver, msg_string, mail_from, recipient_email, callback
+        )
+        with self._futures_lock:
+            self._futures.add(future)
+        future.add_done_callback(self._done)
+
+    def _done(self, future):
+        self._slots.release()
+        with self._futures_lock:
+            self._futures.discard(future)
+
+    def wait(self):
+        """Waits until the emails submitted so far have been delivered"""
+        with self._futures_lock:
+            futures = list(self._futures)
+        futures_wait(futures)
+
+    def _deliver(self, msg_string, mail_from, recipient_email, callback=None):
+        try:
+            self._get_connection().sendmail(mail_from, recipient_email, msg_string)
+        except Exception as e:
+            error = e
+            if not isinstance(error, MailerException):
+                # otherwise, in a worker thread, it would be lost on the future
+                log.exception(error)
+                error = MailerException(f"{error!r}")
+            log.error(f"Could not send email to {recipient_email}: {error}")
+            self.report.record_failure(recipient_email)
+            if callback:
+                callback(error)
+        else:
+            self.report.record_success()
+            if callback:
+                callback(None)
+
+    def _get_connection(self):
+        # each worker thread has its own connection
+        connection = getattr(self._worker_local, "connection", None)
+        if connection is None:
+            connection = SMTPConnection(max_messages=self.max_messages)
+            self._worker_local.connection = connection
+            with self._connections_lock:
+                self._connections.append(connection)
+        return connection
+
+
+class DeliveryReport(object):
+    """Summary of the emails delivered by a DeliveryPool"""
+
+    def __init__(self):
+        self.sent = 0
+        self.failed = []
+        self.started = None
+        self.finished = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        self.started = monotonic()
+
+    def finish(self):
+        self.finished = monotonic()
+
+    def record_success(self):
+        with self._lock:
+            self.sent += 1
+
+    def record_failure(self, recipient_email):
+        with self._lock:
+            self.failed.append(recipient_email)
+
+    def add(self, other):
+        """Adds the emails of another report to this one - e.g. of another
+        process's share of a run"""
+        with self._lock:
+            self.sent += other.sent
+            self.failed.extend(other.failed)
+            if other.started is not None:
+                self.started = min(
+                    t for t in (self.started, other.started) if t is not None
+                )
+            if other.finished is not None:
+                self.finished = max(
+                    t for t in (self.finished, other.finished) if t is not None
+                )
+
+    def __getstate__(self):
+        # without the lock, so it can be returned from another process
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or monotonic()) - self.started
+
+    @property
+    def count(self):
+        """The number of emails delivered or failed"""
+        return self.sent + len(self.failed)
+
+    @property
+    def emails_per_second(self):
+        if not self.elapsed:
+            return 0.0
+        return self.count / self.elapsed
+
+    def __str__(self):
+        return (
+            f"{self.sent} emails sent, {len(self.failed)} failed, in "
+            f"{self.elapsed:.1f}s ({self.emails_per_second:.1f} emails/s)"
+        )
 
 
 def mail_recipient(
@@ -0,0 +1,65 @@
+"""Add subscribe_run and subscribe_run_recipient
+
+Revision ID: 3b7e9a2c5d14
+Revises: 8d2f1c4a7b3e
+Create Date: 2026-10-18 11:03:17.204118
+
+"""
+
+import datetime
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+from ckan.model.types import make_uuid
+
+# revision identifiers, used by Alembic.
+revision: str = "3b7e9a2c5d14"
+down_revision: Union[str, None] = "8d2f1c4a7b3e"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    engine = op.get_bind()
+    inspector = sa.inspect(engine)
+    tables = inspector.get_table_names()
+    if "subscribe_run" not in tables:
+        op.create_table(
+            "subscribe_run",
+            sa.Column("id", sa.UnicodeText, primary_key=True, default=make_uuid),
+            sa.Column("frequency", sa.Integer, nullable=False),
+            sa.Column("include_activity_from", sa.DateTime, nullable=False),
+            sa.Column("notification_datetime", sa.DateTime, nullable=False),
+            sa.Column(
+                "started",
+                sa.DateTime,
+                nullable=False,
+                default=datetime.datetime.utcnow,
+            ),
+            sa.Column("finished", sa.DateTime),
+        )
+        op.create_index(
+            "subscribe_run_frequency_idx",
+            "subscribe_run",
+            ["frequency", "finished"],
+        )
+    if "subscribe_run_recipient" not in tables:
+        op.create_table(
+            "subscribe_run_recipient",
+            sa.Column(
+                "run_id",
+                sa.UnicodeText,
+                sa.ForeignKey("subscribe_run.id", ondelete="CASCADE"),
+                primary_key=True,
+            ),
+            sa.Column("email", sa.UnicodeText, primary_key=True),
+            sa.Column("status", sa.UnicodeText, nullable=False),
+            sa.Column("sent", sa.DateTime, nullable=False),
+        )
+
+
+def downgrade() -> None:
+    op.drop_table("subscribe_run_recipient")
+    op.drop_index("subscribe_run_frequency_idx", table_name="subscribe_run")
+    op.drop_table("subscribe_run")
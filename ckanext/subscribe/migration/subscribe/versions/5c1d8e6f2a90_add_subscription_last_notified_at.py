@@ -0,0 +1,38 @@
+"""Add subscription.last_notified_at
+
+Revision ID: 5c1d8e6f2a90
+Revises: 3b7e9a2c5d14
+Create Date: 2026-10-18 11:48:05.662310
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "5c1d8e6f2a90"
+down_revision: Union[str, None] = "3b7e9a2c5d14"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    engine = op.get_bind()
+    inspector = sa.inspect(engine)
+    columns = [column["name"] for column in inspector.get_columns("subscription")]
+    if "last_notified_at" not in columns:
+        op.add_column(
+            "subscription", sa.Column("last_notified_at", sa.DateTime, nullable=True)
+        )
+        op.create_index(
+            "subscription_frequency_notified_idx",
+            "subscription",
+            ["frequency", "last_notified_at"],
+        )
+
+
+def downgrade() -> None:
+    op.drop_index("subscription_frequency_notified_idx", table_name="subscription")
+    op.drop_column("subscription", "last_notified_at")
@@ -0,0 +1,60 @@
+"""Add subscribe_outbox
+
+Revision ID: 8d2f1c4a7b3e
+Revises: 62e202866fb5
+Create Date: 2026-10-18 10:12:41.538920
+
+"""
+
+import datetime
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+from ckan.model.types import make_uuid
+
+# revision identifiers, used by Alembic.
+revision: str = "8d2f1c4a7b3e"
+down_revision: Union[str, None] = "62e202866fb5"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    engine = op.get_bind()
+    inspector = sa.inspect(engine)
+    tables = inspector.get_table_names()
+    if "subscribe_outbox" not in tables:
+        op.create_table(
+            "subscribe_outbox",
+            sa.Column("id", sa.UnicodeText, primary_key=True, default=make_uuid),
+            sa.Column("recipient_email", sa.UnicodeText, nullable=False),
+            sa.Column("mail_from", sa.UnicodeText),
+            sa.Column("message", sa.UnicodeText, nullable=False),
+            sa.Column("status", sa.UnicodeText, nullable=False, default="pending"),
+            sa.Column("attempts", sa.Integer, nullable=False, default=0),
+            sa.Column(
+                "next_attempt",
+                sa.DateTime,
+                nullable=False,
+                default=datetime.datetime.utcnow,
+            ),
+            sa.Column("last_error", sa.UnicodeText),
+            sa.Column(
+                "created",
+                sa.DateTime,
+                nullable=False,
+                default=datetime.datetime.utcnow,
+            ),
+            sa.Column("sent", sa.DateTime),
+        )
+        op.create_index(
+            "subscribe_outbox_status_idx",
+            "subscribe_outbox",
+            ["status", "next_attempt"],
+        )
+
+
+def downgrade() -> None:
+    op.drop_index("subscribe_outbox_status_idx", table_name="subscribe_outbox")
+    op.drop_table("subscribe_outbox")
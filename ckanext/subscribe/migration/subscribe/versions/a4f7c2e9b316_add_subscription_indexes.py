@@ -0,0 +1,76 @@
+"""Add indexes for the subscription lookups
+
+Revision ID: a4f7c2e9b316
+Revises: 5c1d8e6f2a90
+Create Date: 2026-10-18 12:20:44.918273
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "a4f7c2e9b316"
+down_revision: Union[str, None] = "5c1d8e6f2a90"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# {table: [(index name, columns, unique)]}
+INDEXES = {
+    "subscription": [
+        # one subscription per email address and object. It also serves the
+        # lookups by email address.
+        (
+            "subscription_email_object_idx",
+            ["email", "object_type", "object_id"],
+            True,
+        ),
+        # the subscriptions each notification run polls
+        ("subscription_frequency_verified_idx", ["frequency", "verified"], False),
+        ("subscription_verification_code_idx", ["verification_code"], False),
+    ],
+    "subscribe_login_code": [
+        ("subscribe_login_code_code_idx", ["code"], False),
+    ],
+}
+
+
+def upgrade() -> None:
+    engine = op.get_bind()
+    inspector = sa.inspect(engine)
+    for table, indexes in INDEXES.items():
+        existing = {index["name"] for index in inspector.get_indexes(table)}
+        for name, columns, unique in indexes:
+            if name in existing:
+                continue
+            if name == "subscription_email_object_idx":
+                _delete_duplicate_subscriptions()
+            op.create_index(name, table, columns, unique=unique)
+
+
+def _delete_duplicate_subscriptions():
+    # Before the unique index, subscribing twice at the same time could create
+    # two subscriptions for an email address and object. Keep the verified
+    # one, or else the oldest.
+    op.execute(
+        """
+        DELETE FROM subscription WHERE id IN (
+            SELECT id FROM (
+                SELECT id, row_number() OVER (
+                    PARTITION BY email, object_type, object_id
+                    ORDER BY verified DESC NULLS LAST, created, id
+                ) AS n
+                FROM subscription
+            ) AS ranked
+            WHERE n > 1
+        )
+        """
+    )
+
+
+def downgrade() -> None:
+    for table, indexes in INDEXES.items():
+        for name, _, _ in indexes:
+            op.drop_index(name, table_name=table)
@@ -0,0 +1,39 @@
+"""Add subscribe_run_shard
+
+Revision ID: b83e5f1a7d62
+Revises: e61b3f0d9c27
+Create Date: 2026-10-18 14:21:08.517326
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "b83e5f1a7d62"
+down_revision: Union[str, None] = "e61b3f0d9c27"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    engine = op.get_bind()
+    inspector = sa.inspect(engine)
+    if "subscribe_run_shard" not in inspector.get_table_names():
+        op.create_table(
+            "subscribe_run_shard",
+            sa.Column(
+                "run_id",
+                sa.UnicodeText,
+                sa.ForeignKey("subscribe_run.id", ondelete="CASCADE"),
+                primary_key=True,
+            ),
+            sa.Column("shard", sa.Integer, primary_key=True),
+            sa.Column("finished", sa.DateTime, nullable=False),
+        )
+
+
+def downgrade() -> None:
+    op.drop_table("subscribe_run_shard")
@@ -0,0 +1,34 @@
+"""Add subscribe_run.object_ids
+
+Revision ID: c5e81d3f9a27
+Revises: b83e5f1a7d62
+Create Date: 2026-10-18 16:05:42.318907
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects.postgresql import ARRAY
+
+# revision identifiers, used by Alembic.
+revision: str = "c5e81d3f9a27"
+down_revision: Union[str, None] = "b83e5f1a7d62"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    engine = op.get_bind()
+    inspector = sa.inspect(engine)
+    columns = [column["name"] for column in inspector.get_columns("subscribe_run")]
+    if "object_ids" not in columns:
+        op.add_column(
+            "subscribe_run",
+            sa.Column("object_ids", ARRAY(sa.UnicodeText), nullable=True),
+        )
+
+
+def downgrade() -> None:
+    op.drop_column("subscribe_run", "object_ids")
@@ -0,0 +1,40 @@
+"""Add subscription.failed_attempts and .retry_after
+
+Revision ID: d9a4b62e7f15
+Revises: c5e81d3f9a27
+Create Date: 2026-10-18 17:12:30.904561
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "d9a4b62e7f15"
+down_revision: Union[str, None] = "c5e81d3f9a27"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    engine = op.get_bind()
+    inspector = sa.inspect(engine)
+    columns = [column["name"] for column in inspector.get_columns("subscription")]
+    if "failed_attempts" not in columns:
+        op.add_column(
+            "subscription",
+            sa.Column(
+                "failed_attempts", sa.Integer, nullable=False, server_default="0"
+            ),
+        )
+    if "retry_after" not in columns:
+        op.add_column(
+            "subscription", sa.Column("retry_after", sa.DateTime, nullable=True)
+        )
+
+
+def downgrade() -> None:
+    op.drop_column("subscription", "retry_after")
+    op.drop_column("subscription", "failed_attempts")
@@ -0,0 +1,32 @@
+"""Add an index on subscribe_login_code.expires
+
+Revision ID: e61b3f0d9c27
+Revises: a4f7c2e9b316
+Create Date: 2026-10-18 12:51:09.377016
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "e61b3f0d9c27"
+down_revision: Union[str, None] = "a4f7c2e9b316"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    engine = op.get_bind()
+    inspector = sa.inspect(engine)
+    indexes = {index["name"] for index in inspector.get_indexes("subscribe_login_code")}
+    if "subscribe_login_code_expires_idx" not in indexes:
+        op.create_index(
+            "subscribe_login_code_expires_idx", "subscribe_login_code", ["expires"]
+        )
+
+
+def downgrade() -> None:
+    op.drop_index("subscribe_login_code_expires_idx", table_name="subscribe_login_code")
@@ -7,10 +7,16 @@ from ckan.model.domain_object import DomainObject
 from ckan.model.meta import Session
 from ckan.model.types import make_uuid
 from ckan.plugins.toolkit import BaseModel
-from sqlalchemy import Column, types
+from sqlalchemy import Column, ForeignKey, Index, exists, func, literal, or_, types
+from sqlalchemy.dialects.postgresql import ARRAY
 
 log = logging.getLogger(__name__)
 
+# after a failed notification, a subscription waits this long before it is
+# retried, doubling with each failure in a row, up to RETRY_MAX
+RETRY_MIN = datetime.timedelta(minutes=1)
+RETRY_MAX = datetime.timedelta(hours=6)
+
 
 class _DomainObject(DomainObject):
     """Convenience methods for searching objects"""
@@ -70,6 +76,28 @@ class Subscription(_DomainObject, BaseModel):
     created = Column("created", types.DateTime, default=datetime.datetime.utcnow)
     # frequency is: immediate, daily, weekly
     frequency = Column("frequency", types.Integer)
+    # the end of the window of activity it was last notified of (or None if it
+    # hasn't been notified yet)
+    last_notified_at = Column("last_notified_at", types.DateTime)
+    # the notifications that failed in a row, and when they are next retried
+    failed_attempts = Column(
+        "failed_attempts", types.Integer, nullable=False, default=0, server_default="0"
+    )
+    retry_after = Column("retry_after", types.DateTime)
+
+    __table_args__ = (
+        # one subscription per email address and object
+        Index(
+            "subscription_email_object_idx",
+            "email",
+            "object_type",
+            "object_id",
+            unique=True,
+        ),
+        Index("subscription_frequency_verified_idx", "frequency", "verified"),
+        Index("subscription_frequency_notified_idx", "frequency", "last_notified_at"),
+        Index("subscription_verification_code_idx", "verification_code"),
+    )
 
     def __repr__(self):
         return (
@@ -78,6 +106,86 @@ class Subscription(_DomainObject, BaseModel):
             f"frequency={Frequency(self.frequency).name}>"
         )
 
+    @classmethod
+    def due_clause(cls, now):
+        """Returns SQL for whether a subscription is due to be notified at
+        `now` - i.e. it isn't waiting to retry after failed notifications"""
+        return or_(cls.retry_after.is_(None), cls.retry_after <= now)
+
+    @classmethod
+    def set_last_notified_at(cls, frequency, last_notified_at, run_id=None, only=None):
+        """Advances the watermark of all the subscriptions of this frequency
+        that are due, in one UPDATE.
+
+        :param run_id: skip the email addresses that this NotificationRun
+            failed to send to, so they are notified of the activity next time
+            - after a backoff, so an address that keeps failing isn't retried
+            on every run
+        :param only: SQL for which subscriptions to advance
+            (optional, default: all of them)
+        """
+        query = model.Session.query(cls).filter(
+            cls.frequency == frequency,
+            cls.verified.is_(True),
+            cls.due_clause(last_notified_at),
+            or_(
+                cls.last_notified_at.is_(None), cls.last_notified_at < last_notified_at
+            ),
+        )
+        if only is not None:
+            query = query.filter(only)
+        if run_id is not None:
+            failed = exists().where(
+                NotificationRunRecipient.run_id == run_id,
+                NotificationRunRecipient.email == cls.email,
+                NotificationRunRecipient.status == "failed",
+            )
+            query = query.filter(~failed)
+            include_activity_from = (
+                model.Session.query(NotificationRun.include_activity_from)
+                .filter(NotificationRun.id == run_id)
+                .scalar()
+            )
+            failed_query = model.Session.query(cls).filter(
+                cls.frequency == frequency,
+                cls.verified.is_(True),
+                cls.due_clause(last_notified_at),
+                failed,
+            )
+            if only is not None:
+                failed_query = failed_query.filter(only)
+            backoff = func.least(
+                RETRY_MIN.total_seconds() * func.power(2, cls.failed_attempts),
+                RETRY_MAX.total_seconds(),
+            )
+            failed_query.update(
+                {
+                    # a failed subscription that has no watermark yet would
+                    # otherwise fall back to emails_last_sent, which is about
+                    # to pass the activity it wasn't sent - so hold it at the
+                    # start of the run's window
+                    "last_notified_at": func.coalesce(
+                        cls.last_notified_at, include_activity_from
+                    ),
+                    "failed_attempts": cls.failed_attempts + 1,
+                    "retry_after": literal(last_notified_at, types.DateTime)
+                    + func.make_interval(
+                        0, 0, 0, 0, 0, 0, backoff, type_=types.Interval
+                    ),
+                },
+                synchronize_session=False,
+            )
+        query.update(
+            {
+                "last_notified_at": last_notified_at,
+                "failed_attempts": 0,
+                "retry_after": None,
+            },
+            synchronize_session=False,
+        )
+        # caller needs to do:
+        #   model.Session.commit()
+
 
 class Frequency(Enum):
     IMMEDIATE = 1
@@ -99,6 +207,12 @@ class LoginCode(_DomainObject, BaseModel):
     code = Column("code", types.UnicodeText, nullable=False)
     expires = Column("expires", types.DateTime)
 
+    __table_args__ = (
+        Index("subscribe_login_code_code_idx", "code"),
+        # for purging the expired codes
+        Index("subscribe_login_code_expires_idx", "expires"),
+    )
+
     def __repr__(self):
         return (
             f"<LoginCode id={self.id} email={self.email} "
@@ -151,3 +265,183 @@ class Subscribe(_DomainObject, BaseModel):
             )
         except AttributeError:
             return None
+
+
+class OutboxEmail(_DomainObject, BaseModel):
+    """An email waiting to be delivered, or that has been delivered.
+
+    Notification runs that use the outbox (ckanext.subscribe.outbox) save the
+    rendered emails here, and a separate `subscribe deliver` process sends
+    them (see ckanext.subscribe.outbox).
+    """
+
+    __tablename__ = "subscribe_outbox"
+
+    id = Column("id", types.UnicodeText, primary_key=True, default=make_uuid)
+    recipient_email = Column("recipient_email", types.UnicodeText, nullable=False)
+    mail_from = Column("mail_from", types.UnicodeText)
+    # the whole email, as sent to the SMTP server
+    message = Column("message", types.UnicodeText, nullable=False)
+    # status is: pending, sent, failed
+    status = Column("status", types.UnicodeText, nullable=False, default="pending")
+    attempts = Column("attempts", types.Integer, nullable=False, default=0)
+    next_attempt = Column(
+        "next_attempt", types.DateTime, nullable=False, default=datetime.datetime.utcnow
+    )
+    last_error = Column("last_error", types.UnicodeText)
+    created = Column(
+        "created", types.DateTime, nullable=False, default=datetime.datetime.utcnow
+    )
+    sent = Column("sent", types.DateTime)
+
+    __table_args__ = (Index("subscribe_outbox_status_idx", "status", "next_attempt"),)
+
+    def __repr__(self):
+        return (
+            f"<OutboxEmail id={self.id} recipient_email={self.recipient_email} "
+            f"status={self.status} attempts={self.attempts}>"
+        )
+
+
+class NotificationRun(_DomainObject, BaseModel):
+    """A run of notifications of one frequency, about the activity in its
+    window, and which email addresses it has done.
+
+    If a run doesn't finish, the next run of that frequency resumes it - with
+    the same window, skipping the email addresses already done - rather than
+    starting again.
+    """
+
+    __tablename__ = "subscribe_run"
+
+    id = Column("id", types.UnicodeText, primary_key=True, default=make_uuid)
+    frequency = Column("frequency", types.Integer, nullable=False)
+    # the window of activity notified: after include_activity_from, up to and
+    # including notification_datetime (which becomes emails_last_sent)
+    include_activity_from = Column(
+        "include_activity_from", types.DateTime, nullable=False
+    )
+    notification_datetime = Column(
+        "notification_datetime", types.DateTime, nullable=False
+    )
+    started = Column(
+        "started", types.DateTime, nullable=False, default=datetime.datetime.utcnow
+    )
+    finished = Column("finished", types.DateTime)
+    # the only objects whose activity it notifies, e.g. from
+    # ckanext.subscribe.events (None means all objects)
+    object_ids = Column("object_ids", ARRAY(types.UnicodeText))
+
+    __table_args__ = (Index("subscribe_run_frequency_idx", "frequency", "finished"),)
+
+    def __repr__(self):
+        return (
+            f"<NotificationRun id={self.id} "
+            f"frequency={Frequency(self.frequency).name} "
+            f"started={self.started} finished={self.finished}>"
+        )
+
+    @classmethod
+    def get_unfinished(cls, frequency):
+        return (
+            model.Session.query(cls)
+            .filter_by(frequency=frequency, finished=None)
+            .order_by(cls.started.desc())
+            .first()
+        )
+
+    def record_recipients(self, emails, failed=()):
+        """Records that the run has done these email addresses - they were
+        sent (or queued) their emails, or it failed to send them.
+
+        :param failed: the email addresses of `emails` that failed
+        """
+        now = datetime.datetime.utcnow()
+        rows = [
+            dict(
+                run_id=self.id,
+                email=email,
+                status="failed" if email in failed else "sent",
+                sent=now,
+            )
+            for email in emails
+        ]
+        if rows:
+            model.Session.execute(
+                NotificationRunRecipient.__table__.insert().values(rows)
+            )
+        # caller needs to do:
+        #   model.Session.commit()
+
+    def get_recipients(self):
+        """Returns the email addresses the run has done"""
+        return {
+            email
+            for email, in model.Session.query(NotificationRunRecipient.email).filter_by(
+                run_id=self.id
+            )
+        }
+
+    def record_shard_done(self, shard):
+        """Records that a shard's worker has done its share of the run (see
+        ckanext.subscribe.shards)"""
+        model.Session.add(
+            NotificationRunShard(
+                run_id=self.id, shard=shard, finished=datetime.datetime.utcnow()
+            )
+        )
+        # caller needs to do:
+        #   model.Session.commit()
+
+    def get_shards_done(self):
+        """Returns the shards whose share of the run is done"""
+        return {
+            shard
+            for shard, in model.Session.query(NotificationRunShard.shard).filter_by(
+                run_id=self.id
+            )
+        }
+
+
+class NotificationRunRecipient(_DomainObject, BaseModel):
+    """An email address that a NotificationRun has done"""
+
+    __tablename__ = "subscribe_run_recipient"
+
+    run_id = Column(
+        "run_id",
+        types.UnicodeText,
+        ForeignKey("subscribe_run.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    email = Column("email", types.UnicodeText, primary_key=True)
+    # status is: sent, failed
+    status = Column("status", types.UnicodeText, nullable=False)
+    sent = Column("sent", types.DateTime, nullable=False)
+
+    def __repr__(self):
+        return (
+            f"<NotificationRunRecipient run_id={self.run_id} email={self.email} "
+            f"status={self.status}>"
+        )
+
+
+class NotificationRunShard(_DomainObject, BaseModel):
+    """A shard whose share of a NotificationRun is done"""
+
+    __tablename__ = "subscribe_run_shard"
+
+    run_id = Column(
+        "run_id",
+        types.UnicodeText,
+        ForeignKey("subscribe_run.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    shard = Column("shard", types.Integer, primary_key=True)
+    finished = Column("finished", types.DateTime, nullable=False)
+
+    def __repr__(self):
+        return (
+            f"<NotificationRunShard run_id={self.run_id} shard={self.shard} "
+            f"finished={self.finished}>"
+        )
@@ -1,20 +1,58 @@
 import datetime
-from collections import defaultdict
+import itertools
+from collections import Counter, defaultdict
 
 import ckan.plugins.toolkit as toolkit
 from ckan import model
-from ckan import plugins as p
 from ckan.model import Group, Member, Package
+from sqlalchemy import cast, exists, func, or_, orm, select, union
+from sqlalchemy.dialects.postgresql import JSONB
 
 from ckanext.activity.email_notifications import string_to_timedelta
-from ckanext.activity.model import activity as model_activity
-from ckanext.subscribe import dictization, email_auth, notification_email
-from ckanext.subscribe.interfaces import ISubscribe
-from ckanext.subscribe.model import Frequency, Subscribe, Subscription
+from ckanext.activity.model import Activity
+from ckanext.subscribe import (
+    cache,
+    dictization,
+    email_auth,
+    locks,
+    mailer,
+    notification_email,
+    outbox,
+    pipeline,
+    shards,
+)
+from ckanext.subscribe.interfaces import has_custom_implementation
+from ckanext.subscribe.model import (
+    Frequency,
+    NotificationRun,
+    NotificationRunRecipient,
+    Subscribe,
+    Subscription,
+)
+from ckanext.subscribe.utils import ACTIVITY_YIELD_PER
 
 log = __import__("logging").getLogger(__name__)
 
 _config = {}
+# counters of the work done by notification runs in this process
+stats = Counter()
+
+# Valid activity_types all begin with one of: new, changed, deleted, or follow.
+# See ckanext.activity.logic.validators for the full list.
+NOTIFICATION_ACTIVITY_TYPES = ("new", "changed")
+DELETION_ACTIVITY_TYPES = ("deleted",)
+NOTIFIED_ACTIVITY_TYPES = NOTIFICATION_ACTIVITY_TYPES + DELETION_ACTIVITY_TYPES
+# the keys of activity.data for the object the activity is about
+ACTIVITY_DATA_OBJECT_TYPES = ("package", "group", "organization")
+# the number of email addresses whose notifications are worked out, and login
+# codes created, before they are sent
+SEND_BATCH_SIZE = 100
+# the time between notification runs of each frequency
+FREQUENCY_PERIODS = {
+    Frequency.IMMEDIATE.value: datetime.timedelta(0),
+    Frequency.DAILY.value: datetime.timedelta(days=1),
+    Frequency.WEEKLY.value: datetime.timedelta(days=7),
+}
 
 
 def get_config(key):
@@ -39,160 +77,392 @@ def get_config(key):
     return _config[key]
 
 
-def send_any_immediate_notifications():
+def send_any_immediate_notifications(shard=None):
     log.debug("send_any_immediate_notifications")
-    notification_datetime = datetime.datetime.now()
-    notifications_by_email, deletions_by_email = get_immediate_notifications(
-        notification_datetime
-    )
-    if not notifications_by_email and not deletions_by_email:
-        log.debug("no emails to send (immediate frequency)")
-    else:
-        log.debug(
-            f"sending {len(notifications_by_email)} notification emails (immediate frequency)"
-        )
-        log.debug(
-            f"sending {len(deletions_by_email)} deletion emails (immediate frequency)"
-        )
-        send_emails(notifications_by_email, deletions_by_email)
-
-    # record that notifications are 'all done' up to this time
-    Subscribe.set_emails_last_sent(
-        frequency=Frequency.IMMEDIATE.value, emails_last_sent=notification_datetime
-    )
-    model.Session.commit()
+    return send_notifications(Frequency.IMMEDIATE.value, shard=shard)
 
 
-def send_weekly_notifications_if_its_time_to():
+def send_weekly_notifications_if_its_time_to(shard=None):
     if not is_it_time_to_send_weekly_notifications():
         return
 
     log.debug("send_weekly_notifications")
-    notification_datetime = datetime.datetime.now()
-    notifications_by_email, deletions_by_email = get_weekly_notifications(
-        notification_datetime
-    )
-    if not notifications_by_email and not deletions_by_email:
-        log.debug("no emails to send (weekly frequency)")
-    else:
-        log.debug(
-            f"sending {len(notifications_by_email)} notification emails (weekly frequency)"
-        )
-        log.debug(
-            f"sending {len(deletions_by_email)} deletion emails (weekly frequency)"
-        )
-        send_emails(notifications_by_email, deletions_by_email)
-
-    # record that notifications are 'all done' up to this time
-    Subscribe.set_emails_last_sent(
-        frequency=Frequency.WEEKLY.value, emails_last_sent=notification_datetime
-    )
-    model.Session.commit()
+    return send_notifications(Frequency.WEEKLY.value, shard=shard)
 
 
-def send_daily_notifications_if_its_time_to():
+def send_daily_notifications_if_its_time_to(shard=None):
     if not is_it_time_to_send_daily_notifications():
         return
 
     log.debug("send_daily_notifications")
-    notification_datetime = datetime.datetime.now()
-    notifications_by_email, deletions_by_email = get_daily_notifications(
-        notification_datetime
+    return send_notifications(Frequency.DAILY.value, shard=shard)
+
+
+def send_notifications(subscription_frequency, object_ids=None, shard=None):
+    """Works out the notifications of this frequency and emails them, one
+    email address at a time, so that sending starts straight away and the
+    memory used doesn't grow with the number of subscribers.
+
+    :param object_ids: only notify the activity on these objects, when they
+        are known to be the only ones with new activity - e.g. from
+        ckanext.subscribe.events (optional, default: all objects)
+    :param shard: send only this shards.Shard's share of the run
+        (optional, default: ckanext.subscribe.shards and .shard)
+
+    The run is recorded as a NotificationRun, along with each email address
+    as it is done, so if it doesn't finish, the next run resumes it where it
+    left off, rather than emailing everyone again. A run limited to some
+    objects records them, so when it is resumed, or joined by another shard's
+    worker, it is still limited to them.
+
+    Each subscription is notified of the activity since its own watermark,
+    Subscription.last_notified_at, which the run advances when it finishes -
+    except for the email addresses it failed to send to, so they get the
+    activity next time.
+
+    Only one process at a time sends the notifications of each frequency, so
+    that several CKAN nodes can run this without emailing anyone twice: the
+    others find them locked, and leave them to it. With
+    ckanext.subscribe.shards, the run is shared between the shards' workers,
+    each sending its share of the email addresses (see
+    ckanext.subscribe.shards). They share the frequency's lock, so an
+    unsharded sender is kept out while they send, and vice versa, and each
+    also holds its shard's lock.
+
+    :returns: a summary of the emails that were delivered (or queued)
+    :rtype: ckanext.subscribe.mailer.DeliveryReport
+    """
+    frequency_name = Frequency(subscription_frequency).name.lower()
+    if shard is None:
+        shard = shards.get_shard()
+    lock = locks.AdvisoryLock(
+        f"notifications:{subscription_frequency}", shared=shard is not None
     )
-    if not notifications_by_email and not deletions_by_email:
-        log.debug("no emails to send (daily frequency)")
-    else:
+    shard_lock = (
+        locks.AdvisoryLock(f"notifications:{subscription_frequency}:{shard.index}")
+        if shard is not None
+        else None
+    )
+    if not lock.acquire() or (shard_lock is not None and not shard_lock.acquire()):
+        lock.release()
+        log.info(f"Another process is sending the {frequency_name} notifications")
+        return mailer.DeliveryReport()
+    try:
+        return _send_notifications(subscription_frequency, object_ids, shard)
+    finally:
+        if shard_lock is not None:
+            shard_lock.release()
+        lock.release()
+
+
+def _send_notifications(subscription_frequency, object_ids, shard):
+    frequency_name = Frequency(subscription_frequency).name.lower()
+    if shard is not None:
+        # the shards' workers start (or join) the run one at a time
+        locks.lock_transaction(f"notifications:{subscription_frequency}:run")
+    run = NotificationRun.get_unfinished(subscription_frequency)
+    if run and shard is not None and shard.index in run.get_shards_done():
         log.debug(
-            f"sending {len(notifications_by_email)} notification emails (daily frequency)"
+            f"Shard {shard.index} of {frequency_name} notification run {run.id} "
+            "is done - waiting for the other shards"
         )
-        log.debug(
-            f"sending {len(deletions_by_email)} deletion emails (daily frequency)"
+        model.Session.commit()
+        return mailer.DeliveryReport()
+    elif run:
+        log.info(f"Resuming {frequency_name} notification run {run.id}")
+        # the run's objects, rather than any this worker was told about
+        object_ids = None if run.object_ids is None else set(run.object_ids)
+        # (releasing the shards' lock)
+        model.Session.commit()
+    else:
+        notification_datetime = datetime.datetime.now()
+        include_activity_from = get_include_activity_from(
+            subscription_frequency, notification_datetime
         )
-        send_emails(notifications_by_email, deletions_by_email)
+        if not is_there_any_activity_since(
+            get_earliest_notified_from(
+                subscription_frequency,
+                include_activity_from,
+                get_catch_up_from(subscription_frequency, notification_datetime),
+                now=notification_datetime,
+            ),
+            subscription_frequency,
+        ):
+            log.debug(f"no emails to send ({frequency_name} frequency)")
+            if object_ids is None:
+                Subscribe.set_emails_last_sent(
+                    frequency=subscription_frequency,
+                    emails_last_sent=notification_datetime,
+                )
+            model.Session.commit()
+            return mailer.DeliveryReport()
+        run = NotificationRun(
+            frequency=subscription_frequency,
+            include_activity_from=include_activity_from,
+            notification_datetime=notification_datetime,
+            object_ids=None if object_ids is None else sorted(object_ids),
+        )
+        model.Session.add(run)
+        model.Session.commit()
 
-    # record that notifications are 'all done' up to this time
-    Subscribe.set_emails_last_sent(
-        frequency=Frequency.DAILY.value, emails_last_sent=notification_datetime
+    report = send_notification_emails(
+        iter_notifications_by_email(
+            run.include_activity_from,
+            subscription_frequency,
+            include_activity_to=run.notification_datetime,
+            catch_up_from=get_catch_up_from(
+                subscription_frequency, run.notification_datetime
+            ),
+            object_ids=object_ids,
+            run=run,
+            shard=shard,
+        ),
+        run=run,
     )
+    if not report.count:
+        log.debug(f"no emails to send ({frequency_name} frequency)")
+
+    if shard is not None:
+        # whichever shard is done last finishes the run
+        locks.lock_transaction(f"notifications:{subscription_frequency}:run")
+        run.record_shard_done(shard.index)
+        model.Session.flush()
+        if len(run.get_shards_done()) < shard.count:
+            model.Session.commit()
+            log.info(
+                f"Shard {shard.index} of {frequency_name} notification run "
+                f"{run.id} is done"
+            )
+            return report
+
+    if object_ids is None:
+        # record that notifications are 'all done' up to this time
+        Subscribe.set_emails_last_sent(
+            frequency=subscription_frequency,
+            emails_last_sent=run.notification_datetime,
+        )
+        Subscription.set_last_notified_at(
+            frequency=subscription_frequency,
+            last_notified_at=run.notification_datetime,
+            run_id=run.id,
+        )
+    else:
+        # only the subscriptions notified of all their activity are done
+        Subscription.set_last_notified_at(
+            frequency=subscription_frequency,
+            last_notified_at=run.notification_datetime,
+            run_id=run.id,
+            only=covered_by_objects_clause(subscription_frequency, object_ids),
+        )
+    run.finished = datetime.datetime.utcnow()
     model.Session.commit()
+    return report
 
 
-def get_immediate_notifications(notification_datetime=None):
+def get_immediate_notifications(notification_datetime=None, shard=None):
     """Work out what immediate notifications need sending out, based on
     activity, subscriptions and past notifications.
+
+    :param shard: only the subscriptions of the email addresses in this
+        shards.Shard (optional, default: all subscriptions)
     """
     # just interested in activity which is recent and has a subscriber
-    subscription_frequency = Frequency.IMMEDIATE.value
+    return collect_notifications(
+        iter_notifications(
+            Frequency.IMMEDIATE.value, notification_datetime, shard=shard
+        )
+    )
 
-    # {object_id: [subscriptions]}
-    objects_subscribed_to = get_objects_subscribed_to(subscription_frequency)
-    if not objects_subscribed_to:
-        return {}, {}
 
-    emails_last_sent = Subscribe.get_emails_last_sent(
-        frequency=Frequency.IMMEDIATE.value
-    )
-    now = notification_datetime or datetime.datetime.now()
-    catch_up_period = get_config("email_notifications_since")
+def get_include_activity_from(subscription_frequency, now):
+    """Returns the time from which activity is notified, for a notification
+    run of this frequency at time `now`, to the subscriptions that haven't
+    been notified yet (i.e. without a last_notified_at).
+    """
+    emails_last_sent = Subscribe.get_emails_last_sent(frequency=subscription_frequency)
     if emails_last_sent:
-        include_activity_from = max(emails_last_sent, (now - catch_up_period))
+        return max(emails_last_sent, get_catch_up_from(subscription_frequency, now))
+    elif subscription_frequency == Frequency.IMMEDIATE.value:
+        return now - get_config("email_notifications_since")
     else:
-        include_activity_from = now - catch_up_period
+        return now - FREQUENCY_PERIODS[subscription_frequency]
+
 
-    activities = get_subscribed_to_activities(
-        include_activity_from, list(objects_subscribed_to.keys())
+def get_catch_up_from(subscription_frequency, now):
+    """Returns the time before which activity is never notified, however long
+    ago a subscription was last notified, for a notification run of this
+    frequency at time `now`.
+    """
+    return (
+        now
+        - FREQUENCY_PERIODS[subscription_frequency]
+        - get_config("email_notifications_since")
     )
-    if not activities:
-        return {}, {}
-    return get_notifications_by_email(
-        activities, objects_subscribed_to, subscription_frequency
-    ), get_notifications_by_email(
-        activities, objects_subscribed_to, subscription_frequency, ["deleted"]
+
+
+def notified_from_clause(include_activity_from, catch_up_from=None):
+    """Returns SQL for the time after which activity is notified to each
+    subscription: its last_notified_at, or if it hasn't been notified yet,
+    include_activity_from - but no earlier than catch_up_from.
+    """
+    notified_from = func.coalesce(Subscription.last_notified_at, include_activity_from)
+    if catch_up_from is not None:
+        notified_from = func.greatest(notified_from, catch_up_from)
+    return notified_from
+
+
+def get_earliest_notified_from(
+    subscription_frequency,
+    include_activity_from,
+    catch_up_from=None,
+    session=None,
+    now=None,
+):
+    """Returns the time after which there may be activity to notify to any
+    subscription of this frequency, so only the activity since then needs
+    scanning.
+
+    :param now: the subscriptions waiting to retry after failed notifications
+        until after this time are left out (optional, default: the time now)
+    """
+    session = session or model.Session
+    earliest = (
+        session.query(
+            func.min(notified_from_clause(include_activity_from, catch_up_from))
+        )
+        .filter(Subscription.verified.is_(True))
+        .filter(Subscription.frequency == subscription_frequency)
+        .filter(Subscription.due_clause(now or datetime.datetime.now()))
+        .scalar()
     )
+    return earliest or include_activity_from
 
 
 def get_objects_subscribed_to(subscription_frequency):
     """Returns the objects we're listening for activity to, and the
     subscriptions they are related to
 
+    The subscriptions are lightweight rows with the columns of the
+    subscription table, rather than ORM objects.
+
     :returns: {object_id: [subscriptions]}
     """
+    subscriptions = _get_subscriptions(subscription_frequency)
     objects_subscribed_to = defaultdict(list)  # {object_id: [subscriptions]}
-    # direct subscriptions - i.e. datasets, orgs & groups
-    for subscription in (
-        model.Session.query(Subscription)
-        .filter(Subscription.verified.is_(True))
-        .filter(Subscription.frequency == subscription_frequency)
-        .all()
+    for object_id, subscription_id in model.Session.execute(
+        subscribed_objects_query(subscription_frequency)
     ):
-        objects_subscribed_to[subscription.object_id].append(subscription)
-    # also include the datasets attached to the subscribed orgs
-    for subscription, package_id in (
-        model.Session.query(Subscription, Package.id)
+        objects_subscribed_to[object_id].append(subscriptions[subscription_id])
+    return dict(objects_subscribed_to)
+
+
+def _only_subscriptions(objects_subscribed_to, keep):
+    """Returns the objects_subscribed_to, with only the subscriptions for which
+    keep(subscription) is true"""
+    only = {
+        object_id: [
+            subscription for subscription in subscriptions if keep(subscription)
+        ]
+        for object_id, subscriptions in objects_subscribed_to.items()
+    }
+    return {
+        object_id: subscriptions
+        for object_id, subscriptions in only.items()
+        if subscriptions
+    }
+
+
+def _covered_by_objects(objects_subscribed_to, object_ids):
+    """Returns the objects_subscribed_to, with only the subscriptions that get
+    activity from no objects but `object_ids` (see
+    covered_by_objects_clause())"""
+    not_covered = {
+        subscription.id
+        for object_id, subscriptions in objects_subscribed_to.items()
+        if object_id not in object_ids
+        for subscription in subscriptions
+    }
+    return _only_subscriptions(
+        objects_subscribed_to, lambda subscription: subscription.id not in not_covered
+    )
+
+
+def _get_subscriptions(subscription_frequency):
+    """Returns the verified subscriptions of this frequency, as lightweight
+    rows of the subscription table.
+
+    :returns: {subscription_id: subscription}
+    """
+    return {
+        subscription.id: subscription
+        for subscription in model.Session.query(*Subscription.__table__.columns)
         .filter(Subscription.verified.is_(True))
         .filter(Subscription.frequency == subscription_frequency)
+    }
+
+
+def subscribed_objects_query(subscription_frequency):
+    """Returns a query for the (object_id, subscription_id) pairs of the
+    objects we're listening for activity to, in a single UNION.
+    """
+    verified_subscriptions = (
+        Subscription.verified.is_(True),
+        Subscription.frequency == subscription_frequency,
+    )
+    # direct subscriptions - i.e. datasets, orgs & groups
+    direct = select(
+        Subscription.object_id.label("object_id"),
+        Subscription.id.label("subscription_id"),
+    ).where(*verified_subscriptions)
+    # also include the datasets attached to the subscribed orgs
+    org_datasets = (
+        select(Package.id, Subscription.id)
+        .select_from(Subscription)
         .join(Group, Group.id == Subscription.object_id)
-        .filter(Group.state == "active")
-        .filter(Group.is_organization.is_(True))
         .join(Package, Package.owner_org == Group.id)
-        .all()
-    ):
-        objects_subscribed_to[package_id].append(subscription)
-    # also include the datasets attached to the subscribed orgs
-    for subscription, package_id in (
-        model.Session.query(Subscription, Package.id)
-        .filter(Subscription.verified.is_(True))
-        .filter(Subscription.frequency == subscription_frequency)
+        .where(*verified_subscriptions)
+        .where(Group.state == "active")
+        .where(Group.is_organization.is_(True))
+    )
+    # also include the datasets attached to the subscribed groups
+    group_datasets = (
+        select(Package.id, Subscription.id)
+        .select_from(Subscription)
         .join(Group, Group.id == Subscription.object_id)
-        .filter(Group.state == "active")
-        .filter(Group.is_organization.is_(False))
         .join(Member, Member.group_id == Group.id)
-        .filter(Member.state == "active")
         .join(Package, Package.id == Member.table_id)
-        .all()
-    ):
-        objects_subscribed_to[package_id].append(subscription)
-    return objects_subscribed_to
+        .where(*verified_subscriptions)
+        .where(Group.state == "active")
+        .where(Group.is_organization.is_(False))
+        .where(Member.state == "active")
+    )
+    return union(direct, org_datasets, group_datasets)
+
+
+def covered_by_objects_clause(subscription_frequency, object_ids):
+    """Returns SQL for whether all the objects a subscription gets activity
+    from are among `object_ids` - i.e. whether a run limited to these objects
+    notifies it of all its activity, so its watermark can be advanced. (A
+    subscription to an org or group also gets the activity of its datasets.)
+    """
+    subscribed_objects = subscribed_objects_query(subscription_frequency).subquery()
+    return ~exists().where(
+        subscribed_objects.c.subscription_id == Subscription.id,
+        subscribed_objects.c.object_id.notin_(list(object_ids)),
+    )
+
+
+def any_subscriptions_to_groups(subscription_frequency):
+    """Returns whether there are any subscriptions of this frequency to orgs
+    or groups - which runs limited to some objects leave out (see
+    covered_by_objects_clause())"""
+    return model.Session.query(
+        exists().where(
+            Subscription.verified.is_(True),
+            Subscription.frequency == subscription_frequency,
+            Subscription.object_type.in_(["organization", "group"]),
+        )
+    ).scalar()
 
 
 def is_it_time_to_send_weekly_notifications():
@@ -236,110 +506,436 @@ def most_recent_daily_notification_datetime(now=None):
         return todays_notification_time
 
 
-def get_weekly_notifications(notification_datetime=None):
+def get_weekly_notifications(notification_datetime=None, shard=None):
     """Work out what weekly notifications need sending out, based on activity,
     subscriptions and past notifications.
+
+    :param shard: only the subscriptions of the email addresses in this
+        shards.Shard (optional, default: all subscriptions)
     """
     # interested in activity which is this week and has a subscriber
-    subscription_frequency = Frequency.WEEKLY.value
-
-    # {object_id: [subsciptions]}
-    objects_subscribed_to = get_objects_subscribed_to(subscription_frequency)
-    if not objects_subscribed_to:
-        return {}, {}
-
-    emails_last_sent = Subscribe.get_emails_last_sent(frequency=Frequency.WEEKLY.value)
-    now = notification_datetime or datetime.datetime.now()
-    catch_up_period = get_config("email_notifications_since")
-    week = datetime.timedelta(days=7)
-    if emails_last_sent:
-        include_activity_from = max(emails_last_sent, (now - week - catch_up_period))
-    else:
-        include_activity_from = now - week
-
-    activities = get_subscribed_to_activities(
-        include_activity_from, list(objects_subscribed_to.keys())
-    )
-    if not activities:
-        return {}, {}
-    return get_notifications_by_email(
-        activities, objects_subscribed_to, subscription_frequency
-    ), get_notifications_by_email(
-        activities, objects_subscribed_to, subscription_frequency, ["deleted"]
+    return collect_notifications(
+        iter_notifications(Frequency.WEEKLY.value, notification_datetime, shard=shard)
     )
 
 
-def get_daily_notifications(notification_datetime=None):
+def get_daily_notifications(notification_datetime=None, shard=None):
     """Work out what daily notifications need sending out, based on activity,
     subscriptions and past notifications.
+
+    :param shard: only the subscriptions of the email addresses in this
+        shards.Shard (optional, default: all subscriptions)
     """
     # interested in activity which is this week and has a subscriber
-    subscription_frequency = Frequency.DAILY.value
+    return collect_notifications(
+        iter_notifications(Frequency.DAILY.value, notification_datetime, shard=shard)
+    )
 
-    # {object_id: [subscriptions]}
-    objects_subscribed_to = get_objects_subscribed_to(subscription_frequency)
-    if not objects_subscribed_to:
-        return {}, {}
 
-    emails_last_sent = Subscribe.get_emails_last_sent(frequency=Frequency.DAILY.value)
+def is_there_any_activity_since(include_activity_from, subscription_frequency):
+    """Cheaply checks if there is any activity at all in the time window,
+    before the expensive work of matching it to subscriptions. Most
+    immediate-frequency runs find none, so they can stop here.
+
+    Counts the runs, and those stopped here, in `stats` - e.g. for immediate
+    frequency: stats["immediate_runs"] and
+    stats["immediate_runs_without_activity"]
+    """
+    frequency_name = Frequency(subscription_frequency).name.lower()
+    stats[f"{frequency_name}_runs"] += 1
+    any_activity = model.Session.query(
+        exists().where(Activity.timestamp > include_activity_from)
+    ).scalar()
+    if not any_activity:
+        stats[f"{frequency_name}_runs_without_activity"] += 1
+        log.debug(f"no activity since {include_activity_from} ({frequency_name})")
+    return any_activity
+
+
+def iter_notifications(subscription_frequency, notification_datetime=None, shard=None):
+    """Works out the notifications of this frequency that need sending out,
+    based on activity, subscriptions and past notifications, one email address
+    at a time.
+
+    :param shard: only the email addresses in this shards.Shard
+        (optional, default: all email addresses)
+
+    :returns: iterable of (email, [notification], [deletion notification]),
+        ordered by email
+    """
     now = notification_datetime or datetime.datetime.now()
-    catch_up_period = get_config("email_notifications_since")
-    day = datetime.timedelta(days=1)
-    if emails_last_sent:
-        include_activity_from = max(emails_last_sent, (now - day - catch_up_period))
-    else:
-        include_activity_from = now - day
-    activities = get_subscribed_to_activities(
-        include_activity_from, list(objects_subscribed_to.keys())
-    )
-    if not activities:
-        return {}, {}
-    return get_notifications_by_email(
-        activities, objects_subscribed_to, subscription_frequency
-    ), get_notifications_by_email(
-        activities, objects_subscribed_to, subscription_frequency, ["deleted"]
+    include_activity_from = get_include_activity_from(subscription_frequency, now)
+    catch_up_from = get_catch_up_from(subscription_frequency, now)
+    if not is_there_any_activity_since(
+        get_earliest_notified_from(
+            subscription_frequency, include_activity_from, catch_up_from, now=now
+        ),
+        subscription_frequency,
+    ):
+        return iter(())
+    return iter_notifications_by_email(
+        include_activity_from,
+        subscription_frequency,
+        catch_up_from=catch_up_from,
+        shard=shard,
     )
 
 
+def iter_notifications_by_email(
+    include_activity_from,
+    subscription_frequency,
+    include_activity_to=None,
+    catch_up_from=None,
+    object_ids=None,
+    run=None,
+    shard=None,
+):
+    """Matches the activity since each subscription was last notified (or
+    since `include_activity_from`, for those not notified yet) with the
+    subscriptions of this frequency, and yields the notifications for one email
+    address at a time.
+
+    This is done with a query ordered by email, whose results are streamed, so
+    only one email address's notifications are held in memory at a time.
+    Unless a plugin customises the activities with ISubscribe.get_activities(),
+    in which case the matching is done in Python, for all the email addresses
+    at once.
+
+    :param include_activity_to: the end of the window of activity
+        (optional, default: no end)
+    :param catch_up_from: the time before which activity is not notified,
+        however long ago a subscription was last notified (optional)
+    :param object_ids: only the activity on these objects, to the
+        subscriptions that get activity from no other objects
+        (optional, default: all objects)
+    :param run: a NotificationRun, whose email addresses already done are
+        skipped (optional)
+    :param shard: only the email addresses in this shards.Shard
+        (optional, default: all email addresses)
+
+    :returns: iterable of (email, [notification], [deletion notification]),
+        ordered by email
+    """
+    if has_custom_implementation("get_activities"):
+        # {object_id: [subscriptions]}
+        now = include_activity_to or datetime.datetime.now()
+        objects_subscribed_to = _only_subscriptions(
+            get_objects_subscribed_to(subscription_frequency),
+            lambda subscription: subscription.retry_after is None
+            or subscription.retry_after <= now,
+        )
+        if object_ids is not None:
+            objects_subscribed_to = _covered_by_objects(
+                objects_subscribed_to, object_ids
+            )
+        if not objects_subscribed_to:
+            return
+        activities = get_subscribed_to_activities(
+            get_earliest_notified_from(
+                subscription_frequency, include_activity_from, catch_up_from, now=now
+            ),
+            list(objects_subscribed_to.keys()),
+        )
+        if include_activity_to is not None:
+            activities = [
+                activity
+                for activity in activities
+                if activity.timestamp <= include_activity_to
+            ]
+        if object_ids is not None:
+            activities = [
+                activity for activity in activities if activity.object_id in object_ids
+            ]
+        notifications_by_email, deletions_by_email = get_notifications_by_email(
+            match_activities_to_subscriptions(
+                activities,
+                objects_subscribed_to,
+                notified_from=_get_notified_from(
+                    subscription_frequency, include_activity_from, catch_up_from
+                ),
+            )
+        )
+        done = run.get_recipients() if run else set()
+        for email in sorted(
+            (set(notifications_by_email) | set(deletions_by_email)) - done
+        ):
+            if not shards.in_shard(email, shard):
+                continue
+            yield (
+                email,
+                notifications_by_email.get(email, []),
+                deletions_by_email.get(email, []),
+            )
+        return
+
+    # The results are streamed with a server-side cursor, which a commit would
+    # close, so query with a session of its own, as sending the emails commits
+    # the login codes.
+    session = orm.Session(bind=model.Session.get_bind())
+    try:
+        subscription_activities = query_subscription_activities(
+            include_activity_from,
+            subscription_frequency,
+            session=session,
+            include_activity_to=include_activity_to,
+            catch_up_from=catch_up_from,
+            object_ids=object_ids,
+            exclude_run_id=run.id if run else None,
+            shard=shard,
+        )
+        for email, email_subscription_activities in itertools.groupby(
+            subscription_activities, key=lambda pair: pair[0].email
+        ):
+            notifications, deletions = _split_deletions(email_subscription_activities)
+            yield (
+                email,
+                dictize_notifications(notifications),
+                dictize_notifications(deletions),
+            )
+    finally:
+        session.close()
+
+
+def collect_notifications(notifications):
+    """Gathers up the notifications yielded by iter_notifications() into dicts
+
+    :returns: ({email: [notification]}, {email: [deletion notification]})
+    """
+    notifications_by_email = {}
+    deletions_by_email = {}
+    for email, email_notifications, email_deletions in notifications:
+        if email_notifications:
+            notifications_by_email[email] = email_notifications
+        if email_deletions:
+            deletions_by_email[email] = email_deletions
+    return notifications_by_email, deletions_by_email
+
+
 def get_subscribed_to_activities(include_activity_from, objects_subscribed_to_keys):
     activities = []
-    for subscribe_interface_implementation in p.PluginImplementations(ISubscribe):
-        activities = subscribe_interface_implementation.get_activities(
-            include_activity_from, objects_subscribed_to_keys
-        )
+    for get_activities in pipeline.hooks("get_activities"):
+        activities = get_activities(include_activity_from, objects_subscribed_to_keys)
     return activities
 
 
-def get_notifications_by_email(
-    activities, objects_subscribed_to, subscription_frequency, activity_types=None
+def match_activities_to_subscriptions(
+    activities, objects_subscribed_to, notified_from=None
 ):
-    # group by email address
-    # so we can send each email address one email with all their notifications
-    # and also have access to the subscription object with the object_type etc
-    # (done in a loop rather than sql merely because of ease/clarity)
-    # email: {subscription: [activity, ...], ...}
-    notifications = defaultdict(lambda: defaultdict(list))
+    """Pairs up activities with the subscriptions they are notified to
 
-    if not activity_types:
-        # Valid activity_types all begin with one of: new, changed, deleted, or follow.
-        # See ckanext.activity.logic.validators for the full list.
-        activity_types = ["new", "changed"]
+    :param notified_from: {subscription_id: time} after which activity is
+        notified to each subscription (optional, default: all the activities)
 
+    :returns: iterable of (subscription, activity)
+    """
     for activity in activities:
-        for subscription in objects_subscribed_to[activity.object_id]:
+        for subscription in objects_subscribed_to.get(activity.object_id, []):
             # ignore activity that occurs before this subscription was created
             if subscription.created > activity.timestamp:
                 continue
-            if activity.activity_type.split()[0] in activity_types:
-                notifications[subscription.email][subscription].append(activity)
+            # or that the subscription has already been notified of
+            if (
+                notified_from is not None
+                and notified_from.get(subscription.id, activity.timestamp)
+                >= activity.timestamp
+            ):
+                continue
+            if _activity_type_prefix(activity) in NOTIFIED_ACTIVITY_TYPES:
+                yield subscription, activity
 
-    # dictize
-    notifications_by_email_dictized = defaultdict(list)
-    for email, subscription_activities in list(notifications.items()):
-        notifications_by_email_dictized[email] = dictize_notifications(
-            subscription_activities
+
+def _get_notified_from(subscription_frequency, include_activity_from, catch_up_from):
+    """Returns the time after which activity is notified to each subscription
+    of this frequency. (Unlike the subscriptions themselves, these change with
+    every run, so aren't cached.)
+
+    :returns: {subscription_id: time}
+    """
+    return dict(
+        model.Session.query(
+            Subscription.id, notified_from_clause(include_activity_from, catch_up_from)
         )
-    return notifications_by_email_dictized
+        .filter(Subscription.verified.is_(True))
+        .filter(Subscription.frequency == subscription_frequency)
+    )
+
+
+def query_subscription_activities(
+    include_activity_from,
+    subscription_frequency,
+    session=None,
+    include_activity_to=None,
+    catch_up_from=None,
+    object_ids=None,
+    exclude_run_id=None,
+    shard=None,
+):
+    """Pairs up activities with the subscriptions they are notified to, with a
+    query joining the activity to the subscriptions, rather than in Python.
+
+    The activities are lightweight rows, with only the fields of activity.data
+    that notifications use.
+
+    :param session: the session to query the activity with
+        (optional, default: model.Session)
+    :param include_activity_to: the end of the window of activity
+        (optional, default: no end)
+    :param catch_up_from: the time before which activity is not notified,
+        however long ago a subscription was last notified (optional)
+    :param object_ids: only the activity on these objects, to the
+        subscriptions that get activity from no other objects
+        (optional, default: all objects)
+    :param exclude_run_id: skip the email addresses this NotificationRun has
+        already done (optional)
+    :param shard: only the email addresses in this shards.Shard
+        (optional, default: all email addresses)
+
+    :returns: iterable of (subscription, activity), ordered by email
+    """
+    subscriptions = _get_subscriptions(subscription_frequency)
+    if not subscriptions:
+        return
+    now = include_activity_to or datetime.datetime.now()
+    subscribed_objects = subscribed_objects_query(subscription_frequency).subquery()
+    session = session or model.Session
+    query = (
+        session.query(
+            Activity.id,
+            Activity.timestamp,
+            Activity.user_id,
+            Activity.object_id,
+            Activity.activity_type,
+            slim_activity_data().label("data"),
+            subscribed_objects.c.subscription_id,
+        )
+        .join(subscribed_objects, subscribed_objects.c.object_id == Activity.object_id)
+        .join(Subscription, Subscription.id == subscribed_objects.c.subscription_id)
+        # scan only the activity since the earliest of the subscriptions'
+        # watermarks, and notify each one of the activity since its own
+        .filter(
+            Activity.timestamp
+            > get_earliest_notified_from(
+                subscription_frequency,
+                include_activity_from,
+                catch_up_from,
+                session=session,
+                now=now,
+            )
+        )
+        .filter(
+            Activity.timestamp
+            > notified_from_clause(include_activity_from, catch_up_from)
+        )
+        # leave out the subscriptions waiting to retry after failures
+        .filter(Subscription.due_clause(now))
+        # ignore activity that occurs before this subscription was created
+        .filter(Subscription.created <= Activity.timestamp)
+        .filter(
+            or_(
+                *(
+                    or_(
+                        Activity.activity_type == activity_type,
+                        Activity.activity_type.like(f"{activity_type} %"),
+                    )
+                    for activity_type in NOTIFIED_ACTIVITY_TYPES
+                )
+            )
+        )
+    )
+    if include_activity_to is not None:
+        query = query.filter(Activity.timestamp <= include_activity_to)
+    if object_ids is not None:
+        query = query.filter(Activity.object_id.in_(list(object_ids))).filter(
+            covered_by_objects_clause(subscription_frequency, object_ids)
+        )
+    if exclude_run_id is not None:
+        query = query.filter(
+            ~exists().where(
+                NotificationRunRecipient.run_id == exclude_run_id,
+                NotificationRunRecipient.email == Subscription.email,
+            )
+        )
+    if shard is not None:
+        query = query.filter(shards.shard_clause(Subscription.email, shard))
+    query = query.order_by(Subscription.email, Activity.timestamp).yield_per(
+        ACTIVITY_YIELD_PER
+    )
+    for activity in query:
+        yield subscriptions[activity.subscription_id], activity
+
+
+def slim_activity_data():
+    """Returns SQL for activity.data with just the fields that notifications
+    use (see dictization.dictize_activity()), so the rest of the package,
+    group or org doesn't have to be fetched and parsed.
+    """
+    data = cast(Activity.data, JSONB)
+    return func.jsonb_strip_nulls(
+        func.jsonb_build_object(
+            *itertools.chain.from_iterable(
+                (
+                    key,
+                    func.jsonb_build_object(
+                        *itertools.chain.from_iterable(
+                            (field, data[key][field])
+                            for field in dictization.ACTIVITY_DATA_FIELDS
+                        )
+                    ),
+                )
+                for key in ACTIVITY_DATA_OBJECT_TYPES
+            )
+        ),
+        type_=JSONB,
+    )
+
+
+def get_notifications_by_email(subscription_activities):
+    """Groups the activities by email address, so we can send each email
+    address one email with all their notifications (or one email per deletion),
+    and also have access to the subscription object with the object_type etc.
+
+    :param subscription_activities: iterable of (subscription, activity)
+
+    :returns: ({email: [notification]}, {email: [deletion notification]})
+    """
+    # email: {subscription: [activity, ...], ...}
+    notifications = defaultdict(lambda: defaultdict(list))
+    deletions = defaultdict(lambda: defaultdict(list))
+    for subscription, activity in subscription_activities:
+        if _activity_type_prefix(activity) in DELETION_ACTIVITY_TYPES:
+            deletions[subscription.email][subscription].append(activity)
+        else:
+            notifications[subscription.email][subscription].append(activity)
+
+    # dictize
+    return tuple(
+        {
+            email: dictize_notifications(subscription_activities)
+            for email, subscription_activities in by_email.items()
+        }
+        for by_email in (notifications, deletions)
+    )
+
+
+def _split_deletions(subscription_activities):
+    """Separates the deletion activities from the others
+
+    :param subscription_activities: iterable of (subscription, activity)
+
+    :returns: ({subscription: [activity, ...]}, {subscription: [deletion, ...]})
+    """
+    notifications = defaultdict(list)
+    deletions = defaultdict(list)
+    for subscription, activity in subscription_activities:
+        if _activity_type_prefix(activity) in DELETION_ACTIVITY_TYPES:
+            deletions[subscription].append(activity)
+        else:
+            notifications[subscription].append(activity)
+    return notifications, deletions
+
+
+def _activity_type_prefix(activity):
+    return activity.activity_type.split()[0]
 
 
 def dictize_notifications(subscription_activities):
@@ -353,7 +949,9 @@ def dictize_notifications(subscription_activities):
     notifications_dictized = []
     for subscription, activities in list(subscription_activities.items()):
         subscription_dict = dictization.dictize_subscription(subscription, context)
-        activity_dicts = model_activity.activity_list_dictize(activities, context)
+        activity_dicts = [
+            dictization.dictize_activity(activity) for activity in activities
+        ]
         notifications_dictized.append(
             {
                 "subscription": subscription_dict,
@@ -364,14 +962,92 @@ def dictize_notifications(subscription_activities):
 
 
 def send_emails(notifications_by_email, deletions_by_email):
-    for email, notifications in list(notifications_by_email.items()):
-        code = email_auth.create_code(email)
-        notification_email.send_notification_email(
-            code, email, notifications, "notification"
+    """Emails the notifications to their subscribers.
+
+    :returns: a summary of the emails that were delivered
+    :rtype: ckanext.subscribe.mailer.DeliveryReport
+    """
+    report = send_notification_emails(
+        (
+            email,
+            notifications_by_email.get(email, []),
+            deletions_by_email.get(email, []),
         )
-    for email, notifications in deletions_by_email.items():
-        for notification in notifications:
-            code = email_auth.create_code(email)
-            notification_email.send_notification_email(
-                code, email, [notification], "deletion"
-            )
+        for email in sorted(set(notifications_by_email) | set(deletions_by_email))
+    )
+    # commit the login codes and any emails queued in the outbox
+    model.Session.commit()
+    return report
+
+
+def send_notification_emails(notifications, run=None):
+    """Emails the notifications to their subscribers, as they are yielded.
+
+    :param notifications: iterable of
+        (email, [notification], [deletion notification])
+    :param run: the NotificationRun to record each batch of email addresses
+        in, once their emails are sent (optional)
+
+    With the outbox enabled, the emails are queued in it, and the caller must
+    commit them, along with the login codes. With a run, they are committed
+    with each batch's email addresses instead, so each address is queued
+    exactly once.
+
+    :returns: a summary of the emails that were delivered (or queued)
+    :rtype: ckanext.subscribe.mailer.DeliveryReport
+    """
+    notifications = iter(notifications)
+    queue = outbox.is_enabled()
+    # the ISubscribe hooks are looked up once, each distinct email is only
+    # rendered once, each object and link in it is only fetched or built once,
+    # and SMTP delivery happens in a pool of workers, each reusing its
+    # connection - or the emails are queued for a separate process to deliver
+    delivery = outbox.OutboxWriter() if queue else mailer.get_delivery_pool()
+    failed_so_far = 0
+    with pipeline.hook_pipeline(), cache.object_cache(), cache.url_cache():
+        with notification_email.render_cache(), delivery:
+            while True:
+                batch = list(itertools.islice(notifications, SEND_BATCH_SIZE))
+                if not batch:
+                    break
+                # mint the login codes for the batch in one go
+                codes = email_auth.create_codes(
+                    (email for email, _, _ in batch), commit=not queue
+                )
+                cache.prefetch(
+                    (
+                        notification["subscription"]["object_type"],
+                        notification["subscription"]["object_id"],
+                    )
+                    for _, email_notifications, deletions in batch
+                    for notification in email_notifications + deletions
+                )
+                for email, email_notifications, deletions in batch:
+                    try:
+                        if email_notifications:
+                            notification_email.send_notification_email(
+                                codes[email],
+                                email,
+                                email_notifications,
+                                "notification",
+                            )
+                        for deletion in deletions:
+                            notification_email.send_notification_email(
+                                codes[email], email, [deletion], "deletion"
+                            )
+                    except Exception:
+                        # e.g. an error rendering this address's email - record
+                        # it as failed, rather than stopping the run, which
+                        # would then stop at it again every time it's resumed
+                        log.exception(f"Could not send the notifications to {email}")
+                        delivery.report.record_failure(email)
+                if run is not None:
+                    # checkpoint the run, once the batch is sent
+                    delivery.wait()
+                    failed = set(delivery.report.failed[failed_so_far:])
+                    failed_so_far = len(delivery.report.failed)
+                    run.record_recipients([email for email, _, _ in batch], failed)
+                    model.Session.commit()
+    if delivery.report.count:
+        log.info(f"Notification run: {delivery.report}")
+    return delivery.report
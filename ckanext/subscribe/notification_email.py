@@ -1,19 +1,56 @@
+import contextlib
+import threading
+from collections import OrderedDict
+
 import dominate.tags as tags
-from ckan import model
 from ckan import plugins as p
 
-from ckanext.subscribe import mailer
-from ckanext.subscribe.interfaces import ISubscribe
+from ckanext.subscribe import cache, mailer, pipeline
+from ckanext.subscribe.interfaces import has_custom_implementation
 
+log = __import__("logging").getLogger(__name__)
 config = p.toolkit.config
 
+# the number of distinct notification emails kept by a render_cache()
+RENDER_CACHE_SIZE = 1000
+# stand-ins for the recipient's details when rendering an email for the cache.
+# They are letters only, so they survive being escaped or put in a URL.
+PLACEHOLDER_CODE = "SubscribeRenderCacheCodePlaceholder"
+PLACEHOLDER_EMAIL = "SubscribeRenderCacheEmailPlaceholder"
+
+# the render_cache() of the current notification run, if any
+_local = threading.local()
+
 
 def send_notification_email(code, email, notifications, email_type="notification"):
+    cache = getattr(_local, "render_cache", None)
+    if cache is None:
+        subject, plain_text_body, html_body = render_notification_email(
+            code, email, notifications, email_type
+        )
+    else:
+        subject, plain_text_body, html_body = cache.render(
+            code, email, notifications, email_type
+        )
+
+    mailer.mail_recipient(
+        recipient_name=email,
+        recipient_email=email,
+        subject=subject,
+        body=plain_text_body,
+        body_html=html_body,
+        headers={},
+    )
+
+
+def render_notification_email(code, email, notifications, email_type="notification"):
+    """Returns the subject, plain-text body and html body of a notification
+    email"""
     email_vars = get_notification_email_vars(code, email, notifications)
 
     plain_text_footer = html_footer = ""
-    for subscribe in p.PluginImplementations(ISubscribe):
-        plain_text_footer, html_footer = subscribe.get_footer_contents(
+    for get_footer_contents in pipeline.hooks("get_footer_contents"):
+        plain_text_footer, html_footer = get_footer_contents(
             email_vars, plain_text_footer=plain_text_footer, html_footer=html_footer
         )
 
@@ -21,27 +58,89 @@ def send_notification_email(code, email, notifications, email_type="notification
     email_vars["html_footer"] = html_footer
 
     subject = plain_text_body = html_body = ""
-    for subscribe in p.PluginImplementations(ISubscribe):
-        subject, plain_text_body, html_body = subscribe.get_notification_email_contents(
+    for get_contents in pipeline.hooks("get_notification_email_contents"):
+        subject, plain_text_body, html_body = get_contents(
             email_vars, email_type, subject, plain_text_body, html_body
         )
+    return subject, plain_text_body, html_body
+
+
+@contextlib.contextmanager
+def render_cache(max_size=RENDER_CACHE_SIZE):
+    """Renders each distinct notification email only once within the block,
+    rather than once per recipient.
+
+    The email is rendered with placeholders for the recipient's code and email
+    address, which are then substituted into the cached email for each
+    recipient. So it is disabled if a plugin customises
+    ISubscribe.get_email_vars(), as it might derive other values from them, and
+    with ckanext.subscribe.render_cache = false.
+    """
+    if (
+        getattr(_local, "render_cache", None) is not None
+        or not p.toolkit.asbool(config.get("ckanext.subscribe.render_cache", True))
+        or has_custom_implementation("get_email_vars")
+    ):
+        yield getattr(_local, "render_cache", None)
+        return
+    cache = RenderCache(max_size)
+    _local.render_cache = cache
+    try:
+        yield cache
+    finally:
+        _local.render_cache = None
+        log.debug(f"Notification email render cache: {cache}")
+
+
+class RenderCache(object):
+    """The notification emails rendered with placeholders for the recipient,
+    keyed by the objects and activities they notify, with the least recently
+    used dropped after `max_size` emails."""
+
+    def __init__(self, max_size=RENDER_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._rendered = OrderedDict()
+
+    def render(self, code, email, notifications, email_type="notification"):
+        key = self.key(notifications, email_type)
+        rendered = self._rendered.get(key)
+        if rendered is None:
+            self.misses += 1
+            rendered = render_notification_email(
+                PLACEHOLDER_CODE, PLACEHOLDER_EMAIL, notifications, email_type
+            )
+            self._rendered[key] = rendered
+            if len(self._rendered) > self.max_size:
+                self._rendered.popitem(last=False)
+        else:
+            self.hits += 1
+            self._rendered.move_to_end(key)
+        return tuple(
+            text.replace(PLACEHOLDER_CODE, code).replace(PLACEHOLDER_EMAIL, email)
+            for text in rendered
+        )
 
-    mailer.mail_recipient(
-        recipient_name=email,
-        recipient_email=email,
-        subject=subject,
-        body=plain_text_body,
-        body_html=html_body,
-        headers={},
-    )
+    @staticmethod
+    def key(notifications, email_type):
+        return (email_type,) + tuple(
+            (
+                notification["subscription"]["object_type"],
+                notification["subscription"]["object_id"],
+                tuple(activity["id"] for activity in notification["activities"]),
+            )
+            for notification in notifications
+        )
+
+    def __str__(self):
+        return f"{self.hits} hits, {self.misses} misses"
 
 
 def get_notification_email_vars(code, email, notifications):
     email_vars = {}
-    for subscribe in p.PluginImplementations(ISubscribe):
-        email_vars = subscribe.get_email_vars(
-            code=code, email=email, email_vars=email_vars
-        )
+    for get_email_vars in pipeline.hooks("get_email_vars"):
+        email_vars = get_email_vars(code=code, email=email, email_vars=email_vars)
     notifications_vars = []
     for notification in notifications:
         subscription = notification["subscription"]
@@ -68,16 +167,12 @@ def get_notification_email_vars(code, email, notifications):
             object_title = obj["title"]
         except KeyError:
             # activity['data'] has gone missing - resort to the db
-            if subscription["object_type"] == "dataset":
-                obj = model.Package.get(subscription["object_id"])
-            else:
-                obj = model.Group.get(subscription["object_id"])
+            obj = cache.get_object(object_type_, subscription["object_id"])
             object_name = obj.name
             object_title = obj.title
-        object_link = p.toolkit.url_for(
+        object_link = cache.url_for(
             f"{object_type_}.read",
             id=subscription["object_id"],  # prefer id because it is invariant
-            qualified=True,
         )
         notifications_vars.append(
             dict(
@@ -108,6 +203,6 @@ def dataset_link_from_activity(activity):
 def dataset_href_from_activity(activity):
     try:
         name = activity["data"]["package"]["name"]
-        return p.toolkit.url_for("dataset_read", id=name, qualified=True)
+        return cache.url_for("dataset_read", id=name)
     except KeyError:
         return ""
@@ -0,0 +1,196 @@
+"""
+A durable queue of the emails to send, so that working out the notifications
+and delivering them are done separately.
+
+With ckanext.subscribe.outbox = true, a notification run doesn't send the
+emails itself. It saves them to the subscribe_outbox table, in the same
+transaction as it records the run is done, so a crash neither loses nor
+duplicates them. A separate process delivers them:
+
+    ckan -c /etc/ckan/default/ckan.ini subscribe deliver -r
+
+Several deliver processes can run at once - each claims its own batches of
+emails. An email that can't be delivered is retried with exponential backoff,
+up to ckanext.subscribe.outbox_max_attempts times.
+"""
+
+import datetime
+from functools import partial
+
+import ckan.plugins as p
+from ckan import model
+from ckan.model.types import make_uuid
+
+from ckanext.subscribe import mailer
+from ckanext.subscribe.model import OutboxEmail
+
+log = __import__("logging").getLogger(__name__)
+config = p.toolkit.config
+
+# the delay before retrying an email the first time, doubled for each retry
+RETRY_DELAY = datetime.timedelta(minutes=1)
+MAX_RETRY_DELAY = datetime.timedelta(hours=6)
+
+
+def is_enabled():
+    return p.toolkit.asbool(config.get("ckanext.subscribe.outbox", False))
+
+
+class OutboxWriter(object):
+    """Saves the emails sent within the block to the outbox, rather than
+    delivering them. They are inserted in batches, without committing, so
+    that the caller can commit them along with the rest of its work.
+
+        with outbox.OutboxWriter() as writer:
+            for email in emails:
+                mailer.mail_recipient(...)
+        model.Session.commit()
+
+    :param batch_size: the number of emails in each INSERT
+        (optional, default: ckanext.subscribe.outbox_batch_size)
+    """
+
+    def __init__(self, batch_size=None):
+        if batch_size is None:
+            batch_size = get_batch_size()
+        self.batch_size = batch_size
+        self.report = OutboxReport()
+        self._rows = []
+
+    def __enter__(self):
+        # mailer hands the emails to this, rather than sending them
+        mailer.set_delivery_pool(self)
+        self.report.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        mailer.set_delivery_pool(None)
+        if exc_type is None:
+            self.flush()
+        self.report.finish()
+
+    def submit(self, msg, mail_from, recipient_email):
+        now = datetime.datetime.utcnow()
+        self._rows.append(
+            dict(
+                id=make_uuid(),
+                recipient_email=recipient_email,
+                mail_from=mail_from,
+                message=msg.as_string(),
+                status="pending",
+                attempts=0,
+                next_attempt=now,
+                created=now,
+            )
+        )
+        self.report.record_queued()
+        if len(self._rows) >= self.batch_size:
+            self.flush()
+
+    def wait(self):
+        """Inserts the emails submitted so far (for the same interface as
+        mailer.DeliveryPool)"""
+        self.flush()
+
+    def flush(self):
+        if self._rows:
+            model.Session.execute(OutboxEmail.__table__.insert().values(self._rows))
+            self._rows = []
+
+
+class OutboxReport(mailer.DeliveryReport):
+    """Summary of the emails saved by an OutboxWriter"""
+
+    def __init__(self):
+        super(OutboxReport, self).__init__()
+        self.queued = 0
+
+    def record_queued(self):
+        self.queued += 1
+
+    @property
+    def count(self):
+        return self.queued
+
+    def __str__(self):
+        return f"{self.queued} emails queued in the outbox, in {self.elapsed:.1f}s"
+
+
+def deliver(batch_size=None, workers=None, max_attempts=None):
+    """Delivers the emails that are due in the outbox, until there are none
+    left.
+
+    Each batch is claimed with SELECT ... FOR UPDATE SKIP LOCKED, so other
+    deliver processes skip it, and the result of each email is committed at
+    the end of the batch. If the process dies, the batch is rolled back and
+    delivered again, so at most one batch of emails can be sent twice.
+
+    :param batch_size: (optional, default: ckanext.subscribe.outbox_batch_size)
+    :param workers: the number of emails to send concurrently
+        (optional, default: ckanext.subscribe.delivery_workers)
+    :param max_attempts: the number of times to try each email
+        (optional, default: ckanext.subscribe.outbox_max_attempts)
+
+    :returns: a summary of the emails that were delivered
+    :rtype: ckanext.subscribe.mailer.DeliveryReport
+    """
+    if batch_size is None:
+        batch_size = get_batch_size()
+    if max_attempts is None:
+        max_attempts = p.toolkit.asint(
+            config.get("ckanext.subscribe.outbox_max_attempts", 5)
+        )
+    with mailer.get_delivery_pool(workers=workers) as delivery_pool:
+        while True:
+            emails = (
+                model.Session.query(OutboxEmail)
+                .filter(OutboxEmail.status == "pending")
+                .filter(OutboxEmail.next_attempt <= datetime.datetime.utcnow())
+                .order_by(OutboxEmail.next_attempt)
+                .limit(batch_size)
+                .with_for_update(skip_locked=True)
+                .all()
+            )
+            if not emails:
+                break
+            # {email id: None, or the error}
+            results = {}
+            for email in emails:
+                delivery_pool.submit_string(
+                    email.message,
+                    email.mail_from,
+                    email.recipient_email,
+                    callback=partial(results.__setitem__, email.id),
+                )
+            delivery_pool.wait()
+            now = datetime.datetime.utcnow()
+            for email in emails:
+                record_attempt(email, results[email.id], max_attempts, now)
+            model.Session.commit()
+    if delivery_pool.report.count:
+        log.info(f"Outbox delivery: {delivery_pool.report}")
+    return delivery_pool.report
+
+
+def record_attempt(email, error, max_attempts, now):
+    email.attempts += 1
+    if error is None:
+        email.status = "sent"
+        email.sent = now
+        email.last_error = None
+    elif email.attempts >= max_attempts:
+        email.status = "failed"
+        email.last_error = str(error)
+        log.error(
+            f"Giving up on email {email.id} to {email.recipient_email} after "
+            f"{email.attempts} attempts: {error}"
+        )
+    else:
+        email.last_error = str(error)
+        email.next_attempt = now + min(
+            RETRY_DELAY * 2 ** (email.attempts - 1), MAX_RETRY_DELAY
+        )
+
+
+def get_batch_size():
+    return p.toolkit.asint(config.get("ckanext.subscribe.outbox_batch_size", 100))
@@ -0,0 +1,60 @@
+"""
+Sends the notifications that are due with several worker processes, each
+working out, rendering and sending one shard's share of the email addresses
+(see ckanext.subscribe.shards), so that big runs, such as the weekly digests,
+use all the CPU cores:
+
+    ckan -c ... subscribe send --shards 4
+
+The workers' reports are merged into one, for the whole run.
+"""
+
+import multiprocessing
+
+from ckan import model
+
+from ckanext.subscribe import mailer, notification, purge, shards
+
+log = __import__("logging").getLogger(__name__)
+
+
+def send_any_notifications(shard_count):
+    """Sends the notifications that are due, sharded between shard_count
+    worker processes.
+
+    :returns: a summary of the emails that the workers delivered (or queued)
+    :rtype: ckanext.subscribe.mailer.DeliveryReport
+    """
+    # the workers are forked, so they have CKAN's config and plugins loaded,
+    # but they mustn't share this process's database connections
+    model.Session.remove()
+    model.Session.get_bind().dispose()
+    context = multiprocessing.get_context("fork")
+    with context.Pool(shard_count) as pool:
+        reports = pool.map(
+            _send_shard,
+            [shards.Shard(index, shard_count) for index in range(shard_count)],
+        )
+    report = mailer.DeliveryReport()
+    for shard_report in reports:
+        report.add(shard_report)
+    log.info(f"Notification run, in {shard_count} shards: {report}")
+
+    if purge.is_enabled_after_notifications():
+        purge.purge()
+    return report
+
+
+def _send_shard(shard):
+    report = mailer.DeliveryReport()
+    try:
+        for frequency_report in (
+            notification.send_any_immediate_notifications(shard=shard),
+            notification.send_weekly_notifications_if_its_time_to(shard=shard),
+            notification.send_daily_notifications_if_its_time_to(shard=shard),
+        ):
+            if frequency_report is not None:
+                report.add(frequency_report)
+    finally:
+        model.Session.remove()
+    return report
@@ -0,0 +1,94 @@
+"""
+The chains of ISubscribe hooks that build each email.
+
+Every email calls several ISubscribe hooks - get_email_vars(),
+get_footer_contents() and the get_*_email_contents() - on each of the plugins
+implementing ISubscribe. A HookPipeline looks up the plugins and their hooks
+once, and a notification run uses the same one for all its emails:
+
+    with pipeline.hook_pipeline():
+        for email in emails:
+            ...
+            for get_email_vars in pipeline.hooks("get_email_vars"):
+                email_vars = get_email_vars(code=code, email_vars=email_vars)
+
+The time spent in each plugin's hooks is counted in `timings` and `calls`.
+"""
+
+import contextlib
+import threading
+import time
+from collections import Counter
+
+import ckan.plugins as p
+
+from ckanext.subscribe.interfaces import ISubscribe
+
+log = __import__("logging").getLogger(__name__)
+
+# {"<plugin name>.<hook name>": seconds} spent in each plugin's hooks, in this
+# process
+timings = Counter()
+# {"<plugin name>.<hook name>": number of calls}
+calls = Counter()
+
+# the HookPipeline of the current notification run, if any
+_local = threading.local()
+
+
+class HookPipeline(object):
+    """The ISubscribe plugins, and their hooks, looked up once"""
+
+    def __init__(self):
+        self.plugins = list(p.PluginImplementations(ISubscribe))
+        self._hooks = {}
+
+    def hooks(self, hook_name):
+        """Returns the plugins' implementations of an ISubscribe hook, in the
+        order they are chained."""
+        hooks = self._hooks.get(hook_name)
+        if hooks is None:
+            hooks = self._hooks[hook_name] = [
+                _timed(plugin, hook_name) for plugin in self.plugins
+            ]
+        return hooks
+
+
+def _timed(plugin, hook_name):
+    hook = getattr(plugin, hook_name)
+    key = f"{getattr(plugin, 'name', type(plugin).__name__)}.{hook_name}"
+
+    def timed_hook(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return hook(*args, **kwargs)
+        finally:
+            timings[key] += time.perf_counter() - start
+            calls[key] += 1
+
+    return timed_hook
+
+
+def hooks(hook_name):
+    """Returns the implementations of an ISubscribe hook, in the order they
+    are chained, from the current hook_pipeline() if there is one."""
+    pipeline = getattr(_local, "pipeline", None) or HookPipeline()
+    return pipeline.hooks(hook_name)
+
+
+@contextlib.contextmanager
+def hook_pipeline():
+    """Looks up the ISubscribe hooks once, for all the emails sent within the
+    block, and logs the time spent in each plugin's hooks."""
+    if getattr(_local, "pipeline", None) is not None:
+        # already in a pipeline, so just carry on using it
+        yield _local.pipeline
+        return
+    timings_before = Counter(timings)
+    _local.pipeline = HookPipeline()
+    try:
+        yield _local.pipeline
+    finally:
+        _local.pipeline = None
+        for key, seconds in sorted((timings - timings_before).items()):
+            log.debug(f"ISubscribe hook {key}: {seconds:.3f}s")
@@ -2,7 +2,7 @@ import ckan.plugins as plugins
 import ckan.plugins.toolkit as tk
 
 import ckanext.subscribe.helpers as subscribe_helpers
-from ckanext.subscribe import action, auth
+from ckanext.subscribe import action, auth, commands
 from ckanext.subscribe.blueprints import subscribe_blueprint
 from ckanext.subscribe.interfaces import ISubscribe
 
@@ -14,6 +14,7 @@ class SubscribePlugin(plugins.SingletonPlugin):
     plugins.implements(ISubscribe, inherit=True)
     plugins.implements(plugins.ITemplateHelpers)
     plugins.implements(plugins.IBlueprint, inherit=True)
+    plugins.implements(plugins.IClick)
 
     # IConfigurer
 
@@ -63,3 +64,8 @@ class SubscribePlugin(plugins.SingletonPlugin):
     # IBlueprint
     def get_blueprint(self):
         return [subscribe_blueprint]
+
+    # IClick
+
+    def get_commands(self):
+        return [commands.subscribe]
@@ -0,0 +1,149 @@
+"""
+Deletes what is no longer needed: the login codes and verification codes that
+have expired, subscriptions that were never verified, and the history of old
+notification runs and delivered outbox emails.
+
+A login code is created for every notification email, so without purging,
+subscribe_login_code grows by one row per email for ever. Purge with:
+
+    ckan -c ... subscribe purge-codes
+
+or at the end of every notification run, with
+ckanext.subscribe.purge_after_notifications = true.
+
+The rows are deleted in batches of ckanext.subscribe.purge_batch_size, each
+in its own transaction, so the locks are only held briefly.
+"""
+
+import datetime
+from collections import Counter
+
+import ckan.plugins as p
+from ckan import model
+from sqlalchemy import or_, select, tuple_
+
+from ckanext.subscribe.model import (
+    LoginCode,
+    NotificationRun,
+    NotificationRunRecipient,
+    OutboxEmail,
+    Subscription,
+)
+
+log = __import__("logging").getLogger(__name__)
+config = p.toolkit.config
+
+
+def is_enabled_after_notifications():
+    return p.toolkit.asbool(
+        config.get("ckanext.subscribe.purge_after_notifications", False)
+    )
+
+
+def purge(batch_size=None, now=None):
+    """Deletes the expired codes, stale unverified subscriptions and old
+    history, in batches.
+
+    :param batch_size: the number of rows deleted in each transaction
+        (optional, default: ckanext.subscribe.purge_batch_size)
+
+    :returns: the number of rows purged of each kind
+    :rtype: collections.Counter
+    """
+    if batch_size is None:
+        batch_size = p.toolkit.asint(
+            config.get("ckanext.subscribe.purge_batch_size", 1000)
+        )
+    # codes expire in local time (see email_auth and email_verification)
+    now = now or datetime.datetime.now()
+    unverified_cutoff = now - datetime.timedelta(
+        days=p.toolkit.asint(
+            config.get("ckanext.subscribe.unverified_subscription_expiry_days", 30)
+        )
+    )
+    history_cutoff = datetime.datetime.utcnow() - datetime.timedelta(
+        days=p.toolkit.asint(config.get("ckanext.subscribe.history_expiry_days", 30))
+    )
+    purged = Counter()
+
+    purged["login_codes"] = _delete_in_batches(
+        LoginCode.__table__, LoginCode.expires < now, batch_size
+    )
+    purged["unverified_subscriptions"] = _delete_in_batches(
+        Subscription.__table__,
+        (
+            or_(Subscription.verified.is_(None), Subscription.verified.is_(False)),
+            Subscription.created < unverified_cutoff,
+            or_(
+                Subscription.verification_code_expires.is_(None),
+                Subscription.verification_code_expires < now,
+            ),
+        ),
+        batch_size,
+    )
+    purged["verification_codes"] = _update_in_batches(
+        Subscription.__table__,
+        (
+            Subscription.verification_code.isnot(None),
+            Subscription.verification_code_expires < now,
+        ),
+        dict(verification_code=None, verification_code_expires=None),
+        batch_size,
+    )
+
+    # the history of finished notification runs, and the emails the outbox
+    # has finished with
+    old_runs = select(NotificationRun.id).where(
+        NotificationRun.finished < history_cutoff
+    )
+    purged["run_recipients"] = _delete_in_batches(
+        NotificationRunRecipient.__table__,
+        NotificationRunRecipient.run_id.in_(old_runs),
+        batch_size,
+    )
+    purged["runs"] = _delete_in_batches(
+        NotificationRun.__table__, NotificationRun.finished < history_cutoff, batch_size
+    )
+    purged["outbox_emails"] = _delete_in_batches(
+        OutboxEmail.__table__,
+        (
+            OutboxEmail.status.in_(("sent", "failed")),
+            OutboxEmail.created < history_cutoff,
+        ),
+        batch_size,
+    )
+
+    purged = +purged  # drop the zero counts
+    if purged:
+        log.info(
+            "Purged "
+            + ", ".join(f"{count} {kind}" for kind, count in sorted(purged.items()))
+        )
+    return purged
+
+
+def _delete_in_batches(table, conditions, batch_size):
+    return _in_batches(table.delete(), table, conditions, batch_size)
+
+
+def _update_in_batches(table, conditions, values, batch_size):
+    return _in_batches(table.update().values(**values), table, conditions, batch_size)
+
+
+def _in_batches(statement, table, conditions, batch_size):
+    """Runs the DELETE or UPDATE statement on the rows of the table matching
+    the conditions, one batch of rows per transaction.
+
+    :returns: the number of rows affected
+    """
+    if not isinstance(conditions, tuple):
+        conditions = (conditions,)
+    key = table.primary_key.columns
+    rows = select(*key).where(*conditions).limit(batch_size)
+    total = 0
+    while True:
+        result = model.Session.execute(statement.where(tuple_(*key).in_(rows)))
+        model.Session.commit()
+        total += result.rowcount
+        if result.rowcount < batch_size:
+            return total
@@ -0,0 +1,265 @@
+"""
+A long-running process that sends the notifications as they fall due:
+
+    ckan -c ... subscribe send-any-notifications -r
+
+It polls for immediate notifications every
+ckanext.subscribe.immediate_interval seconds, with some random jitter. It
+works out when the daily and weekly notifications are next due, and sleeps
+until then, rather than checking the database on every poll.
+
+Several replicas can be run, for resilience. Only the one holding the
+"scheduler" lock sends notifications, and the others stand by to take over.
+If its connection to the database is lost, so is the lock, and it stands by.
+With ckanext.subscribe.shards, there is a lock for each shard, so one replica
+of each shard sends its share (see ckanext.subscribe.shards).
+SIGTERM (or SIGINT) stops it, once it has finished what it is doing.
+
+With ckanext.subscribe.listen = true, it is told about new activity as it
+happens (see ckanext.subscribe.events), and notifies the activity on just
+those objects straight away. It then only polls for immediate notifications
+every ckanext.subscribe.listen_poll_interval seconds, in case it missed any -
+or within ckanext.subscribe.immediate_interval of activity, if there are
+subscriptions to orgs or groups, which only a poll notifies.
+
+Every ckanext.subscribe.stats_interval seconds it logs how many notification
+runs there were, and the time spent in each plugin's ISubscribe hooks.
+"""
+
+import datetime
+import random
+import signal
+import threading
+from collections import Counter
+
+import ckan.plugins as p
+from ckan import model
+
+from ckanext.subscribe import events, locks, notification, pipeline, purge, shards
+from ckanext.subscribe.model import Frequency
+
+log = __import__("logging").getLogger(__name__)
+config = p.toolkit.config
+
+# the immediate polls are spread by up to this fraction of the interval, so
+# that replicas and restarts don't poll in step
+IMMEDIATE_JITTER = 0.1
+
+
+class Scheduler(object):
+    """Sends the notifications of each frequency when they are due.
+
+    :param immediate_interval: seconds between polls for immediate
+        notifications (optional, default: ckanext.subscribe.immediate_interval,
+        or ckanext.subscribe.listen_poll_interval when listening)
+    :param listener: tells it about new activity - an events.ActivityListener
+        or a stand-in (optional, default: one if ckanext.subscribe.listen)
+    """
+
+    def __init__(self, immediate_interval=None, jitter=IMMEDIATE_JITTER, listener=None):
+        if listener is None and events.is_enabled():
+            listener = events.ActivityListener()
+        self.listener = listener
+        # when listening, how soon after activity to poll, for the
+        # subscriptions that the runs limited to its objects leave out
+        self.follow_up_interval = p.toolkit.asint(
+            config.get("ckanext.subscribe.immediate_interval", 10)
+        )
+        if immediate_interval is None:
+            if listener is None:
+                immediate_interval = self.follow_up_interval
+            else:
+                immediate_interval = p.toolkit.asint(
+                    config.get("ckanext.subscribe.listen_poll_interval", 300)
+                )
+        self.immediate_interval = immediate_interval
+        self.jitter = jitter
+        shard = shards.get_shard()
+        self.lock = locks.AdvisoryLock(
+            "scheduler" if shard is None else f"scheduler:{shard.index}"
+        )
+        # {frequency: when it is next due}
+        self.next_due = {}
+        self.stats_interval = p.toolkit.asint(
+            config.get("ckanext.subscribe.stats_interval", 3600)
+        )
+        self.stats_due = None
+        # the counters when they were last logged
+        self._stats_logged = self._counters()
+        self._stopping = threading.Event()
+
+    def stop(self, signum=None, frame=None):
+        log.info("Stopping the scheduler")
+        self._stopping.set()
+
+    @property
+    def stopping(self):
+        return self._stopping.is_set()
+
+    def run(self):
+        """Sends the notifications as they are due, until stopped"""
+        previous_handlers = self._handle_signals()
+        try:
+            while not self.stopping:
+                if self.lock.held and not self.lock.is_alive():
+                    # another replica may already have taken over
+                    log.warning("Lost the lock - standing by")
+                    if self.listener is not None:
+                        self.listener.close()
+                if not self.lock.held:
+                    if not self.lock.acquire():
+                        log.debug("Another scheduler is sending - standing by")
+                        self._sleep(self.immediate_interval)
+                        continue
+                    log.info("Sending notifications as they are due")
+                    if self.listener is not None:
+                        self.listener.listen()
+                    self.next_due = self.work_out_next_due(datetime.datetime.now())
+                self.run_due(datetime.datetime.now())
+                self._log_stats_if_due(datetime.datetime.now())
+                self._wait_until(min(self.next_due.values()))
+        finally:
+            if self.listener is not None:
+                self.listener.close()
+            self.lock.release()
+            model.Session.remove()
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
+
+    def work_out_next_due(self, now):
+        """Returns when the notifications of each frequency are next due,
+        catching up on any daily or weekly ones that were missed.
+
+        :returns: {frequency: datetime}
+        """
+        next_due = {Frequency.IMMEDIATE.value: now}
+        if notification.is_it_time_to_send_daily_notifications():
+            next_due[Frequency.DAILY.value] = now
+        else:
+            next_due[Frequency.DAILY.value] = self._next_due(Frequency.DAILY.value, now)
+        if notification.is_it_time_to_send_weekly_notifications():
+            next_due[Frequency.WEEKLY.value] = now
+        else:
+            next_due[Frequency.WEEKLY.value] = self._next_due(
+                Frequency.WEEKLY.value, now
+            )
+        model.Session.remove()
+        return next_due
+
+    def run_due(self, now):
+        """Sends the notifications of the frequencies that are due"""
+        sent = False
+        for frequency, due in sorted(self.next_due.items()):
+            if due > now or self.stopping:
+                continue
+            if self._send(frequency, now):
+                sent = True
+                self.next_due[frequency] = self._next_due(frequency, now)
+        if sent and purge.is_enabled_after_notifications():
+            purge.purge()
+
+    def run_activity(self, object_ids, now):
+        """Sends the immediate notifications of the activity on these
+        objects"""
+        log.debug(f"Activity on {len(object_ids)} objects")
+        self._send(Frequency.IMMEDIATE.value, now, object_ids=object_ids)
+        if notification.any_subscriptions_to_groups(Frequency.IMMEDIATE.value):
+            # the orgs' and groups' subscribers are sent it by a poll
+            follow_up = now + datetime.timedelta(seconds=self.follow_up_interval)
+            self.next_due[Frequency.IMMEDIATE.value] = min(
+                self.next_due.get(Frequency.IMMEDIATE.value, follow_up), follow_up
+            )
+        model.Session.remove()
+
+    def log_stats(self):
+        """Logs the notification runs, and the time spent in each plugin's
+        ISubscribe hooks, since it last logged them"""
+        counters = self._counters()
+        runs, seconds, calls = (
+            counter - logged for counter, logged in zip(counters, self._stats_logged)
+        )
+        self._stats_logged = counters
+        runs = ", ".join(f"{key}={count}" for key, count in sorted(runs.items()))
+        log.info(f"Notification runs: {runs or 'none'}")
+        for key, hook_seconds in sorted(seconds.items()):
+            log.info(f"ISubscribe hook {key}: {calls[key]} calls, {hook_seconds:.3f}s")
+
+    def _log_stats_if_due(self, now):
+        if not self.stats_interval:
+            return
+        if self.stats_due is not None and now >= self.stats_due:
+            self.log_stats()
+        if self.stats_due is None or now >= self.stats_due:
+            self.stats_due = now + datetime.timedelta(seconds=self.stats_interval)
+
+    @staticmethod
+    def _counters():
+        return (
+            Counter(notification.stats),
+            Counter(pipeline.timings),
+            Counter(pipeline.calls),
+        )
+
+    def _send(self, frequency, now, object_ids=None):
+        try:
+            notification.send_notifications(frequency, object_ids=object_ids)
+        except Exception:
+            log.exception(f"{Frequency(frequency).name.title()} notifications failed")
+            model.Session.rollback()
+            # try again after the usual interval - the run is resumed
+            self.next_due[frequency] = now + datetime.timedelta(
+                seconds=self.immediate_interval
+            )
+            return False
+        finally:
+            model.Session.remove()
+        return True
+
+    def _next_due(self, frequency, now):
+        if frequency == Frequency.IMMEDIATE.value:
+            jitter = random.uniform(-self.jitter, self.jitter)
+            return now + datetime.timedelta(
+                seconds=self.immediate_interval * (1 + jitter)
+            )
+        if frequency == Frequency.DAILY.value:
+            most_recent = notification.most_recent_daily_notification_datetime(now)
+            period = datetime.timedelta(days=1)
+        else:
+            most_recent = notification.most_recent_weekly_notification_datetime(now)
+            period = datetime.timedelta(days=7)
+        return most_recent.replace(second=0, microsecond=0) + period
+
+    def _wait_until(self, until):
+        """Sleeps until the time, or if listening, until there is activity"""
+        if self.listener is None:
+            self._sleep_until(until)
+            return
+        while not self.stopping:
+            now = datetime.datetime.now()
+            if now >= until:
+                return
+            # wake up at least every second, to notice being stopped
+            object_ids = self.listener.wait(min((until - now).total_seconds(), 1))
+            if object_ids:
+                self.run_activity(object_ids, datetime.datetime.now())
+                return
+
+    def _sleep_until(self, until):
+        self._sleep((until - datetime.datetime.now()).total_seconds())
+
+    def _sleep(self, seconds):
+        # returns early if stopped
+        self._stopping.wait(max(seconds, 0))
+
+    def _handle_signals(self):
+        """Stops on SIGTERM or SIGINT
+
+        :returns: {signal: the handler it had before}
+        """
+        # signal handlers can only be set in the main thread
+        if threading.current_thread() is not threading.main_thread():
+            return {}
+        return {
+            signum: signal.signal(signum, self.stop)
+            for signum in (signal.SIGTERM, signal.SIGINT)
+        }
@@ -0,0 +1,57 @@
+"""
+Shares each notification run between several workers, e.g. one on each CKAN
+node, by a hash of the email address:
+
+    ckanext.subscribe.shards = 4
+    # on each worker, a different one of 0 to 3
+    ckanext.subscribe.shard = 0
+
+Each worker sends the notifications of its share of the email addresses. The
+first to start a run creates it, and the others join it. The last one to do
+its share finishes the run, advancing emails_last_sent and the subscriptions'
+watermarks. So a run only finishes when every shard has had a worker send its
+share - to keep them going, run a standby replica of each shard's scheduler.
+
+All the workers need the same ckanext.subscribe.shards.
+"""
+
+import hashlib
+from collections import namedtuple
+
+import ckan.plugins as p
+from sqlalchemy import Integer, cast, func, literal
+from sqlalchemy.dialects.postgresql import BIT
+
+config = p.toolkit.config
+
+Shard = namedtuple("Shard", ["index", "count"])
+
+
+def get_shard():
+    """Returns this worker's shard, or None if the runs aren't sharded"""
+    count = p.toolkit.asint(config.get("ckanext.subscribe.shards", 1))
+    if count <= 1:
+        return None
+    index = p.toolkit.asint(config.get("ckanext.subscribe.shard", 0))
+    if not 0 <= index < count:
+        raise ValueError(
+            f"ckanext.subscribe.shard is {index}, but must be 0 to {count - 1}"
+        )
+    return Shard(index, count)
+
+
+def email_hash(email):
+    """Returns the hash of an email address that it is sharded by - the first
+    28 bits of its md5, which shard_clause() works out the same way in SQL"""
+    return int(hashlib.md5(email.encode("utf-8")).hexdigest()[:7], 16)
+
+
+def in_shard(email, shard):
+    return shard is None or email_hash(email) % shard.count == shard.index
+
+
+def shard_clause(email, shard):
+    """Returns SQL for whether the email address (e.g. a column) is in the
+    shard"""
+    hex_digits = literal("x").concat(func.substr(func.md5(email), 1, 7))
+    return cast(cast(hex_digits, BIT(28)), Integer) % shard.count == shard.index
@@ -0,0 +1,40 @@
+"""
+An in-process stand-in for events.ActivityListener, for the tests: object ids
+put() on it are returned by wait().
+
+    listener = QueueListener()
+    scheduler = Scheduler(listener=listener)
+    listener.put(dataset["id"])
+"""
+
+import queue
+import time
+
+
+class QueueListener(object):
+    def __init__(self, debounce=0):
+        self.debounce = debounce
+        self._queue = queue.Queue()
+
+    def put(self, object_id):
+        self._queue.put(object_id)
+
+    def listen(self):
+        pass
+
+    def close(self):
+        pass
+
+    def wait(self, timeout):
+        try:
+            object_ids = {self._queue.get(timeout=max(timeout, 0))}
+        except queue.Empty:
+            return set()
+        deadline = time.monotonic() + self.debounce
+        while True:
+            try:
+                object_ids.add(
+                    self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                )
+            except queue.Empty:
+                return object_ids
@@ -0,0 +1,147 @@
+"""
+A stand-in SMTP server for the tests, in the style of aiosmtpd's Controller:
+it runs on an event loop in a thread of its own, and keeps the messages it is
+sent.
+
+    with SMTPServer() as server:
+        with helpers.changed_config("smtp.test_server", server.address):
+            ...
+    server.messages  # [(mail_from, [recipient], message)]
+"""
+
+import asyncio
+import base64
+import threading
+
+
+class SMTPServer(object):
+    """
+    :param pipelining: advertise PIPELINING
+    :param reject: email addresses whose RCPT is refused
+    :param disconnect_after: close each connection after this many messages
+    :param auth: (user, password) that AUTH PLAIN accepts
+    :param delay: seconds to wait before accepting each message
+    """
+
+    def __init__(
+        self, pipelining=True, reject=(), disconnect_after=None, auth=None, delay=0
+    ):
+        self.pipelining = pipelining
+        self.reject = set(reject)
+        self.disconnect_after = disconnect_after
+        self.auth = auth
+        self.delay = delay
+        self.messages = []
+        self.sessions = 0
+        self.max_concurrent_sessions = 0
+        self._concurrent_sessions = 0
+        self._loop = None
+        self._thread = None
+        self._server = None
+        self.address = None
+
+    def __enter__(self):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        self._server = asyncio.run_coroutine_threadsafe(
+            asyncio.start_server(self._session, "127.0.0.1", 0), self._loop
+        ).result()
+        port = self._server.sockets[0].getsockname()[1]
+        self.address = f"127.0.0.1:{port}"
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._loop.call_soon_threadsafe(self._server.close)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    async def _session(self, reader, writer):
+        self.sessions += 1
+        self._concurrent_sessions += 1
+        self.max_concurrent_sessions = max(
+            self.max_concurrent_sessions, self._concurrent_sessions
+        )
+
+        def reply(*lines):
+            for line in lines[:-1]:
+                writer.write(line[:3].encode() + b"-" + line[4:].encode() + b"\r\n")
+            writer.write(lines[-1].encode() + b"\r\n")
+
+        mail_from, recipients, messages = None, [], 0
+        authenticated = self.auth is None
+        try:
+            reply("220 localhost stand-in ESMTP")
+            while True:
+                await writer.drain()
+                line = await reader.readline()
+                if not line:
+                    return
+                command, _, argument = line.decode().strip().partition(" ")
+                command = command.upper()
+                if command == "EHLO":
+                    extensions = ["PIPELINING"] if self.pipelining else []
+                    if self.auth:
+                        extensions.append("AUTH PLAIN")
+                    reply(*[f"250 {line}" for line in ["localhost"] + extensions])
+                elif command == "HELO":
+                    reply("250 localhost")
+                elif command == "AUTH":
+                    token = argument.partition(" ")[2]
+                    _, user, password = base64.b64decode(token).decode().split("\0")
+                    if (user, password) == self.auth:
+                        authenticated = True
+                        reply("235 Authentication successful")
+                    else:
+                        reply("535 Authentication failed")
+                elif not authenticated and command in ("MAIL", "RCPT", "DATA"):
+                    reply("530 Authentication required")
+                elif command == "MAIL":
+                    mail_from = argument.partition(":")[2].strip("<>")
+                    reply("250 OK")
+                elif command == "RCPT":
+                    recipient = argument.partition(":")[2].strip("<>")
+                    if recipient in self.reject:
+                        reply("550 No such user")
+                    else:
+                        recipients.append(recipient)
+                        reply("250 OK")
+                elif command == "DATA":
+                    if mail_from is None or not recipients:
+                        reply("554 No valid recipients")
+                        continue
+                    reply("354 End data with <CR><LF>.<CR><LF>")
+                    await writer.drain()
+                    data = []
+                    while True:
+                        line = await reader.readline()
+                        if not line:
+                            return
+                        if line == b".\r\n":
+                            break
+                        data.append(line[1:] if line.startswith(b"..") else line)
+                    await asyncio.sleep(self.delay)
+                    self.messages.append((mail_from, recipients, b"".join(data)))
+                    reply("250 OK")
+                    mail_from, recipients = None, []
+                    messages += 1
+                    if self.disconnect_after and messages >= self.disconnect_after:
+                        await writer.drain()
+                        return
+                elif command == "RSET":
+                    mail_from, recipients = None, []
+                    reply("250 OK")
+                elif command == "NOOP":
+                    reply("250 OK")
+                elif command == "QUIT":
+                    reply("221 Bye")
+                    await writer.drain()
+                    return
+                else:
+                    reply("500 Command not recognized")
+        except ConnectionError:
+            pass
+        finally:
+            self._concurrent_sessions -= 1
+            writer.close()
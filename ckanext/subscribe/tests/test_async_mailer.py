@@ -0,0 +1,163 @@
+import contextlib
+
+import mock
+import pytest
+from ckan.tests import helpers
+
+from ckanext.subscribe import async_mailer, mailer
+from ckanext.subscribe.tests.smtp_server import SMTPServer
+
+
+def _send(n=1):
+    for i in range(n):
+        mailer.mail_recipient(
+            recipient_name=f"user{i}@example.com",
+            recipient_email=f"user{i}@example.com",
+            subject="Subject",
+            body="Body",
+        )
+
+
+@contextlib.contextmanager
+def _serving(**kwargs):
+    with SMTPServer(**kwargs) as server:
+        with helpers.changed_config("smtp.test_server", server.address):
+            yield server
+
+
+@pytest.mark.ckan_config("ckan.plugins", "subscribe activity")
+@pytest.mark.usefixtures("with_plugins")
+class TestAsyncDeliveryPool(object):
+    @pytest.mark.parametrize("pipelining", [True, False])
+    def test_delivers(self, pipelining):
+        with _serving(pipelining=pipelining) as server:
+            with async_mailer.AsyncDeliveryPool(workers=1) as pool:
+                _send(3)
+
+        assert server.sessions == 1
+        assert sorted(recipients[0] for _, recipients, _ in server.messages) == [
+            "user0@example.com",
+            "user1@example.com",
+            "user2@example.com",
+        ]
+        assert pool.report.sent == 3
+        assert pool.report.failed == []
+
+    def test_sends_concurrently_over_a_fixed_set_of_connections(self):
+        with _serving(delay=0.01) as server:
+            with async_mailer.AsyncDeliveryPool(workers=3) as pool:
+                _send(20)
+
+        assert server.sessions == 3
+        assert server.max_concurrent_sessions > 1
+        assert len(server.messages) == 20
+        assert pool.report.sent == 20
+
+    @pytest.mark.parametrize("pipelining", [True, False])
+    def test_a_failing_mailbox_doesnt_stop_the_others(self, pipelining):
+        with _serving(pipelining=pipelining, reject=["user2@example.com"]) as server:
+            with async_mailer.AsyncDeliveryPool(workers=1) as pool:
+                _send(5)
+
+        assert server.sessions == 1
+        assert len(server.messages) == 4
+        assert pool.report.sent == 4
+        assert pool.report.failed == ["user2@example.com"]
+
+    def test_reconnects_after_max_messages(self):
+        with _serving() as server:
+            with async_mailer.AsyncDeliveryPool(workers=1, max_messages=2) as pool:
+                _send(5)
+
+        assert server.sessions == 3
+        assert pool.report.sent == 5
+
+    def test_reconnects_when_server_disconnects(self):
+        with _serving(disconnect_after=2) as server:
+            with async_mailer.AsyncDeliveryPool(workers=1) as pool:
+                _send(5)
+
+        assert server.sessions == 3
+        assert len(server.messages) == 5
+        assert pool.report.sent == 5
+
+    def test_leading_dots_are_escaped(self):
+        with _serving() as server:
+            with async_mailer.AsyncDeliveryPool(workers=1) as pool:
+                pool.submit_string(
+                    "Body\n.leading dot\n", "from@example.com", "user@example.com"
+                )
+
+        assert server.messages[0][2] == b"Body\r\n.leading dot\r\n"
+
+    def test_wait(self):
+        with _serving() as server:
+            with async_mailer.AsyncDeliveryPool(workers=2) as pool:
+                _send(4)
+                pool.wait()
+
+                assert len(server.messages) == 4
+
+    def test_callback(self):
+        results = []
+        with _serving(reject=["bad@example.com"]):
+            with async_mailer.AsyncDeliveryPool(workers=1) as pool:
+                for email in ("good@example.com", "bad@example.com"):
+                    pool.submit_string(
+                        "Body", "from@example.com", email, results.append
+                    )
+
+        assert results[0] is None
+        assert isinstance(results[1], mailer.MailerException)
+
+    def test_login(self):
+        with SMTPServer(auth=("user", "password")) as server:
+            with mock.patch(
+                "ckanext.subscribe.mailer.get_smtp_settings",
+                return_value=(server.address, False, "user", "password"),
+            ):
+                with async_mailer.AsyncDeliveryPool(workers=1) as pool:
+                    _send(1)
+
+        assert pool.report.sent == 1
+
+    def test_wrong_password(self):
+        with SMTPServer(auth=("user", "password")) as server:
+            with mock.patch(
+                "ckanext.subscribe.mailer.get_smtp_settings",
+                return_value=(server.address, False, "user", "wrong"),
+            ):
+                with async_mailer.AsyncDeliveryPool(workers=1) as pool:
+                    _send(1)
+
+        assert server.messages == []
+        assert pool.report.failed == ["user0@example.com"]
+
+    def test_server_down(self):
+        with _serving() as server:
+            address = server.address
+
+        with helpers.changed_config("smtp.test_server", address):
+            with async_mailer.AsyncDeliveryPool(workers=1) as pool:
+                _send(2)
+
+        assert pool.report.failed == ["user0@example.com", "user1@example.com"]
+
+
+@pytest.mark.ckan_config("ckan.plugins", "subscribe activity")
+@pytest.mark.usefixtures("with_plugins")
+class TestGetDeliveryPool(object):
+    def test_threads_by_default(self):
+        assert isinstance(mailer.get_delivery_pool(), mailer.DeliveryPool)
+
+    @pytest.mark.ckan_config("ckanext.subscribe.delivery_backend", "asyncio")
+    def test_asyncio(self):
+        pool = mailer.get_delivery_pool(workers=5)
+
+        assert isinstance(pool, async_mailer.AsyncDeliveryPool)
+        assert pool.workers == 5
+
+    @pytest.mark.ckan_config("ckanext.subscribe.delivery_backend", "carrier-pigeon")
+    def test_unknown_backend(self):
+        with pytest.raises(ValueError):
+            mailer.get_delivery_pool()
@@ -0,0 +1,267 @@
+"""Benchmarks of the notification hot paths on a large, synthetic portal.
+
+They take minutes, so they only run when CKANEXT_SUBSCRIBE_BENCHMARK is set:
+
+    CKANEXT_SUBSCRIBE_BENCHMARK=1 pytest --ckan-ini=test.ini -s \
+        ckanext/subscribe/tests/test_benchmarks.py
+"""
+
+import datetime
+import os
+import time
+import tracemalloc
+from collections import defaultdict
+
+import pytest
+from ckan import model
+from ckan.model import Group, Member, Package
+from ckan.model.types import make_uuid
+
+from ckanext.activity.model import Activity
+from ckanext.activity.model import activity as model_activity
+from ckanext.subscribe.dictization import dictize_activity
+from ckanext.subscribe.model import Frequency, Subscription
+from ckanext.subscribe.notification import get_objects_subscribed_to
+
+pytestmark = [
+    pytest.mark.skipif(
+        not os.environ.get("CKANEXT_SUBSCRIBE_BENCHMARK"),
+        reason="Set CKANEXT_SUBSCRIBE_BENCHMARK to run the benchmarks",
+    ),
+    pytest.mark.ckan_config("ckan.plugins", "subscribe activity"),
+    pytest.mark.usefixtures("with_plugins", "clean_db"),
+]
+
+NUM_DATASETS = 100000
+NUM_ORGS = 200
+NUM_GROUPS = 200
+NUM_SUBSCRIPTIONS = 50000
+
+
+def _insert(table, rows, batch_size=5000):
+    for i in range(0, len(rows), batch_size):
+        model.Session.execute(table.insert().values(rows[i : i + batch_size]))
+
+
+def create_synthetic_portal(
+    num_datasets=NUM_DATASETS,
+    num_orgs=NUM_ORGS,
+    num_groups=NUM_GROUPS,
+    num_subscriptions=NUM_SUBSCRIPTIONS,
+):
+    """Bulk-inserts datasets spread over orgs & groups, and immediate
+    subscriptions to a mix of them, bypassing the actions for speed.
+
+    :returns: {object_type: [object_id, ...]}
+    """
+    now = datetime.datetime.utcnow()
+    orgs = [make_uuid() for _ in range(num_orgs)]
+    groups = [make_uuid() for _ in range(num_groups)]
+    _insert(
+        model.group_table,
+        [
+            dict(
+                id=id_,
+                name=f"bench-{type_}-{i}",
+                title=f"Benchmark {type_} {i}",
+                type=type_,
+                is_organization=type_ == "organization",
+                state="active",
+                approval_status="approved",
+                created=now,
+            )
+            for type_, ids in (("organization", orgs), ("group", groups))
+            for i, id_ in enumerate(ids)
+        ],
+    )
+    datasets = [make_uuid() for _ in range(num_datasets)]
+    _insert(
+        model.package_table,
+        [
+            dict(
+                id=id_,
+                name=f"bench-dataset-{i}",
+                title=f"Benchmark dataset {i}",
+                type="dataset",
+                state="active",
+                private=False,
+                owner_org=orgs[i % num_orgs],
+                metadata_created=now,
+                metadata_modified=now,
+            )
+            for i, id_ in enumerate(datasets)
+        ],
+    )
+    _insert(
+        model.member_table,
+        [
+            dict(
+                id=make_uuid(),
+                table_id=id_,
+                table_name="package",
+                group_id=groups[i % num_groups],
+                capacity="public",
+                state="active",
+            )
+            for i, id_ in enumerate(datasets)
+        ],
+    )
+    objects = {"dataset": datasets, "organization": orgs, "group": groups}
+    # mostly datasets, with 1 in 10 subscriptions to an org or a group
+    object_types = ["dataset"] * 8 + ["organization", "group"]
+    _insert(
+        Subscription.__table__,
+        [
+            dict(
+                id=make_uuid(),
+                email=f"user{i % (num_subscriptions // 2)}@example.com",
+                object_type=object_types[i % 10],
+                object_id=objects[object_types[i % 10]][
+                    i % len(objects[object_types[i % 10]])
+                ],
+                verified=True,
+                frequency=Frequency.IMMEDIATE.value,
+                created=now - datetime.timedelta(days=1),
+            )
+            for i in range(num_subscriptions)
+        ],
+    )
+    model.Session.commit()
+    return objects
+
+
+def _get_objects_subscribed_to_orm(subscription_frequency):
+    # the original implementation: three ORM queries of Subscription objects
+    objects_subscribed_to = defaultdict(list)
+    for subscription in (
+        model.Session.query(Subscription)
+        .filter(Subscription.verified.is_(True))
+        .filter(Subscription.frequency == subscription_frequency)
+        .all()
+    ):
+        objects_subscribed_to[subscription.object_id].append(subscription)
+    for subscription, package_id in (
+        model.Session.query(Subscription, Package.id)
+        .filter(Subscription.verified.is_(True))
+        .filter(Subscription.frequency == subscription_frequency)
+        .join(Group, Group.id == Subscription.object_id)
+        .filter(Group.state == "active")
+        .filter(Group.is_organization.is_(True))
+        .join(Package, Package.owner_org == Group.id)
+        .all()
+    ):
+        objects_subscribed_to[package_id].append(subscription)
+    for subscription, package_id in (
+        model.Session.query(Subscription, Package.id)
+        .filter(Subscription.verified.is_(True))
+        .filter(Subscription.frequency == subscription_frequency)
+        .join(Group, Group.id == Subscription.object_id)
+        .filter(Group.state == "active")
+        .filter(Group.is_organization.is_(False))
+        .join(Member, Member.group_id == Group.id)
+        .filter(Member.state == "active")
+        .join(Package, Package.id == Member.table_id)
+        .all()
+    ):
+        objects_subscribed_to[package_id].append(subscription)
+    return objects_subscribed_to
+
+
+def _pairs(objects_subscribed_to):
+    return {
+        (object_id, subscription.id)
+        for object_id, subscriptions in objects_subscribed_to.items()
+        for subscription in subscriptions
+    }
+
+
+def _time(func, *args):
+    model.Session.expunge_all()
+    start = time.monotonic()
+    result = func(*args)
+    return result, time.monotonic() - start
+
+
+class TestGetObjectsSubscribedToBenchmark(object):
+    def test_union_query_vs_orm_queries(self):
+        create_synthetic_portal()
+
+        orm_result, orm_seconds = _time(
+            _get_objects_subscribed_to_orm, Frequency.IMMEDIATE.value
+        )
+        union_result, union_seconds = _time(
+            get_objects_subscribed_to, Frequency.IMMEDIATE.value
+        )
+
+        print(
+            f"\nget_objects_subscribed_to: {len(union_result)} objects, "
+            f"{len(_pairs(union_result))} (object, subscription) pairs\n"
+            f"  3 ORM queries: {orm_seconds:.2f}s\n"
+            f"  UNION query:   {union_seconds:.2f}s"
+        )
+        assert _pairs(union_result) == _pairs(orm_result)
+
+
+def _synthetic_activities(num_activities=10000, num_resources=20):
+    """Activity objects (not saved) of a realistically sized dataset"""
+    now = datetime.datetime.utcnow()
+    package = {
+        "id": make_uuid(),
+        "name": "bench-dataset",
+        "title": "Benchmark dataset",
+        "notes": "A description of the dataset. " * 20,
+        "extras": [{"key": f"key{i}", "value": "value " * 10} for i in range(20)],
+        "tags": [{"name": f"tag{i}"} for i in range(10)],
+        "resources": [
+            {
+                "id": make_uuid(),
+                "name": f"Resource {i}",
+                "url": f"http://example.com/resource/{i}.csv",
+                "description": "A description of the resource. " * 10,
+            }
+            for i in range(num_resources)
+        ],
+    }
+    return [
+        Activity(
+            id=make_uuid(),
+            timestamp=now,
+            user_id="bench-user",
+            object_id=package["id"],
+            activity_type="changed package",
+            data={"package": package},
+        )
+        for _ in range(num_activities)
+    ]
+
+
+def _measure(func, *args):
+    tracemalloc.start()
+    start = time.monotonic()
+    func(*args)
+    seconds = time.monotonic() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peak
+
+
+class TestDictizeActivitiesBenchmark(object):
+    def test_slim_dictizer_vs_activity_list_dictize(self):
+        activities = _synthetic_activities()
+        context = {"model": model, "session": model.Session}
+
+        full_seconds, full_peak = _measure(
+            model_activity.activity_list_dictize, activities, context
+        )
+        slim_seconds, slim_peak = _measure(
+            lambda activities: [dictize_activity(a) for a in activities], activities
+        )
+
+        print(
+            f"\ndictizing {len(activities)} activities:\n"
+            f"  activity_list_dictize: {full_seconds:.2f}s, "
+            f"peak {full_peak / 1e6:.1f}MB\n"
+            f"  dictize_activity:      {slim_seconds:.2f}s, "
+            f"peak {slim_peak / 1e6:.1f}MB"
+        )
+        assert slim_seconds < full_seconds
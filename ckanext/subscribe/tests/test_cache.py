@@ -0,0 +1,114 @@
+import datetime
+
+import mock
+import pytest
+from ckan import plugins as p
+from ckan.tests.factories import Dataset, Organization
+
+from ckanext.subscribe import cache
+from ckanext.subscribe.notification import dictize_notifications
+from ckanext.subscribe.notification_email import get_notification_email_vars
+from ckanext.subscribe.tests import factories
+
+
+@pytest.mark.ckan_config("ckan.plugins", "subscribe activity")
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+class TestObjectCache(object):
+    def test_get_object(self):
+        dataset = Dataset()
+        org = Organization()
+
+        with cache.object_cache():
+            assert cache.get_object("dataset", dataset["id"]).name == dataset["name"]
+            assert cache.get_object("organization", org["id"]).title == org["title"]
+
+    def test_fetched_once(self):
+        dataset = Dataset()
+
+        with cache.object_cache() as object_cache:
+            cache.get_object("dataset", dataset["id"])
+            cache.get_object("dataset", dataset["id"])
+
+        assert object_cache.queries == 1
+
+    def test_prefetch_fetches_each_type_in_one_query(self):
+        datasets = [Dataset(), Dataset()]
+        org = Organization()
+
+        with cache.object_cache() as object_cache:
+            cache.prefetch(
+                [("dataset", dataset["id"]) for dataset in datasets]
+                + [("organization", org["id"])]
+            )
+            for dataset in datasets:
+                cache.get_object("dataset", dataset["id"])
+            cache.get_object("organization", org["id"])
+
+        assert object_cache.queries == 2
+
+    def test_missing_object(self):
+        with cache.object_cache():
+            assert cache.get_object("dataset", "missing") is None
+
+    def test_without_a_cache(self):
+        dataset = Dataset()
+
+        assert cache.get_object("dataset", dataset["id"]).name == dataset["name"]
+
+    def test_notification_email_vars_use_the_cache(self):
+        dataset, activity = factories.DatasetActivity(
+            timestamp=datetime.datetime.now() - datetime.timedelta(minutes=10),
+            return_activity=True,
+        )
+        subscription = factories.Subscription(
+            dataset_id=dataset["id"], return_object=True
+        )
+        notifications = dictize_notifications({subscription: [activity]})
+
+        with cache.object_cache() as object_cache:
+            cache.prefetch([("dataset", dataset["id"])])
+            for code in ("code-a", "code-b"):
+                email_vars = get_notification_email_vars(
+                    code=code, email="bob@example.com", notifications=notifications
+                )
+
+        assert object_cache.queries == 1
+        assert email_vars["notifications"][0]["object_name"] == dataset["name"]
+
+
+@pytest.mark.ckan_config("ckan.plugins", "subscribe activity")
+@pytest.mark.usefixtures("with_plugins")
+class TestUrlCache(object):
+    def test_url_with_code(self):
+        with cache.url_cache():
+            url = cache.url_with_code("subscribe.manage", "the-code")
+
+        assert url == p.toolkit.url_for(
+            "subscribe.manage", code="the-code", qualified=True
+        )
+
+    def test_url_with_code_and_object(self):
+        with cache.url_cache():
+            url = cache.url_with_code(
+                "subscribe.unsubscribe", "the-code", dataset="abc"
+            )
+
+        assert url == p.toolkit.url_for(
+            "subscribe.unsubscribe", code="the-code", dataset="abc", qualified=True
+        )
+
+    def test_built_once(self):
+        with mock.patch(
+            "ckan.plugins.toolkit.url_for", wraps=p.toolkit.url_for
+        ) as url_for:
+            with cache.url_cache():
+                for code in ("code-a", "code-b"):
+                    cache.url_with_code("subscribe.manage", code)
+                    cache.url_for("dataset.read", id="abc")
+
+        assert url_for.call_count == 2
+
+    def test_without_a_cache(self):
+        assert cache.url_for("dataset.read", id="abc") == p.toolkit.url_for(
+            "dataset.read", id="abc", qualified=True
+        )
@@ -0,0 +1,81 @@
+from collections import Counter
+
+import mock
+import pytest
+from ckan.cli.cli import ckan
+
+from ckanext.subscribe import mailer
+
+
+@pytest.mark.ckan_config("ckan.plugins", "subscribe activity")
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+class TestSendAnyNotifications(object):
+    @mock.patch("ckanext.subscribe.notification.send_any_immediate_notifications")
+    @mock.patch(
+        "ckanext.subscribe.notification.send_weekly_notifications_if_its_time_to"
+    )
+    @mock.patch(
+        "ckanext.subscribe.notification.send_daily_notifications_if_its_time_to"
+    )
+    def test_send_any_notifications(self, daily, weekly, immediate, cli):
+        result = cli.invoke(ckan, ["subscribe", "send-any-notifications"])
+
+        assert not result.exit_code, result.output
+        immediate.assert_called_once()
+
+    @mock.patch("ckanext.subscribe.scheduler.Scheduler.run")
+    def test_repeatedly_runs_the_scheduler(self, run, cli):
+        result = cli.invoke(ckan, ["subscribe", "send-any-notifications", "-r"])
+
+        assert not result.exit_code, result.output
+        run.assert_called_once()
+
+
+@pytest.mark.ckan_config("ckan.plugins", "subscribe activity")
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+class TestSend(object):
+    @mock.patch(
+        "ckanext.subscribe.parallel.send_any_notifications",
+        return_value=mailer.DeliveryReport(),
+    )
+    def test_send_in_shards(self, send_any_notifications, cli):
+        result = cli.invoke(ckan, ["subscribe", "send", "--shards", "4"])
+
+        assert not result.exit_code, result.output
+        send_any_notifications.assert_called_once_with(4)
+        assert "Notification run, in 4 shards: 0 emails sent" in result.output
+
+    def test_shards_is_required(self, cli):
+        result = cli.invoke(ckan, ["subscribe", "send"])
+
+        assert result.exit_code
+
+
+@pytest.mark.ckan_config("ckan.plugins", "subscribe activity")
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+class TestDeliver(object):
+    @mock.patch(
+        "ckanext.subscribe.outbox.deliver", return_value=mailer.DeliveryReport()
+    )
+    def test_deliver(self, deliver, cli):
+        result = cli.invoke(ckan, ["subscribe", "deliver"])
+
+        assert not result.exit_code, result.output
+        deliver.assert_called_once()
+        assert "Outbox delivery: 0 emails sent" in result.output
+
+
+@pytest.mark.ckan_config("ckan.plugins", "subscribe activity")
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+class TestPurgeCodes(object):
+    @mock.patch(
+        "ckanext.subscribe.purge.purge",
+        return_value=Counter(login_codes=3, unverified_subscriptions=1),
+    )
+    def test_purge_codes(self, purge, cli):
+        result = cli.invoke(ckan, ["subscribe", "purge-codes"])
+
+        assert not result.exit_code, result.output
+        purge.assert_called_once()
+        assert "Purged 3 login codes" in result.output
+        assert "Purged 1 unverified subscriptions" in result.output
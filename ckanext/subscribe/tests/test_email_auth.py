@@ -0,0 +1,29 @@
+import pytest
+from ckan import model
+
+from ckanext.subscribe import email_auth
+from ckanext.subscribe.model import LoginCode
+
+
+@pytest.mark.ckan_config("ckan.plugins", "subscribe activity")
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+class TestCreateCodes(object):
+    def test_basic(self):
+        codes = email_auth.create_codes(["bob@example.com", "alice@example.com"])
+
+        assert set(codes.keys()) == {"bob@example.com", "alice@example.com"}
+        assert codes["bob@example.com"] != codes["alice@example.com"]
+        for email, code in codes.items():
+            assert email_auth.authenticate_with_code(code) == email
+
+    def test_no_emails(self):
+        assert email_auth.create_codes([]) == {}
+        assert model.Session.query(LoginCode).count() == 0
+
+    def test_more_than_one_batch(self):
+        emails = [f"user{i}@example.com" for i in range(2500)]
+
+        codes = email_auth.create_codes(emails)
+
+        assert len(codes) == 2500
+        assert model.Session.query(LoginCode).count() == 2500
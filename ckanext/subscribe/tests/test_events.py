@@ -0,0 +1,168 @@
+import datetime
+
+import mock
+import pytest
+from ckan import model
+from ckan.tests.factories import Dataset, Organization
+from sqlalchemy import text
+
+from ckanext.subscribe import events
+from ckanext.subscribe.model import Frequency
+from ckanext.subscribe.notification import send_notifications
+from ckanext.subscribe.scheduler import Scheduler
+from ckanext.subscribe.tests import factories
+from ckanext.subscribe.tests.listeners import QueueListener
+
+
+def _notify(object_id):
+    model.Session.execute(
+        text("SELECT pg_notify(:channel, :object_id)"),
+        {"channel": events.CHANNEL, "object_id": object_id},
+    )
+    model.Session.commit()
+
+
+@pytest.mark.ckan_config("ckan.plugins", "subscribe activity")
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+class TestActivityListener(object):
+    def setup_method(self):
+        self.listener = events.ActivityListener(debounce=0.2)
+        self.listener.listen()
+
+    def teardown_method(self):
+        self.listener.close()
+
+    def test_receives_the_object_ids(self):
+        _notify("dataset-a")
+
+        assert self.listener.wait(timeout=1) == {"dataset-a"}
+
+    def test_burst_is_received_together(self):
+        for object_id in ("dataset-a", "dataset-b", "dataset-a"):
+            _notify(object_id)
+
+        assert self.listener.wait(timeout=1) == {"dataset-a", "dataset-b"}
+
+    def test_times_out_without_activity(self):
+        assert self.listener.wait(timeout=0.1) == set()
+
+    def test_activity_is_notified_by_the_trigger(self):
+        if not events.is_trigger_installed():
+            pytest.skip("The trigger is only added if the activity table exists")
+
+        dataset = factories.DatasetActivity()
+
+        assert dataset["id"] in self.listener.wait(timeout=1)
+
+    def test_listen_adds_a_missing_trigger(self):
+        model.Session.execute(
+            text(f"DROP TRIGGER IF EXISTS {events.TRIGGER} ON activity")
+        )
+        model.Session.commit()
+        listener = events.ActivityListener(debounce=0)
+
+        try:
+            listener.listen()
+            dataset = factories.DatasetActivity()
+
+            assert events.is_trigger_installed()
+            assert dataset["id"] in listener.wait(timeout=1)
+        finally:
+            listener.close()
+
+
+@pytest.mark.ckan_config("ckan.plugins", "subscribe activity")
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+class TestEventDrivenNotifications(object):
+    @mock.patch("ckanext.subscribe.notification_email.send_notification_email")
+    def test_only_the_objects_are_notified(self, send_notification_email):
+        dataset_a = factories.DatasetActivity()
+        dataset_b = factories.DatasetActivity()
+        factories.Subscription(email="user@a.com", dataset_id=dataset_a["id"])
+        factories.Subscription(email="user@b.com", dataset_id=dataset_b["id"])
+
+        send_notifications(Frequency.IMMEDIATE.value, object_ids={dataset_a["id"]})
+
+        assert [call[0][1] for call in send_notification_email.call_args_list] == [
+            "user@a.com"
+        ]
+
+    @mock.patch("ckanext.subscribe.notification_email.send_notification_email")
+    def test_the_other_objects_are_notified_by_the_next_poll(
+        self, send_notification_email
+    ):
+        dataset_a = factories.DatasetActivity()
+        dataset_b = factories.DatasetActivity()
+        factories.Subscription(email="user@a.com", dataset_id=dataset_a["id"])
+        factories.Subscription(email="user@b.com", dataset_id=dataset_b["id"])
+        send_notifications(Frequency.IMMEDIATE.value, object_ids={dataset_a["id"]})
+        send_notification_email.reset_mock()
+
+        send_notifications(Frequency.IMMEDIATE.value)
+
+        assert [call[0][1] for call in send_notification_email.call_args_list] == [
+            "user@b.com"
+        ]
+
+    @mock.patch("ckanext.subscribe.notification_email.send_notification_email")
+    def test_org_subscription_is_left_to_the_next_poll(self, send_notification_email):
+        org = Organization()
+        dataset = Dataset(owner_org=org["id"])
+        factories.Subscription(email="user@a.com", dataset_id=dataset["id"])
+        factories.Subscription(email="user@org.com", organization_id=org["id"])
+
+        send_notifications(Frequency.IMMEDIATE.value, object_ids={dataset["id"]})
+
+        assert [call[0][1] for call in send_notification_email.call_args_list] == [
+            "user@a.com"
+        ]
+        send_notification_email.reset_mock()
+
+        send_notifications(Frequency.IMMEDIATE.value)
+
+        assert [call[0][1] for call in send_notification_email.call_args_list] == [
+            "user@org.com"
+        ]
+
+    @mock.patch("ckanext.subscribe.notification.send_notifications")
+    def test_scheduler_sends_on_activity(self, send_notifications_):
+        listener = QueueListener()
+        scheduler = Scheduler(listener=listener)
+        listener.put("dataset-a")
+        listener.put("dataset-b")
+
+        scheduler._wait_until(datetime.datetime.now() + datetime.timedelta(seconds=5))
+
+        send_notifications_.assert_called_once_with(
+            Frequency.IMMEDIATE.value, object_ids={"dataset-a", "dataset-b"}
+        )
+
+    @pytest.mark.parametrize("subscribed_to_org", [True, False])
+    @mock.patch("ckanext.subscribe.notification.send_notifications")
+    def test_scheduler_polls_soon_after_activity_for_org_subscriptions(
+        self, send_notifications_, subscribed_to_org
+    ):
+        org = Organization()
+        dataset = Dataset(owner_org=org["id"])
+        if subscribed_to_org:
+            factories.Subscription(organization_id=org["id"])
+        else:
+            factories.Subscription(dataset_id=dataset["id"])
+        scheduler = Scheduler(listener=QueueListener())
+        now = datetime.datetime.now()
+        next_poll = now + datetime.timedelta(seconds=300)
+        scheduler.next_due = {Frequency.IMMEDIATE.value: next_poll}
+
+        scheduler.run_activity({dataset["id"]}, now)
+
+        if subscribed_to_org:
+            assert scheduler.next_due[
+                Frequency.IMMEDIATE.value
+            ] == now + datetime.timedelta(seconds=10)
+        else:
+            assert scheduler.next_due[Frequency.IMMEDIATE.value] == next_poll
+
+    def test_scheduler_polls_less_often_when_listening(self):
+        scheduler = Scheduler(listener=QueueListener())
+
+        assert scheduler.immediate_interval == 300
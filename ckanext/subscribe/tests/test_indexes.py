@@ -0,0 +1,118 @@
+import datetime
+
+import pytest
+from ckan import model
+from sqlalchemy import exc, text
+from sqlalchemy.dialects import postgresql
+
+from ckanext.subscribe.model import Frequency, LoginCode, Subscription
+
+
+def _seed(n=500):
+    now = datetime.datetime.now()
+    model.Session.execute(
+        Subscription.__table__.insert().values(
+            [
+                dict(
+                    id=f"sub-{i}",
+                    email=f"user{i % 100}@example.com",
+                    object_type="dataset",
+                    object_id=f"dataset-{i}",
+                    verified=bool(i % 2),
+                    verification_code=f"verification-code-{i}",
+                    created=now,
+                    frequency=Frequency.IMMEDIATE.value + i % 3,
+                )
+                for i in range(n)
+            ]
+        )
+    )
+    model.Session.execute(
+        LoginCode.__table__.insert().values(
+            [
+                dict(
+                    id=f"login-{i}",
+                    email=f"user{i % 100}@example.com",
+                    code=f"login-code-{i}",
+                    expires=now,
+                )
+                for i in range(n)
+            ]
+        )
+    )
+    model.Session.commit()
+    model.Session.execute(text("ANALYZE subscription"))
+    model.Session.execute(text("ANALYZE subscribe_login_code"))
+
+
+def _explain(query):
+    # the seeded tables are still small enough that the planner may prefer to
+    # scan them, so check that it *can* use an index
+    model.Session.execute(text("SET LOCAL enable_seqscan = off"))
+    sql = query.statement.compile(
+        dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True}
+    )
+    return "\n".join(row[0] for row in model.Session.execute(text(f"EXPLAIN {sql}")))
+
+
+@pytest.mark.ckan_config("ckan.plugins", "subscribe activity")
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+class TestIndexes(object):
+    def setup_method(self):
+        _seed()
+
+    def teardown_method(self):
+        model.Session.rollback()
+
+    def test_poll_by_frequency(self):
+        plan = _explain(
+            model.Session.query(Subscription)
+            .filter(Subscription.verified.is_(True))
+            .filter(Subscription.frequency == Frequency.DAILY.value)
+        )
+
+        assert "subscription_frequency_verified_idx" in plan
+
+    def test_lookup_by_email(self):
+        plan = _explain(
+            model.Session.query(Subscription).filter_by(email="user1@example.com")
+        )
+
+        assert "subscription_email_object_idx" in plan
+
+    def test_lookup_by_email_and_object(self):
+        plan = _explain(
+            model.Session.query(Subscription)
+            .filter_by(email="user1@example.com")
+            .filter_by(object_type="dataset")
+            .filter_by(object_id="dataset-1")
+        )
+
+        assert "subscription_email_object_idx" in plan
+
+    def test_lookup_by_verification_code(self):
+        plan = _explain(
+            model.Session.query(Subscription).filter_by(
+                verification_code="verification-code-1"
+            )
+        )
+
+        assert "subscription_verification_code_idx" in plan
+
+    def test_lookup_by_login_code(self):
+        plan = _explain(model.Session.query(LoginCode).filter_by(code="login-code-1"))
+
+        assert "subscribe_login_code_code_idx" in plan
+
+    def test_one_subscription_per_email_and_object(self):
+        model.Session.add(
+            Subscription(
+                email="user1@example.com",
+                object_type="dataset",
+                object_id="dataset-1",
+                frequency=Frequency.IMMEDIATE.value,
+            )
+        )
+
+        with pytest.raises(exc.IntegrityError):
+            model.Session.commit()
@@ -0,0 +1,198 @@
+import pickle
+import smtplib
+
+import mock
+import pytest
+from ckan.lib.mailer import MailerException
+
+from ckanext.subscribe import mailer
+
+
+def _send(n=1):
+    for i in range(n):
+        mailer.mail_recipient(
+            recipient_name=f"user{i}@example.com",
+            recipient_email=f"user{i}@example.com",
+            subject="Subject",
+            body="Body",
+        )
+
+
+def _sendmail(connection, n=1):
+    for i in range(n):
+        connection.sendmail("ckan@example.com", f"user{i}@example.com", "Message")
+
+
+@pytest.mark.ckan_config("ckan.plugins", "subscribe activity")
+@pytest.mark.usefixtures("with_plugins")
+class TestSMTPConnection(object):
+    @mock.patch("ckanext.subscribe.mailer.smtplib.SMTP")
+    def test_without_a_pool_connects_for_each_email(self, SMTP):
+        _send(3)
+
+        assert SMTP.call_count == 3
+        assert SMTP.return_value.sendmail.call_count == 3
+        assert SMTP.return_value.quit.call_count == 3
+
+    @mock.patch("ckanext.subscribe.mailer.smtplib.SMTP")
+    def test_reuses_the_connection(self, SMTP):
+        connection = mailer.SMTPConnection()
+        _sendmail(connection, 3)
+        connection.close()
+
+        assert SMTP.call_count == 1
+        assert SMTP.return_value.sendmail.call_count == 3
+        SMTP.return_value.quit.assert_called_once()
+
+    @mock.patch("ckanext.subscribe.mailer.smtplib.SMTP")
+    def test_with_no_emails_does_not_connect(self, SMTP):
+        mailer.SMTPConnection().close()
+
+        SMTP.assert_not_called()
+
+    @mock.patch("ckanext.subscribe.mailer.smtplib.SMTP")
+    def test_reconnects_after_max_messages(self, SMTP):
+        _sendmail(mailer.SMTPConnection(max_messages=2), 5)
+
+        assert SMTP.call_count == 3
+        assert SMTP.return_value.sendmail.call_count == 5
+
+    @pytest.mark.ckan_config("ckanext.subscribe.smtp_max_messages_per_connection", "2")
+    @mock.patch("ckanext.subscribe.mailer.smtplib.SMTP")
+    def test_max_messages_config(self, SMTP):
+        _sendmail(mailer.SMTPConnection(), 3)
+
+        assert SMTP.call_count == 2
+
+    @mock.patch("ckanext.subscribe.mailer.smtplib.SMTP")
+    def test_reconnects_when_server_disconnects(self, SMTP):
+        SMTP.return_value.sendmail.side_effect = [
+            None,
+            smtplib.SMTPServerDisconnected("Connection unexpectedly closed"),
+            None,
+            None,
+        ]
+
+        _sendmail(mailer.SMTPConnection(), 3)
+
+        assert SMTP.call_count == 2
+        assert SMTP.return_value.sendmail.call_count == 4
+
+    @mock.patch("ckanext.subscribe.mailer.smtplib.SMTP")
+    def test_gives_up_if_reconnecting_doesnt_help(self, SMTP):
+        SMTP.return_value.sendmail.side_effect = smtplib.SMTPServerDisconnected(
+            "Connection unexpectedly closed"
+        )
+
+        with pytest.raises(MailerException):
+            _sendmail(mailer.SMTPConnection())
+
+    @mock.patch("ckanext.subscribe.mailer.smtplib.SMTP")
+    def test_broken_connection_is_closed(self, SMTP):
+        SMTP.return_value.sendmail.side_effect = [
+            ConnectionResetError("Connection reset by peer"),
+            None,
+        ]
+        connection = mailer.SMTPConnection()
+
+        with pytest.raises(MailerException):
+            _sendmail(connection)
+        SMTP.return_value.close.assert_called_once()
+        _sendmail(connection)
+
+        assert SMTP.call_count == 2
+
+
+@pytest.mark.ckan_config("ckan.plugins", "subscribe activity")
+@pytest.mark.usefixtures("with_plugins")
+class TestDeliveryPool(object):
+    @mock.patch("ckanext.subscribe.mailer.smtplib.SMTP")
+    def test_single_worker(self, SMTP):
+        with mailer.DeliveryPool(workers=1) as pool:
+            _send(3)
+
+        assert SMTP.call_count == 1
+        assert SMTP.return_value.sendmail.call_count == 3
+        assert pool.report.sent == 3
+        assert pool.report.failed == []
+
+    @mock.patch("ckanext.subscribe.mailer.smtplib.SMTP")
+    def test_several_workers(self, SMTP):
+        with mailer.DeliveryPool(workers=3) as pool:
+            _send(20)
+
+        # each worker thread has its own connection
+        assert 1 <= SMTP.call_count <= 3
+        assert SMTP.return_value.sendmail.call_count == 20
+        assert SMTP.return_value.quit.call_count == SMTP.call_count
+        assert pool.report.sent == 20
+
+    @pytest.mark.ckan_config("ckanext.subscribe.delivery_workers", "2")
+    def test_workers_config(self):
+        pool = mailer.DeliveryPool()
+
+        assert pool.workers == 2
+
+    @pytest.mark.parametrize("workers", [1, 3])
+    @mock.patch("ckanext.subscribe.mailer.smtplib.SMTP")
+    def test_a_failing_mailbox_doesnt_stop_the_others(self, SMTP, workers):
+        def sendmail(mail_from, recipients, msg):
+            if recipients == ["user2@example.com"]:
+                raise smtplib.SMTPRecipientsRefused(
+                    {"user2@example.com": (550, b"No such user")}
+                )
+
+        SMTP.return_value.sendmail.side_effect = sendmail
+
+        with mailer.DeliveryPool(workers=workers) as pool:
+            _send(5)
+
+        assert pool.report.sent == 4
+        assert pool.report.failed == ["user2@example.com"]
+        assert "4 emails sent, 1 failed" in str(pool.report)
+
+    @pytest.mark.parametrize("workers", [1, 3])
+    @mock.patch("ckanext.subscribe.mailer.smtplib.SMTP")
+    def test_an_unexpected_error_is_a_failure(self, SMTP, workers):
+        def sendmail(mail_from, recipients, msg):
+            if recipients == ["user2@example.com"]:
+                raise ValueError("Unexpected")
+
+        SMTP.return_value.sendmail.side_effect = sendmail
+        results = []
+
+        with mailer.DeliveryPool(workers=workers) as pool:
+            for i in range(5):
+                pool.submit_string(
+                    "Body", "from@example.com", f"user{i}@example.com", results.append
+                )
+
+        assert pool.report.sent == 4
+        assert pool.report.failed == ["user2@example.com"]
+        assert len(results) == 5
+        assert len([e for e in results if isinstance(e, MailerException)]) == 1
+
+
+class TestDeliveryReport(object):
+    def test_add(self):
+        report = mailer.DeliveryReport()
+        other = mailer.DeliveryReport()
+        other.start()
+        other.record_success()
+        other.record_failure("user@example.com")
+        other.finish()
+
+        report.add(other)
+
+        assert report.sent == 1
+        assert report.failed == ["user@example.com"]
+        assert report.elapsed == other.elapsed
+
+    def test_pickles(self):
+        report = mailer.DeliveryReport()
+        report.record_success()
+
+        unpickled = pickle.loads(pickle.dumps(report))
+
+        assert unpickled.sent == 1
+        unpickled.record_success()
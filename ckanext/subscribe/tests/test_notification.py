@@ -1,24 +1,33 @@
 import datetime
+import smtplib
+import types
 
 import mock
 import pytest
 from ckan import model
 from ckan.tests.factories import Dataset, Group, Organization
 
+from ckanext.subscribe import email_auth
 from ckanext.subscribe import model as subscribe_model
+from ckanext.subscribe.dictization import dictize_activity
 from ckanext.subscribe.model import Frequency
 from ckanext.subscribe.notification import (
     dictize_notifications,
     get_daily_notifications,
     get_immediate_notifications,
+    get_objects_subscribed_to,
     get_weekly_notifications,
+    iter_notifications,
     most_recent_weekly_notification_datetime,
     send_any_immediate_notifications,
     send_daily_notifications_if_its_time_to,
     send_emails,
+    send_notification_emails,
     send_weekly_notifications_if_its_time_to,
+    stats,
 )
 from ckanext.subscribe.tests import factories
+from ckanext.subscribe.utils import filter_activities
 
 
 @pytest.mark.ckan_config("ckan.plugins", "subscribe activity")
@@ -222,6 +231,135 @@ class TestGetImmediateNotifications(object):
 
         assert _get_activities(notifies) == []
 
+    @mock.patch("ckanext.subscribe.notification.get_objects_subscribed_to")
+    def test_no_activity_skips_working_out_the_subscriptions(
+        self, get_objects_subscribed_to
+    ):
+        runs = stats["immediate_runs"]
+        runs_without_activity = stats["immediate_runs_without_activity"]
+
+        notifies, deletions = get_immediate_notifications()
+
+        assert (notifies, deletions) == ({}, {})
+        get_objects_subscribed_to.assert_not_called()
+        assert stats["immediate_runs"] == runs + 1
+        assert stats["immediate_runs_without_activity"] == runs_without_activity + 1
+
+    def test_activity_is_not_short_circuited(self):
+        dataset = factories.DatasetActivity()
+        factories.Subscription(dataset_id=dataset["id"])
+        runs_without_activity = stats["immediate_runs_without_activity"]
+
+        get_immediate_notifications()
+
+        assert stats["immediate_runs_without_activity"] == runs_without_activity
+
+
+@pytest.mark.ckan_config("ckan.plugins", "subscribe activity")
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+class TestGetObjectsSubscribedTo(object):
+    def test_basic(self):
+        org = Organization()
+        dataset = Dataset(owner_org=org["id"])
+        group = Group()
+        group_dataset = Dataset(groups=[{"id": group["id"]}])
+        subscription = factories.Subscription(dataset_id=dataset["id"])
+        org_subscription = factories.Subscription(organization_id=org["id"])
+        group_subscription = factories.Subscription(group_id=group["id"])
+
+        objects = get_objects_subscribed_to(Frequency.IMMEDIATE.value)
+
+        assert {
+            object_id: sorted(s.id for s in subscriptions)
+            for object_id, subscriptions in objects.items()
+        } == {
+            dataset["id"]: sorted([subscription["id"], org_subscription["id"]]),
+            org["id"]: [org_subscription["id"]],
+            group["id"]: [group_subscription["id"]],
+            group_dataset["id"]: [group_subscription["id"]],
+        }
+
+
+@pytest.mark.ckan_config("ckan.plugins", "subscribe activity")
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+@mock.patch(
+    "ckanext.subscribe.notification.has_custom_implementation",
+    return_value=True,
+)
+class TestGetImmediateNotificationsWithCustomActivities(object):
+    """When a plugin customises ISubscribe.get_activities(), the activities are
+    matched to the subscriptions in Python, rather than in the query."""
+
+    def test_basic(self, has_custom_implementation):
+        dataset = factories.DatasetActivity()
+        _ = factories.DatasetActivity()  # decoy
+        subscription = factories.Subscription(dataset_id=dataset["id"])
+
+        notifies, deletions = get_immediate_notifications()
+
+        assert list(notifies.keys()) == [subscription["email"]]
+        assert _get_activities(notifies) == [
+            ("bob@example.com", "new package", dataset["id"])
+        ]
+        assert deletions == {}
+
+    def test_deletions(self, has_custom_implementation):
+        dataset = factories.DatasetActivity(activity_type="deleted package")
+        factories.Subscription(dataset_id=dataset["id"])
+
+        notifies, deletions = get_immediate_notifications()
+
+        assert notifies == {}
+        assert _get_activities(deletions) == [
+            ("bob@example.com", "deleted package", dataset["id"])
+        ]
+
+    def test_activity_before_the_subscription_is_not_notified(
+        self, has_custom_implementation
+    ):
+        dataset = Dataset()
+        factories.Activity(object_id=dataset["id"], activity_type="changed package")
+        factories.Subscription(
+            dataset_id=dataset["id"], created=datetime.datetime.now()
+        )
+        factories.Activity(object_id=dataset["id"], activity_type="changed package")
+
+        notifies, deletions = get_immediate_notifications()
+
+        assert _get_activities(notifies) == [
+            ("bob@example.com", "changed package", dataset["id"])
+        ]
+
+
+@pytest.mark.ckan_config("ckan.plugins", "subscribe activity")
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+class TestFilterActivities(object):
+    @mock.patch("ckanext.subscribe.utils.ACTIVITY_QUERY_CHUNK_SIZE", 2)
+    def test_object_ids_are_queried_in_chunks(self):
+        datasets = [factories.DatasetActivity() for _ in range(5)]
+        _ = factories.DatasetActivity()  # decoy
+
+        activities = filter_activities(
+            datetime.datetime.now() - datetime.timedelta(hours=1),
+            [dataset["id"] for dataset in datasets],
+        )
+
+        assert isinstance(activities, types.GeneratorType)
+        assert sorted(activity.object_id for activity in activities) == sorted(
+            dataset["id"] for dataset in datasets
+        )
+
+    def test_old_activity_is_not_included(self):
+        dataset = factories.DatasetActivity(
+            timestamp=datetime.datetime.now() - datetime.timedelta(hours=2)
+        )
+
+        activities = filter_activities(
+            datetime.datetime.now() - datetime.timedelta(hours=1), [dataset["id"]]
+        )
+
+        assert list(activities) == []
+
 
 def _create_dataset_and_activity(activity_in_minutes_ago=[]):
     minutes_ago = activity_in_minutes_ago.pop(0)
@@ -531,6 +669,361 @@ class TestSendEmails(object):
         assert "new dataset" in body
 
 
+@pytest.mark.ckan_config("ckan.plugins", "subscribe activity")
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+class TestDictizeActivity(object):
+    def test_only_the_fields_notifications_use(self):
+        dataset, activity = factories.DatasetActivity(return_activity=True)
+
+        activity_dict = dictize_activity(activity)
+
+        assert activity_dict["activity_type"] == "new package"
+        assert activity_dict["object_id"] == dataset["id"]
+        assert activity_dict["timestamp"] == activity.timestamp.isoformat()
+        assert activity_dict["data"] == {
+            "package": {
+                "id": dataset["id"],
+                "name": dataset["name"],
+                "title": dataset["title"],
+            }
+        }
+
+    def test_the_query_fetches_the_same_fields(self):
+        dataset, activity = factories.DatasetActivity(return_activity=True)
+        factories.Subscription(dataset_id=dataset["id"])
+        expected = dictize_activity(activity)
+
+        notifies, deletions = get_immediate_notifications()
+
+        assert notifies["bob@example.com"][0]["activities"] == [expected]
+
+
+@pytest.mark.ckan_config("ckan.plugins", "subscribe activity")
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+class TestIterNotifications(object):
+    def test_one_email_at_a_time_in_order(self):
+        dataset = factories.DatasetActivity()
+        dataset_deleted = factories.DatasetActivity(activity_type="deleted package")
+        factories.Subscription(email="user@b.com", dataset_id=dataset["id"])
+        factories.Subscription(email="user@a.com", dataset_id=dataset["id"])
+        factories.Subscription(email="user@a.com", dataset_id=dataset_deleted["id"])
+
+        notifications = iter_notifications(Frequency.IMMEDIATE.value)
+
+        assert isinstance(notifications, types.GeneratorType)
+        assert [
+            (email, len(email_notifications), len(deletions))
+            for email, email_notifications, deletions in notifications
+        ] == [("user@a.com", 1, 1), ("user@b.com", 1, 0)]
+
+    def test_no_activity(self):
+        factories.Subscription()
+
+        assert list(iter_notifications(Frequency.IMMEDIATE.value)) == []
+
+
+@pytest.mark.ckan_config("ckan.plugins", "subscribe activity")
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+class TestSendNotificationEmails(object):
+    @mock.patch("ckanext.subscribe.notification_email.send_notification_email")
+    def test_sends_as_the_notifications_are_yielded(self, send_notification_email):
+        events = []
+        send_notification_email.side_effect = lambda code, email, *args: events.append(
+            ("sent", email)
+        )
+
+        def notifications():
+            for email in ("user@a.com", "user@b.com"):
+                events.append(("yielded", email))
+                yield email, [{"subscription": {}, "activities": []}], []
+
+        with mock.patch("ckanext.subscribe.notification.SEND_BATCH_SIZE", 1):
+            send_notification_emails(notifications())
+
+        assert events == [
+            ("yielded", "user@a.com"),
+            ("sent", "user@a.com"),
+            ("yielded", "user@b.com"),
+            ("sent", "user@b.com"),
+        ]
+
+    @mock.patch("ckanext.subscribe.notification_email.send_notification_email")
+    def test_one_email_per_deletion(self, send_notification_email):
+        deletions = [{"subscription": {}, "activities": []}] * 2
+
+        send_notification_emails([("bob@example.com", [], deletions)])
+
+        assert [call[0][3] for call in send_notification_email.call_args_list] == [
+            "deletion",
+            "deletion",
+        ]
+
+
+@pytest.mark.ckan_config("ckan.plugins", "subscribe activity")
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+class TestResumableNotificationRuns(object):
+    def _crash_on(self, crash_email):
+        create_codes = email_auth.create_codes
+
+        def create_codes_(emails, commit=True):
+            emails = list(emails)
+            if crash_email in emails:
+                raise Exception("Crashed")
+            return create_codes(emails, commit=commit)
+
+        return create_codes_
+
+    def test_resumes_after_the_emails_already_sent(self):
+        dataset = factories.DatasetActivity()
+        for email in ("user@a.com", "user@b.com", "user@c.com"):
+            factories.Subscription(email=email, dataset_id=dataset["id"])
+
+        with mock.patch(
+            "ckanext.subscribe.notification_email.send_notification_email"
+        ), mock.patch(
+            "ckanext.subscribe.email_auth.create_codes",
+            side_effect=self._crash_on("user@b.com"),
+        ), mock.patch(
+            "ckanext.subscribe.notification.SEND_BATCH_SIZE", 1
+        ):
+            with pytest.raises(Exception):
+                send_any_immediate_notifications()
+        run = subscribe_model.NotificationRun.get_unfinished(Frequency.IMMEDIATE.value)
+        assert run.get_recipients() == {"user@a.com"}
+        assert (
+            subscribe_model.Subscribe.get_emails_last_sent(Frequency.IMMEDIATE.value)
+            is None
+        )
+
+        with mock.patch(
+            "ckanext.subscribe.notification_email.send_notification_email"
+        ) as send_notification_email:
+            send_any_immediate_notifications()
+
+        assert [call[0][1] for call in send_notification_email.call_args_list] == [
+            "user@b.com",
+            "user@c.com",
+        ]
+        model.Session.refresh(run)
+        assert run.finished
+        assert run.get_recipients() == {"user@a.com", "user@b.com", "user@c.com"}
+        assert (
+            subscribe_model.Subscribe.get_emails_last_sent(Frequency.IMMEDIATE.value)
+            == run.notification_datetime
+        )
+
+    def test_an_email_that_cant_be_sent_doesnt_stop_the_run(self):
+        dataset = factories.DatasetActivity()
+        for email in ("user@a.com", "user@b.com", "user@c.com"):
+            factories.Subscription(email=email, dataset_id=dataset["id"])
+
+        def send_notification_email(code, email, *args):
+            if email == "user@b.com":
+                raise ValueError("Can't render it")
+
+        with mock.patch(
+            "ckanext.subscribe.notification_email.send_notification_email",
+            side_effect=send_notification_email,
+        ) as send_notification_email_:
+            send_any_immediate_notifications()
+
+        assert send_notification_email_.call_count == 3
+        run = model.Session.query(subscribe_model.NotificationRun).one()
+        assert run.finished
+        assert dict(
+            model.Session.query(
+                subscribe_model.NotificationRunRecipient.email,
+                subscribe_model.NotificationRunRecipient.status,
+            ).filter_by(run_id=run.id)
+        ) == {"user@a.com": "sent", "user@b.com": "failed", "user@c.com": "sent"}
+
+    @mock.patch("ckanext.subscribe.notification_email.send_notification_email")
+    def test_resumed_run_keeps_its_window(self, send_notification_email):
+        dataset = factories.DatasetActivity()
+        factories.Subscription(email="user@a.com", dataset_id=dataset["id"])
+        run = subscribe_model.NotificationRun(
+            frequency=Frequency.IMMEDIATE.value,
+            include_activity_from=datetime.datetime.now() - datetime.timedelta(hours=1),
+            notification_datetime=datetime.datetime.now()
+            - datetime.timedelta(minutes=1),
+        )
+        model.Session.add(run)
+        model.Session.commit()
+
+        send_any_immediate_notifications()
+
+        # the activity is after the run's window, so is left for the next run
+        send_notification_email.assert_not_called()
+        assert (
+            subscribe_model.Subscribe.get_emails_last_sent(Frequency.IMMEDIATE.value)
+            == run.notification_datetime
+        )
+
+    @mock.patch("ckanext.subscribe.notification_email.send_notification_email")
+    def test_no_run_is_recorded_without_activity(self, send_notification_email):
+        factories.Subscription()
+
+        send_any_immediate_notifications()
+
+        assert model.Session.query(subscribe_model.NotificationRun).count() == 0
+        assert time_since_emails_last_sent(
+            Frequency.IMMEDIATE.value
+        ) < datetime.timedelta(seconds=1)
+
+
+@pytest.mark.ckan_config("ckan.plugins", "subscribe activity")
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+class TestSubscriptionWatermarks(object):
+    def _last_notified_at(self):
+        return dict(
+            model.Session.query(
+                subscribe_model.Subscription.email,
+                subscribe_model.Subscription.last_notified_at,
+            )
+        )
+
+    @mock.patch("ckanext.subscribe.notification_email.send_notification_email")
+    def test_run_advances_the_watermarks(self, send_notification_email):
+        dataset = factories.DatasetActivity()
+        factories.Subscription(email="user@a.com", dataset_id=dataset["id"])
+        factories.Subscription(email="user@b.com", dataset_id=Dataset()["id"])
+
+        send_any_immediate_notifications()
+
+        emails_last_sent = subscribe_model.Subscribe.get_emails_last_sent(
+            Frequency.IMMEDIATE.value
+        )
+        assert self._last_notified_at() == {
+            "user@a.com": emails_last_sent,
+            "user@b.com": emails_last_sent,
+        }
+        # and the activity isn't notified again
+        assert get_immediate_notifications() == ({}, {})
+
+    @mock.patch("ckanext.subscribe.email_verification.send_request_email")
+    @mock.patch("ckanext.subscribe.notification_email.send_notification_email")
+    def test_unverified_subscription_isnt_advanced(
+        self, send_notification_email, send_request_email
+    ):
+        dataset = factories.DatasetActivity()
+        factories.Subscription(email="user@a.com", dataset_id=dataset["id"])
+        factories.Subscription(
+            email="user@b.com", dataset_id=dataset["id"], skip_verification=False
+        )
+
+        send_any_immediate_notifications()
+
+        assert self._last_notified_at()["user@b.com"] is None
+
+    @mock.patch("ckanext.subscribe.mailer.smtplib.SMTP")
+    def test_failed_recipient_is_notified_next_time(self, SMTP):
+        def sendmail(mail_from, recipients, msg):
+            if recipients == ["user@b.com"]:
+                raise smtplib.SMTPRecipientsRefused(
+                    {"user@b.com": (550, b"Mailbox full")}
+                )
+
+        SMTP.return_value.sendmail.side_effect = sendmail
+        dataset = factories.DatasetActivity()
+        factories.Subscription(email="user@a.com", dataset_id=dataset["id"])
+        factories.Subscription(email="user@b.com", dataset_id=dataset["id"])
+
+        send_any_immediate_notifications()
+
+        run = model.Session.query(subscribe_model.NotificationRun).one()
+        assert self._last_notified_at() == {
+            "user@a.com": run.notification_datetime,
+            "user@b.com": run.include_activity_from,
+        }
+        # once it is due to be retried
+        self._retry_now("user@b.com")
+        notifies, deletions = get_immediate_notifications()
+        assert list(notifies) == ["user@b.com"]
+
+    def _retry_now(self, email):
+        model.Session.query(subscribe_model.Subscription).filter_by(email=email).update(
+            {"retry_after": datetime.datetime.now()}
+        )
+        model.Session.commit()
+
+    @mock.patch("ckanext.subscribe.mailer.smtplib.SMTP")
+    def test_failed_recipient_backs_off(self, SMTP):
+        refuse = {"user@b.com"}
+
+        def sendmail(mail_from, recipients, msg):
+            if recipients[0] in refuse:
+                raise smtplib.SMTPRecipientsRefused(
+                    {recipients[0]: (550, b"No such user")}
+                )
+
+        SMTP.return_value.sendmail.side_effect = sendmail
+        dataset = factories.DatasetActivity()
+        factories.Subscription(email="user@a.com", dataset_id=dataset["id"])
+        factories.Subscription(email="user@b.com", dataset_id=dataset["id"])
+
+        def subscription_b():
+            return (
+                model.Session.query(subscribe_model.Subscription)
+                .filter_by(email="user@b.com")
+                .one()
+            )
+
+        def latest_run():
+            return (
+                model.Session.query(subscribe_model.NotificationRun)
+                .order_by(subscribe_model.NotificationRun.started.desc())
+                .first()
+            )
+
+        send_any_immediate_notifications()
+
+        run = latest_run()
+        assert subscription_b().failed_attempts == 1
+        assert (
+            subscription_b().retry_after
+            == run.notification_datetime + subscribe_model.RETRY_MIN
+        )
+
+        # until it is due, it doesn't start a run
+        send_any_immediate_notifications()
+
+        assert model.Session.query(subscribe_model.NotificationRun).count() == 1
+
+        # it waits twice as long after failing again
+        self._retry_now("user@b.com")
+        send_any_immediate_notifications()
+
+        run = latest_run()
+        assert subscription_b().failed_attempts == 2
+        assert (
+            subscription_b().retry_after
+            == run.notification_datetime + 2 * subscribe_model.RETRY_MIN
+        )
+
+        # and is back to normal once it is sent
+        refuse.clear()
+        self._retry_now("user@b.com")
+        send_any_immediate_notifications()
+
+        run = latest_run()
+        assert subscription_b().failed_attempts == 0
+        assert subscription_b().retry_after is None
+        assert subscription_b().last_notified_at == run.notification_datetime
+
+    @mock.patch("ckanext.subscribe.notification_email.send_notification_email")
+    def test_changing_frequency_doesnt_notify_again(self, send_notification_email):
+        dataset = factories.DatasetActivity()
+        subscription = factories.Subscription(
+            dataset_id=dataset["id"], return_object=True
+        )
+        send_any_immediate_notifications()
+
+        subscription.frequency = Frequency.DAILY.value
+        model.Session.commit()
+
+        assert get_daily_notifications() == ({}, {})
+
+
 def time_since_emails_last_sent(frequency):
     return datetime.datetime.now() - subscribe_model.Subscribe.get_emails_last_sent(
         frequency
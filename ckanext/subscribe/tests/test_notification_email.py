@@ -5,18 +5,24 @@ import mock
 import pytest
 from ckan import model
 from ckan.lib.helpers import literal
+from ckan.tests import helpers
 
 from ckanext.activity.model import activity as model_activity
 from ckanext.subscribe import model as subscribe_model
+from ckanext.subscribe import notification_email
 from ckanext.subscribe.notification import dictize_notifications
 from ckanext.subscribe.notification_email import (
     dataset_href_from_activity,
     dataset_link_from_activity,
     get_notification_email_vars,
+    render_cache,
     send_notification_email,
 )
 from ckanext.subscribe.tests import factories
-from ckanext.subscribe.utils import get_notification_email_contents
+from ckanext.subscribe.utils import (
+    get_email_template_environment,
+    get_notification_email_contents,
+)
 
 
 @pytest.mark.ckan_config("ckan.plugins", "subscribe activity")
@@ -53,6 +59,59 @@ class TestSendNotificationEmail(object):
         assert "new dataset" in body
 
 
+def _dataset_notifications():
+    dataset, activity = factories.DatasetActivity(
+        timestamp=datetime.datetime.now() - datetime.timedelta(minutes=10),
+        return_activity=True,
+    )
+    subscription_activities = {
+        factories.Subscription(dataset_id=dataset["id"], return_object=True): [activity]
+    }
+    return dictize_notifications(subscription_activities)
+
+
+@pytest.mark.ckan_config("ckan.plugins", "subscribe activity")
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+class TestRenderCache(object):
+    @mock.patch(
+        "ckanext.subscribe.notification_email.render_notification_email",
+        wraps=notification_email.render_notification_email,
+    )
+    @mock.patch("ckanext.subscribe.mailer.mail_recipient")
+    def test_same_notifications_rendered_once(
+        self, mail_recipient, render_notification_email
+    ):
+        notifications = _dataset_notifications()
+
+        with render_cache() as cache:
+            send_notification_email("code-a", "a@example.com", notifications)
+            send_notification_email("code-b", "b@example.com", notifications)
+
+        render_notification_email.assert_called_once()
+        assert (cache.hits, cache.misses) == (1, 1)
+        for (code, email), call in zip(
+            [("code-a", "a@example.com"), ("code-b", "b@example.com")],
+            mail_recipient.call_args_list,
+        ):
+            assert call[1]["recipient_email"] == email
+            for body in (call[1]["body"], call[1]["body_html"]):
+                assert f"/subscribe/manage?code={code}" in body
+                assert "Placeholder" not in body
+
+    @mock.patch("ckanext.subscribe.mailer.mail_recipient")
+    def test_different_notifications_rendered_separately(self, mail_recipient):
+        with render_cache() as cache:
+            send_notification_email("code", "a@example.com", _dataset_notifications())
+            send_notification_email("code", "a@example.com", _dataset_notifications())
+
+        assert (cache.hits, cache.misses) == (0, 2)
+
+    @pytest.mark.ckan_config("ckanext.subscribe.render_cache", "false")
+    def test_disabled_by_config(self):
+        with render_cache() as cache:
+            assert cache is None
+
+
 @pytest.mark.ckan_config("ckan.plugins", "subscribe activity")
 @pytest.mark.usefixtures("with_plugins", "clean_db")
 class TestGetNotificationEmailContents(object):
@@ -103,6 +162,37 @@ class TestGetNotificationEmailContents(object):
             f"Test Dataset</a>" in email[2],
         )
 
+    def test_templates_are_compiled_once(self):
+        environment = get_email_template_environment()
+
+        assert get_email_template_environment() is environment
+        assert environment.get_template("notification.html") is (
+            environment.get_template("notification.html")
+        )
+
+    def test_template_overridden_from_directory(self, tmp_path):
+        (tmp_path / "notification.txt").write_text(
+            "{{ notifications|length }} changes for {{ email }}"
+        )
+        email_vars = {
+            "site_title": "CKAN",
+            "email": "bob@example.com",
+            "notifications": [],
+            "html_footer": "",
+            "plain_text_footer": "",
+        }
+
+        with helpers.changed_config(
+            "ckanext.subscribe.email_templates_directory", str(tmp_path)
+        ):
+            subject, plain_text_body, html_body = get_notification_email_contents(
+                email_vars
+            )
+
+        assert plain_text_body == "0 changes for bob@example.com"
+        # the html template isn't overridden, so is the default one
+        assert "Changes have occurred" in html_body
+
 
 @pytest.mark.ckan_config("ckan.plugins", "subscribe activity")
 @pytest.mark.usefixtures("with_plugins", "clean_db")
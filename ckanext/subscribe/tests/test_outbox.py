@@ -0,0 +1,123 @@
+import datetime
+import smtplib
+
+import mock
+import pytest
+from ckan import model
+
+from ckanext.subscribe import mailer, outbox
+from ckanext.subscribe.model import OutboxEmail
+from ckanext.subscribe.notification import send_any_immediate_notifications
+from ckanext.subscribe.tests import factories
+
+
+def _send(n=1):
+    for i in range(n):
+        mailer.mail_recipient(
+            recipient_name=f"user{i}@example.com",
+            recipient_email=f"user{i}@example.com",
+            subject="Subject",
+            body="Body",
+        )
+
+
+def _queue(n=1):
+    with outbox.OutboxWriter():
+        _send(n)
+    model.Session.commit()
+
+
+def _refuse(mail_from, recipients, msg):
+    raise smtplib.SMTPRecipientsRefused({recipients[0]: (550, b"No such user")})
+
+
+@pytest.mark.ckan_config("ckan.plugins", "subscribe activity")
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+class TestOutboxWriter(object):
+    @mock.patch("ckanext.subscribe.mailer.smtplib.SMTP")
+    def test_queues_rather_than_sends(self, SMTP):
+        with outbox.OutboxWriter(batch_size=2) as writer:
+            _send(3)
+        model.Session.commit()
+
+        SMTP.assert_not_called()
+        assert writer.report.queued == 3
+        emails = model.Session.query(OutboxEmail).order_by(OutboxEmail.recipient_email)
+        assert [email.recipient_email for email in emails] == [
+            "user0@example.com",
+            "user1@example.com",
+            "user2@example.com",
+        ]
+        assert {email.status for email in emails} == {"pending"}
+        assert "Subject: " in emails[0].message
+
+    @pytest.mark.ckan_config("ckanext.subscribe.outbox", "true")
+    @mock.patch("ckanext.subscribe.mailer.smtplib.SMTP")
+    def test_notification_run_queues_the_emails(self, SMTP):
+        dataset = factories.DatasetActivity()
+        factories.Subscription(dataset_id=dataset["id"], email="bob@example.com")
+
+        send_any_immediate_notifications()
+
+        SMTP.assert_not_called()
+        email = model.Session.query(OutboxEmail).one()
+        assert email.recipient_email == "bob@example.com"
+        assert email.status == "pending"
+
+
+@pytest.mark.ckan_config("ckan.plugins", "subscribe activity")
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+class TestDeliver(object):
+    @mock.patch("ckanext.subscribe.mailer.smtplib.SMTP")
+    def test_delivers_the_queued_emails(self, SMTP):
+        _queue(3)
+
+        report = outbox.deliver(batch_size=2)
+
+        assert report.sent == 3
+        assert SMTP.return_value.sendmail.call_count == 3
+        emails = model.Session.query(OutboxEmail).all()
+        assert {email.status for email in emails} == {"sent"}
+        assert all(email.attempts == 1 for email in emails)
+
+    @mock.patch("ckanext.subscribe.mailer.smtplib.SMTP")
+    def test_sent_emails_are_not_delivered_again(self, SMTP):
+        _queue(2)
+
+        outbox.deliver()
+        outbox.deliver()
+
+        assert SMTP.return_value.sendmail.call_count == 2
+
+    @mock.patch("ckanext.subscribe.mailer.smtplib.SMTP")
+    def test_failure_is_retried_later(self, SMTP):
+        SMTP.return_value.sendmail.side_effect = _refuse
+        _queue(1)
+
+        report = outbox.deliver()
+
+        assert report.failed == ["user0@example.com"]
+        email = model.Session.query(OutboxEmail).one()
+        assert email.status == "pending"
+        assert email.attempts == 1
+        assert email.next_attempt > datetime.datetime.utcnow()
+        assert "No such user" in email.last_error
+        # not due yet
+        assert outbox.deliver().count == 0
+
+    @mock.patch("ckanext.subscribe.mailer.smtplib.SMTP")
+    def test_gives_up_after_max_attempts(self, SMTP):
+        SMTP.return_value.sendmail.side_effect = _refuse
+        _queue(1)
+
+        for attempt in range(2):
+            outbox.deliver(max_attempts=2)
+            model.Session.query(OutboxEmail).update(
+                {"next_attempt": datetime.datetime.utcnow()}
+            )
+            model.Session.commit()
+
+        email = model.Session.query(OutboxEmail).one()
+        assert email.status == "failed"
+        assert email.attempts == 2
+        assert outbox.deliver(max_attempts=2).count == 0
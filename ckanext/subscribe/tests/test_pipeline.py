@@ -0,0 +1,62 @@
+import mock
+import pytest
+from ckan import plugins as p
+
+from ckanext.subscribe import pipeline
+from ckanext.subscribe.interfaces import ISubscribe
+
+
+def _get_email_vars():
+    email_vars = {}
+    for get_email_vars in pipeline.hooks("get_email_vars"):
+        email_vars = get_email_vars(
+            code="the-code", email="bob@example.com", email_vars=email_vars
+        )
+    return email_vars
+
+
+@pytest.mark.ckan_config("ckan.plugins", "subscribe activity")
+@pytest.mark.usefixtures("with_plugins")
+class TestHookPipeline(object):
+    def test_plugins_looked_up_once_per_pipeline(self):
+        with mock.patch(
+            "ckanext.subscribe.pipeline.p.PluginImplementations",
+            wraps=p.PluginImplementations,
+        ) as PluginImplementations:
+            with pipeline.hook_pipeline():
+                _get_email_vars()
+                _get_email_vars()
+
+        PluginImplementations.assert_called_once_with(ISubscribe)
+
+    def test_plugins_looked_up_each_time_without_a_pipeline(self):
+        with mock.patch(
+            "ckanext.subscribe.pipeline.p.PluginImplementations",
+            wraps=p.PluginImplementations,
+        ) as PluginImplementations:
+            _get_email_vars()
+            _get_email_vars()
+
+        assert PluginImplementations.call_count == 2
+
+    def test_chains_the_hooks(self):
+        with pipeline.hook_pipeline():
+            email_vars = _get_email_vars()
+
+        assert email_vars["email"] == "bob@example.com"
+        assert "code=the-code" in email_vars["manage_link"]
+
+    def test_time_in_each_plugin_is_counted(self):
+        calls_before = sum(
+            count
+            for key, count in pipeline.calls.items()
+            if key.endswith(".get_email_vars")
+        )
+
+        with pipeline.hook_pipeline():
+            _get_email_vars()
+
+        keys = [key for key in pipeline.calls if key.endswith(".get_email_vars")]
+        assert keys
+        assert sum(pipeline.calls[key] for key in keys) == calls_before + 1
+        assert all(pipeline.timings[key] > 0 for key in keys)
@@ -0,0 +1,133 @@
+import datetime
+
+import mock
+import pytest
+from ckan import model
+from ckan.tests import helpers
+
+from ckanext.subscribe import purge
+from ckanext.subscribe.model import (
+    Frequency,
+    LoginCode,
+    NotificationRun,
+    NotificationRunRecipient,
+    OutboxEmail,
+    Subscription,
+)
+from ckanext.subscribe.tests.factories import SubscriptionLowLevel
+
+
+def _login_code(expires):
+    model.Session.add(LoginCode(email="bob@example.com", code="code", expires=expires))
+    model.Session.commit()
+
+
+@pytest.mark.ckan_config("ckan.plugins", "subscribe activity")
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+class TestPurge(object):
+    def test_expired_login_codes(self):
+        now = datetime.datetime.now()
+        for i in range(5):
+            _login_code(now - datetime.timedelta(hours=i + 1))
+        _login_code(now + datetime.timedelta(hours=1))
+
+        purged = purge.purge(batch_size=2)
+
+        assert purged["login_codes"] == 5
+        assert model.Session.query(LoginCode).count() == 1
+
+    def test_expired_verification_codes(self):
+        now = datetime.datetime.now()
+        expired = SubscriptionLowLevel(
+            verified=True,
+            verification_code="expired",
+            verification_code_expires=now - datetime.timedelta(hours=1),
+            created=now,
+        )
+        current = SubscriptionLowLevel(
+            email="alice@example.com",
+            verification_code="current",
+            verification_code_expires=now + datetime.timedelta(hours=1),
+            created=now,
+        )
+
+        purged = purge.purge()
+
+        assert purged["verification_codes"] == 1
+        assert Subscription.get(expired["id"]).verification_code is None
+        assert Subscription.get(current["id"]).verification_code == "current"
+
+    def test_stale_unverified_subscriptions(self):
+        now = datetime.datetime.now()
+        stale = SubscriptionLowLevel(
+            verified=False,
+            verification_code_expires=now - datetime.timedelta(days=40),
+            created=now - datetime.timedelta(days=40),
+        )
+        recent = SubscriptionLowLevel(
+            email="alice@example.com",
+            verified=False,
+            verification_code_expires=now - datetime.timedelta(days=1),
+            created=now - datetime.timedelta(days=1),
+        )
+        verified = SubscriptionLowLevel(
+            email="carol@example.com",
+            verified=True,
+            created=now - datetime.timedelta(days=40),
+        )
+
+        purged = purge.purge()
+
+        assert purged["unverified_subscriptions"] == 1
+        assert Subscription.get(stale["id"]) is None
+        assert Subscription.get(recent["id"])
+        assert Subscription.get(verified["id"])
+
+    def test_old_history(self):
+        old = datetime.datetime.utcnow() - datetime.timedelta(days=40)
+        for finished in (old, datetime.datetime.utcnow()):
+            run = NotificationRun(
+                frequency=Frequency.IMMEDIATE.value,
+                include_activity_from=finished,
+                notification_datetime=finished,
+                finished=finished,
+            )
+            model.Session.add(run)
+            model.Session.flush()
+            run.record_recipients(["bob@example.com", "alice@example.com"])
+            model.Session.add(
+                OutboxEmail(
+                    recipient_email="bob@example.com",
+                    message="message",
+                    status="sent",
+                    created=finished,
+                )
+            )
+        model.Session.commit()
+
+        purged = purge.purge(batch_size=1)
+
+        assert purged["runs"] == 1
+        assert purged["run_recipients"] == 2
+        assert purged["outbox_emails"] == 1
+        assert model.Session.query(NotificationRun).count() == 1
+        assert model.Session.query(NotificationRunRecipient).count() == 2
+        assert model.Session.query(OutboxEmail).count() == 1
+
+    def test_nothing_to_purge(self):
+        assert purge.purge() == {}
+
+    @mock.patch("ckanext.subscribe.purge.purge")
+    def test_after_notifications(self, purge_):
+        with helpers.changed_config(
+            "ckanext.subscribe.purge_after_notifications", "true"
+        ):
+            helpers.call_action("subscribe_send_any_notifications")
+
+        purge_.assert_called_once()
+
+    @mock.patch("ckanext.subscribe.purge.purge")
+    def test_not_after_notifications_by_default(self, purge_):
+        helpers.call_action("subscribe_send_any_notifications")
+
+        purge_.assert_not_called()
@@ -0,0 +1,219 @@
+import datetime
+
+import mock
+import pytest
+from ckan import model
+from sqlalchemy import func, select
+
+from ckanext.subscribe import locks, notification, pipeline
+from ckanext.subscribe.model import Frequency, Subscribe
+from ckanext.subscribe.notification import (
+    most_recent_daily_notification_datetime,
+    most_recent_weekly_notification_datetime,
+)
+from ckanext.subscribe.scheduler import Scheduler
+
+
+def _run_once(scheduler):
+    # stop after the first round of sending
+    with mock.patch.object(
+        Scheduler, "_sleep_until", side_effect=lambda until: scheduler.stop()
+    ), mock.patch.object(
+        Scheduler, "_sleep", side_effect=lambda seconds: scheduler.stop()
+    ):
+        scheduler.run()
+
+
+def _terminate(lock):
+    # as if the database dropped the lock's connection
+    pid = lock._connection.execute(select(func.pg_backend_pid())).scalar()
+    model.Session.execute(select(func.pg_terminate_backend(pid)))
+    model.Session.commit()
+
+
+@pytest.mark.ckan_config("ckan.plugins", "subscribe activity")
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+class TestScheduler(object):
+    def test_missed_notifications_are_due_straight_away(self):
+        now = datetime.datetime.now()
+
+        next_due = Scheduler().work_out_next_due(now)
+
+        assert next_due == {
+            Frequency.IMMEDIATE.value: now,
+            Frequency.DAILY.value: now,
+            Frequency.WEEKLY.value: now,
+        }
+
+    def test_daily_and_weekly_are_due_at_their_next_time(self):
+        now = datetime.datetime.now()
+        for frequency in (Frequency.DAILY.value, Frequency.WEEKLY.value):
+            Subscribe.set_emails_last_sent(frequency=frequency, emails_last_sent=now)
+        model.Session.commit()
+
+        next_due = Scheduler().work_out_next_due(now)
+
+        assert next_due[Frequency.DAILY.value] == (
+            most_recent_daily_notification_datetime(now).replace(
+                second=0, microsecond=0
+            )
+            + datetime.timedelta(days=1)
+        )
+        assert next_due[Frequency.WEEKLY.value] == (
+            most_recent_weekly_notification_datetime(now).replace(
+                second=0, microsecond=0
+            )
+            + datetime.timedelta(days=7)
+        )
+
+    def test_immediate_is_polled_with_jitter(self):
+        scheduler = Scheduler(immediate_interval=10, jitter=0.1)
+        now = datetime.datetime.now()
+
+        next_due = scheduler._next_due(Frequency.IMMEDIATE.value, now)
+
+        assert (
+            datetime.timedelta(seconds=9)
+            <= next_due - now
+            <= datetime.timedelta(seconds=11)
+        )
+
+    @mock.patch("ckanext.subscribe.notification.send_notifications")
+    def test_run_sends_the_due_notifications(self, send_notifications):
+        scheduler = Scheduler()
+
+        _run_once(scheduler)
+
+        assert [call[0][0] for call in send_notifications.call_args_list] == [
+            Frequency.IMMEDIATE.value,
+            Frequency.DAILY.value,
+            Frequency.WEEKLY.value,
+        ]
+        now = datetime.datetime.now()
+        assert all(due > now for due in scheduler.next_due.values())
+        assert not scheduler.lock.held
+
+    @mock.patch("ckanext.subscribe.notification.send_notifications")
+    def test_failed_run_is_retried_after_the_interval(self, send_notifications):
+        send_notifications.side_effect = Exception("Failed")
+        scheduler = Scheduler(immediate_interval=10)
+        now = datetime.datetime.now()
+        scheduler.next_due = {Frequency.DAILY.value: now}
+
+        scheduler.run_due(now)
+
+        assert scheduler.next_due[Frequency.DAILY.value] == now + datetime.timedelta(
+            seconds=10
+        )
+
+    @mock.patch("ckanext.subscribe.notification.send_notifications")
+    def test_stands_by_while_another_scheduler_sends(self, send_notifications):
+        leader = locks.AdvisoryLock("scheduler")
+        assert leader.acquire()
+        try:
+            _run_once(Scheduler())
+        finally:
+            leader.release()
+
+        send_notifications.assert_not_called()
+
+    @mock.patch("ckanext.subscribe.notification.send_notifications")
+    def test_stands_by_when_its_lock_is_lost(self, send_notifications):
+        scheduler = Scheduler()
+        assert scheduler.lock.acquire()
+        _terminate(scheduler.lock)
+        leader = locks.AdvisoryLock("scheduler")
+        assert leader.acquire()
+        try:
+            _run_once(scheduler)
+        finally:
+            leader.release()
+
+        send_notifications.assert_not_called()
+        assert not scheduler.lock.held
+
+    @mock.patch("ckanext.subscribe.scheduler.log")
+    def test_logs_the_stats_since_it_last_logged_them(self, log):
+        scheduler = Scheduler()
+        notification.stats["immediate_runs"] += 3
+        notification.stats["immediate_runs_without_activity"] += 2
+        pipeline.timings["test.get_email_vars"] += 0.25
+        pipeline.calls["test.get_email_vars"] += 5
+
+        scheduler.log_stats()
+
+        log.info.assert_any_call(
+            "Notification runs: immediate_runs=3, immediate_runs_without_activity=2"
+        )
+        log.info.assert_any_call("ISubscribe hook test.get_email_vars: 5 calls, 0.250s")
+
+        log.info.reset_mock()
+        scheduler.log_stats()
+
+        log.info.assert_called_once_with("Notification runs: none")
+
+    def test_stop(self):
+        scheduler = Scheduler()
+
+        scheduler.stop()
+
+        assert scheduler.stopping
+
+
+@pytest.mark.ckan_config("ckan.plugins", "subscribe activity")
+@pytest.mark.usefixtures("with_plugins")
+class TestAdvisoryLock(object):
+    def test_only_one_holder(self):
+        lock_a = locks.AdvisoryLock("test")
+        lock_b = locks.AdvisoryLock("test")
+
+        try:
+            assert lock_a.acquire()
+            assert not lock_b.acquire()
+            lock_a.release()
+            assert lock_b.acquire()
+        finally:
+            lock_a.release()
+            lock_b.release()
+
+    def test_is_alive(self):
+        lock = locks.AdvisoryLock("test")
+
+        try:
+            assert not lock.is_alive()
+            assert lock.acquire()
+            assert lock.is_alive()
+            _terminate(lock)
+            assert not lock.is_alive()
+            assert not lock.held
+        finally:
+            lock.release()
+
+    def test_shared(self):
+        lock_a = locks.AdvisoryLock("test", shared=True)
+        lock_b = locks.AdvisoryLock("test", shared=True)
+        exclusive = locks.AdvisoryLock("test")
+
+        try:
+            assert lock_a.acquire()
+            assert lock_b.acquire()
+            assert not exclusive.acquire()
+            lock_a.release()
+            lock_b.release()
+            assert exclusive.acquire()
+            assert not lock_a.acquire()
+        finally:
+            lock_a.release()
+            lock_b.release()
+            exclusive.release()
+
+    def test_different_names_dont_conflict(self):
+        lock_a = locks.AdvisoryLock("test-a")
+        lock_b = locks.AdvisoryLock("test-b")
+
+        try:
+            assert lock_a.acquire()
+            assert lock_b.acquire()
+        finally:
+            lock_a.release()
+            lock_b.release()
@@ -0,0 +1,207 @@
+import mock
+import pytest
+from ckan import model
+from ckan.tests import helpers
+from sqlalchemy import literal
+
+from ckanext.subscribe import locks, parallel, shards
+from ckanext.subscribe.model import Frequency, NotificationRun, Subscribe
+from ckanext.subscribe.notification import (
+    get_immediate_notifications,
+    send_any_immediate_notifications,
+    send_notifications,
+)
+from ckanext.subscribe.tests import factories
+
+EMAILS = [f"user{i}@example.com" for i in range(6)]
+
+
+def _send_as_shard(index):
+    with helpers.changed_config("ckanext.subscribe.shards", "2"):
+        with helpers.changed_config("ckanext.subscribe.shard", str(index)):
+            with mock.patch(
+                "ckanext.subscribe.notification_email.send_notification_email"
+            ) as send_notification_email:
+                send_any_immediate_notifications()
+    return {call[0][1] for call in send_notification_email.call_args_list}
+
+
+@pytest.mark.ckan_config("ckan.plugins", "subscribe activity")
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+class TestShards(object):
+    def test_not_sharded_by_default(self):
+        assert shards.get_shard() is None
+
+    def test_shard_out_of_range(self):
+        with helpers.changed_config("ckanext.subscribe.shards", "2"):
+            with helpers.changed_config("ckanext.subscribe.shard", "2"):
+                with pytest.raises(ValueError):
+                    shards.get_shard()
+
+    def test_sql_agrees_with_python(self):
+        shard = shards.Shard(1, 3)
+        for email in EMAILS:
+            in_shard = model.Session.query(
+                shards.shard_clause(literal(email), shard)
+            ).scalar()
+            assert in_shard == shards.in_shard(email, shard)
+
+
+@pytest.mark.ckan_config("ckan.plugins", "subscribe activity")
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+class TestShardedNotificationRuns(object):
+    def test_shards_share_a_run(self):
+        dataset = factories.DatasetActivity()
+        for email in EMAILS:
+            factories.Subscription(email=email, dataset_id=dataset["id"])
+
+        sent = _send_as_shard(0)
+
+        assert sent == {
+            email for email in EMAILS if shards.in_shard(email, shards.Shard(0, 2))
+        }
+        run = NotificationRun.get_unfinished(Frequency.IMMEDIATE.value)
+        assert run.get_shards_done() == {0}
+        assert Subscribe.get_emails_last_sent(Frequency.IMMEDIATE.value) is None
+
+        # its share is done, so it waits for the other shard
+        assert _send_as_shard(0) == set()
+
+        sent = _send_as_shard(1)
+
+        assert sent == {
+            email for email in EMAILS if shards.in_shard(email, shards.Shard(1, 2))
+        }
+        model.Session.refresh(run)
+        assert run.finished
+        assert run.get_recipients() == set(EMAILS)
+        assert (
+            Subscribe.get_emails_last_sent(Frequency.IMMEDIATE.value)
+            == run.notification_datetime
+        )
+
+    @mock.patch("ckanext.subscribe.notification_email.send_notification_email")
+    def test_another_process_is_sending(self, send_notification_email):
+        dataset = factories.DatasetActivity()
+        factories.Subscription(dataset_id=dataset["id"])
+        lock = locks.AdvisoryLock(f"notifications:{Frequency.IMMEDIATE.value}")
+        assert lock.acquire()
+        try:
+            send_any_immediate_notifications()
+        finally:
+            lock.release()
+
+        send_notification_email.assert_not_called()
+        assert model.Session.query(NotificationRun).count() == 0
+
+    @pytest.mark.parametrize("lock_shared", [False, True])
+    def test_sharded_and_unsharded_senders_exclude_each_other(self, lock_shared):
+        dataset = factories.DatasetActivity()
+        for email in EMAILS:
+            factories.Subscription(email=email, dataset_id=dataset["id"])
+        # i.e. an unsharded sender, or another shard's worker
+        lock = locks.AdvisoryLock(
+            f"notifications:{Frequency.IMMEDIATE.value}", shared=lock_shared
+        )
+        assert lock.acquire()
+        try:
+            if lock_shared:
+                with mock.patch(
+                    "ckanext.subscribe.notification_email.send_notification_email"
+                ) as send_notification_email:
+                    send_any_immediate_notifications()
+                sent = {call[0][1] for call in send_notification_email.call_args_list}
+            else:
+                sent = _send_as_shard(0)
+        finally:
+            lock.release()
+
+        assert sent == set()
+        assert model.Session.query(NotificationRun).count() == 0
+
+    def test_shard_workers_share_the_lock(self):
+        dataset = factories.DatasetActivity()
+        for email in EMAILS:
+            factories.Subscription(email=email, dataset_id=dataset["id"])
+        other_shard = locks.AdvisoryLock(
+            f"notifications:{Frequency.IMMEDIATE.value}", shared=True
+        )
+        assert other_shard.acquire()
+        try:
+            sent = _send_as_shard(0)
+        finally:
+            other_shard.release()
+
+        assert sent == {
+            email for email in EMAILS if shards.in_shard(email, shards.Shard(0, 2))
+        }
+
+    def test_shards_join_an_event_driven_run_limited_to_its_objects(self):
+        dataset_a = factories.DatasetActivity()
+        dataset_b = factories.DatasetActivity()
+        for email in EMAILS:
+            factories.Subscription(email=email, dataset_id=dataset_a["id"])
+            factories.Subscription(email=email, dataset_id=dataset_b["id"])
+
+        def send(**kwargs):
+            with mock.patch(
+                "ckanext.subscribe.notification_email.send_notification_email"
+            ) as send_notification_email:
+                send_notifications(Frequency.IMMEDIATE.value, **kwargs)
+            return {
+                (call[0][1], notification["subscription"]["object_id"])
+                for call in send_notification_email.call_args_list
+                for notification in call[0][2]
+            }
+
+        # shard 0 is told about the activity on dataset_a, and shard 1 joins
+        # the run as it polls
+        sent = send(object_ids={dataset_a["id"]}, shard=shards.Shard(0, 2))
+        sent |= send(shard=shards.Shard(1, 2))
+
+        assert sent == {(email, dataset_a["id"]) for email in EMAILS}
+        run = model.Session.query(NotificationRun).one()
+        assert run.finished
+        assert run.object_ids == [dataset_a["id"]]
+        assert Subscribe.get_emails_last_sent(Frequency.IMMEDIATE.value) is None
+
+        # and the next full run notifies the rest
+        assert send() == {(email, dataset_b["id"]) for email in EMAILS}
+
+    def test_get_notifications_of_a_shard(self):
+        dataset = factories.DatasetActivity()
+        for email in EMAILS:
+            factories.Subscription(email=email, dataset_id=dataset["id"])
+
+        notifications_by_email = [
+            get_immediate_notifications(shard=shards.Shard(index, 2))[0]
+            for index in range(2)
+        ]
+
+        assert set(notifications_by_email[0]) == {
+            email for email in EMAILS if shards.in_shard(email, shards.Shard(0, 2))
+        }
+        assert set(notifications_by_email[0]) | set(notifications_by_email[1]) == set(
+            EMAILS
+        )
+
+
+@pytest.mark.ckan_config("ckan.plugins", "subscribe activity")
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+class TestParallel(object):
+    @mock.patch("ckanext.subscribe.mailer.smtplib.SMTP")
+    def test_workers_send_a_run_together(self, SMTP):
+        dataset = factories.DatasetActivity()
+        for email in EMAILS:
+            factories.Subscription(email=email, dataset_id=dataset["id"])
+
+        report = parallel.send_any_notifications(2)
+
+        assert report.sent == len(EMAILS)
+        run = (
+            model.Session.query(NotificationRun)
+            .filter_by(frequency=Frequency.IMMEDIATE.value)
+            .one()
+        )
+        assert run.finished
+        assert run.get_shards_done() == {0, 1}
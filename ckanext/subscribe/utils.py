@@ -1,12 +1,68 @@
 # encoding: utf-8
 import ckan.plugins as p
 from ckan import model
-from jinja2 import Template
+from jinja2 import (
+    ChoiceLoader,
+    DictLoader,
+    Environment,
+    FileSystemBytecodeCache,
+    FileSystemLoader,
+)
 
 from ckanext.activity.model import Activity
+from ckanext.subscribe import cache
 
 config = p.toolkit.config
 
+# the number of object ids in each activity query
+ACTIVITY_QUERY_CHUNK_SIZE = 1000
+# the number of activities fetched from the database at a time
+ACTIVITY_YIELD_PER = 500
+
+# the default email templates, which can be overridden by files in the
+# ckanext.subscribe.email_templates_directory
+EMAIL_TEMPLATES = {
+    "notification.html": """
+<p>Changes have occurred in relation to your subscription(s)</p>
+
+{% for notification in notifications %}
+
+  <h3><a href="{{ notification.object_link }}">"{{ notification.object_title }}" ({{ notification.object_name }})</a>:</h3>
+
+  {% for activity in notification.activities %}
+    <p>
+      - {{ activity.timestamp.strftime('%Y-%m-%d %H:%M') }} -
+      {{ activity.activity_type }}
+      {% if notification.object_type != 'dataset' %}
+        - {{ activity.dataset_link }}
+      {% endif %}
+    </p>
+  {% endfor %}
+{% endfor %}
+
+--
+{{ html_footer }}
+""",
+    "notification.txt": """
+Changes have occurred in relation to your subscription(s)
+
+{% for notification in notifications %}
+  "{{ notification.object_title }}" - {{ notification.object_link }}
+
+  {% for activity in notification.activities %}
+      - {{ activity.timestamp.strftime('%Y-%m-%d %H:%M') }} - {{ activity.activity_type }} {% if (
+          notification.object_type != 'dataset') %} - {{ activity.dataset_href }} {% endif %}
+
+  {% endfor %}
+{% endfor %}
+
+--
+{{ plain_text_footer }}
+""",
+}
+# (settings, jinja2.Environment)
+_email_template_environment = None
+
 
 def get_footer_contents(email_vars, subscription=None):
     html_lines = []
@@ -63,16 +119,8 @@ def get_email_vars(code, subscription=None, email=None):
     """
     assert code
     assert subscription or email
-    unsubscribe_all_link = p.toolkit.url_for(
-        "subscribe.unsubscribe_all",
-        code=code,
-        qualified=True,
-    )
-    manage_link = p.toolkit.url_for(
-        "subscribe.manage",
-        code=code,
-        qualified=True,
-    )
+    unsubscribe_all_link = cache.url_with_code("subscribe.unsubscribe_all", code)
+    manage_link = cache.url_with_code("subscribe.manage", code)
     extra_vars = dict(
         site_title=config.get("ckan.site_title"),
         site_url=config.get("ckan.site_url"),
@@ -82,19 +130,15 @@ def get_email_vars(code, subscription=None, email=None):
     )
 
     if subscription:
-        if subscription.object_type == "dataset":
-            subscription_object = model.Package.get(subscription.object_id)
-        else:
-            subscription_object = model.Group.get(subscription.object_id)
-        object_link = p.toolkit.url_for(
-            f"{subscription.object_type}.read",
-            id=subscription.object_id,
-            qualified=True,
+        subscription_object = cache.get_object(
+            subscription.object_type, subscription.object_id
         )
-        unsubscribe_link = p.toolkit.url_for(
+        object_link = cache.url_for(
+            f"{subscription.object_type}.read", id=subscription.object_id
+        )
+        unsubscribe_link = cache.url_with_code(
             "subscribe.unsubscribe",
-            code=code,
-            qualified=True,
+            code,
             **{subscription.object_type: subscription.object_id},
         )
         extra_vars.update(
@@ -176,48 +220,45 @@ def get_notification_email_contents(email_vars):
     # Make sure subject is only one line
     subject = subject.split("\n")[0]
 
-    html_body = Template(
-        """
-<p>Changes have occurred in relation to your subscription(s)</p>
-
-{% for notification in notifications %}
-
-  <h3><a href="{{ notification.object_link }}">"{{ notification.object_title }}" ({{ notification.object_name }})</a>:</h3>
-
-  {% for activity in notification.activities %}
-    <p>
-      - {{ activity.timestamp.strftime('%Y-%m-%d %H:%M') }} -
-      {{ activity.activity_type }}
-      {% if notification.object_type != 'dataset' %}
-        - {{ activity.dataset_link }}
-      {% endif %}
-    </p>
-  {% endfor %}
-{% endfor %}
-
---
-{{ html_footer }}
-"""
-    ).render(**email_vars)
-    plain_text_body = Template(
-        """
-Changes have occurred in relation to your subscription(s)
-
-{% for notification in notifications %}
-  "{{ notification.object_title }}" - {{ notification.object_link }}
+    environment = get_email_template_environment()
+    html_body = environment.get_template("notification.html").render(**email_vars)
+    plain_text_body = environment.get_template("notification.txt").render(**email_vars)
+    return subject, plain_text_body, html_body
 
-  {% for activity in notification.activities %}
-      - {{ activity.timestamp.strftime('%Y-%m-%d %H:%M') }} - {{ activity.activity_type }} {% if (
-          notification.object_type != 'dataset') %} - {{ activity.dataset_href }} {% endif %}
 
-  {% endfor %}
-{% endfor %}
+def get_email_template_environment():
+    """Returns the Jinja environment for the email templates. It is shared by
+    all the emails, so each template is only parsed and compiled once.
 
---
-{{ plain_text_footer }}
-"""
-    ).render(**email_vars)
-    return subject, plain_text_body, html_body
+    Templates in the directory ckanext.subscribe.email_templates_directory
+    override the defaults in EMAIL_TEMPLATES. If
+    ckanext.subscribe.email_templates_bytecode_cache is set, the compiled
+    templates are also cached in that directory, for other processes to use.
+    """
+    global _email_template_environment
+    templates_directory = config.get("ckanext.subscribe.email_templates_directory")
+    bytecode_cache_directory = config.get(
+        "ckanext.subscribe.email_templates_bytecode_cache"
+    )
+    settings = (templates_directory, bytecode_cache_directory)
+    if _email_template_environment is None or (
+        _email_template_environment[0] != settings
+    ):
+        loaders = [DictLoader(EMAIL_TEMPLATES)]
+        if templates_directory:
+            loaders.insert(0, FileSystemLoader(templates_directory))
+        environment = Environment(
+            loader=ChoiceLoader(loaders),
+            bytecode_cache=(
+                FileSystemBytecodeCache(bytecode_cache_directory)
+                if bytecode_cache_directory
+                else None
+            ),
+            # don't check the template files for changes on every email
+            auto_reload=False,
+        )
+        _email_template_environment = (settings, environment)
+    return _email_template_environment[1]
 
 
 def get_verification_email_contents(email_vars):
@@ -253,10 +294,21 @@ To confirm this email subscription, click this link:
 
 
 def filter_activities(include_activity_from, objects_subscribed_to_keys):
-    activities = (
-        model.Session.query(Activity)
-        .filter(Activity.timestamp > include_activity_from)
-        .filter(Activity.object_id.in_(objects_subscribed_to_keys))
-        .all()
-    )
-    return activities
+    """Yields the activity since `include_activity_from` on the given objects.
+
+    The object ids are queried in chunks, to keep the SQL statements small,
+    and the activities are streamed from the database rather than all loaded
+    into memory at once.
+    """
+    objects_subscribed_to_keys = list(objects_subscribed_to_keys)
+    for i in range(0, len(objects_subscribed_to_keys), ACTIVITY_QUERY_CHUNK_SIZE):
+        yield from (
+            model.Session.query(Activity)
+            .filter(Activity.timestamp > include_activity_from)
+            .filter(
+                Activity.object_id.in_(
+                    objects_subscribed_to_keys[i : i + ACTIVITY_QUERY_CHUNK_SIZE]
+                )
+            )
+            .yield_per(ACTIVITY_YIELD_PER)
+        )